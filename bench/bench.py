@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks the CPU-bound stages of the pipeline on their own, using synthetic calendars and a fake display, so that no
+Google account, browser or physical panel is needed:
+- normalize: GcalHelper.retrieve_events against a stand-in Calendar API service
+- template: RenderHelper.generate_html
+- draw: RenderHelper.draw_calendar, i.e. drawing the calendar with PIL from the glyph atlases instead
+- split: RenderHelper.split_colours on a synthetic screenshot
+- pack: EPD.getbuffer for the black and red images
+- slice: EPD.send_buffers, i.e. slicing the packed buffers into the four quadrants of the panel
+
+Each stage is run a number of times and the fastest time is kept. Results can be saved as a JSON baseline, and later
+runs fail (exit code 1) when a stage is slower than the baseline by more than the threshold. For example:
+
+python3 -m bench.bench --save        # record a baseline on this machine
+python3 -m bench.bench               # compare against it
+"""
+
+import datetime as dt
+import argparse
+import json
+import os
+import pathlib
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from bench import fakeepdconfig
+from bench.synthetic import make_calendars, FakeCalendarService
+
+DEFAULT_BASELINE = str(pathlib.Path(__file__).parent.absolute()) + '/baseline.json'
+
+
+def best_of(func, repeat):
+    # returns the fastest of a number of runs, and the result of the last run
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def make_screenshot(path, width, height, seed=0):
+    # a synthetic screenshot with black, grey and red text and shapes, saved as a PNG like the browser would
+    from PIL import Image, ImageDraw
+    rng = random.Random(seed)
+    image = Image.new('RGB', (width, height), (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    colours = [(0, 0, 0), (108, 117, 125), (220, 53, 69), (255, 0, 0)]
+    for _ in range(600):
+        x, y = rng.randrange(width), rng.randrange(height)
+        draw.text((x, y), 'event {}'.format(rng.randrange(1000)), fill=rng.choice(colours))
+    for _ in range(40):
+        x, y = rng.randrange(width - 60), rng.randrange(height - 60)
+        draw.ellipse((x, y, x + 60, y + 60), fill=rng.choice(colours))
+    image.save(path)
+
+
+def run_benchmarks(calendarCount, eventCount, repeat, seed):
+    import pytz
+    from gcal.gcal import GcalHelper
+    from render.render import RenderHelper
+    fakeepdconfig.install()
+    import display.epd12in48b as eink
+
+    results = {}
+    localTZ = pytz.timezone('America/New_York')
+    today = dt.date.today()
+    calStartDate = today - dt.timedelta(days=((today.weekday() + 1) % 7))
+    startDatetime = localTZ.localize(dt.datetime.combine(calStartDate, dt.datetime.min.time()))
+    endDatetime = localTZ.localize(dt.datetime.combine(calStartDate + dt.timedelta(days=34), dt.datetime.max.time()))
+
+    # normalisation of the raw events returned by the Calendar API
+    calendars = make_calendars(calendarCount, eventCount // max(1, calendarCount), startDatetime, seed=seed)
+    gcalService = GcalHelper(service=FakeCalendarService(calendars))
+    results['normalize'], eventList = best_of(
+        lambda: gcalService.retrieve_events(list(calendars), startDatetime, endDatetime, localTZ, 24), repeat)
+
+    # generation of the calendar HTML
+    renderService = RenderHelper(984, 1304, 270)
+    calDict = {'events': eventList, 'calStartDate': calStartDate, 'today': today,
+               'lastRefresh': dt.datetime.now(localTZ), 'batteryLevel': 80, 'batteryDisplayMode': 1,
+               'dayOfWeekText': ['M', 'T', 'W', 'T', 'F', 'S', 'S'], 'weekStartDay': 6, 'maxEventsPerDay': 3,
+               'is24hour': False}
+    results['template'], _ = best_of(lambda: renderService.generate_html(calDict), repeat)
+    results['draw'], _ = best_of(lambda: renderService.draw_calendar(calDict), repeat)
+
+    # colour split of the screenshot
+    with tempfile.TemporaryDirectory() as tmpDir:
+        screenshot = os.path.join(tmpDir, 'calendar.png')
+        make_screenshot(screenshot, 984, 1304, seed)
+        from PIL import Image
+        image = Image.open(screenshot)
+        image.load()
+        results['split'], (blackimg, redimg) = best_of(lambda: renderService.split_colours(image), repeat)
+
+    # packing and quadrant slicing on a fake panel
+    epd = eink.EPD()
+    results['pack'], (blackbuf, redbuf) = best_of(lambda: (epd.getbuffer(blackimg), epd.getbuffer(redimg)), repeat)
+    fakeepdconfig.reset_counters()
+    results['slice'], _ = best_of(lambda: epd.send_buffers(blackbuf, redbuf), repeat)
+    spiBytes = fakeepdconfig.counters['spi_bytes'] // repeat
+    return results, {'events': len(eventList), 'spi_bytes': spiBytes}
+
+
+def compare(results, baseline, threshold):
+    # returns a list of stages that regressed by more than the threshold
+    regressions = []
+    for stage, elapsed in results.items():
+        reference = baseline.get('stages', {}).get(stage)
+        if reference is None:
+            print('{:<10} {:>9.4f}s   (no baseline)'.format(stage, elapsed))
+            continue
+        change = (elapsed - reference) / reference if reference > 0 else 0
+        isRegression = change > threshold
+        print('{:<10} {:>9.4f}s   baseline {:>9.4f}s   {:>+7.1%}{}'.format(
+            stage, elapsed, reference, change, '   REGRESSION' if isRegression else ''))
+        if isRegression:
+            regressions.append(stage)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages with synthetic data.')
+    parser.add_argument('--calendars', type=int, default=3, help='number of synthetic calendars')
+    parser.add_argument('--events', type=int, default=300, help='total number of synthetic events')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per stage, the fastest is kept')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the synthetic data')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline JSON file')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown before failing, e.g. 0.25')
+    parser.add_argument('--save', action='store_true', help='save the results as the new baseline')
+    args = parser.parse_args()
+
+    results, info = run_benchmarks(args.calendars, args.events, args.repeat, args.seed)
+    print('{} events normalised, {} bytes sent over SPI per update'.format(info['events'], info['spi_bytes']))
+
+    if args.save:
+        baseline = {'stages': results, 'calendars': args.calendars, 'events': args.events, 'repeat': args.repeat,
+                    'seed': args.seed, 'python': platform.python_version(), 'machine': platform.machine(),
+                    'created': dt.datetime.now().isoformat(timespec='seconds')}
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2)
+        for stage, elapsed in results.items():
+            print('{:<10} {:>9.4f}s'.format(stage, elapsed))
+        print('Baseline saved to ' + args.baseline)
+        return
+
+    try:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = {}
+        print('No baseline found at {}, run with --save to create one'.format(args.baseline))
+    if baseline and (baseline.get('calendars'), baseline.get('events')) != (args.calendars, args.events):
+        print('Warning: baseline was recorded with {} calendars and {} events'.format(
+            baseline.get('calendars'), baseline.get('events')))
+
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print('Stages slower than baseline by more than {:.0%}: {}'.format(args.threshold, ', '.join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
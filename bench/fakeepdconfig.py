@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A stand-in for display/epdconfig.py that has no GPIO or SPI behind it. It mirrors the same module level functions and
+pin constants, and only counts what would have been sent to the panel. Call install() before importing
+display.epd12in48b to drive the EPD class without a physical display attached.
+
+Optionally, the bytes sent are recorded as a transcript of commands and data, with the controllers they were sent to
+(from the chip select pins that were low at the time), see bench/transcript.py.
+"""
+
+import hashlib
+import sys
+import time
+
+EPD_SCK_PIN   =11
+EPD_MOSI_PIN  =10
+
+EPD_M1_CS_PIN  =8
+EPD_S1_CS_PIN  =7
+EPD_M2_CS_PIN  =17
+EPD_S2_CS_PIN  =18
+
+EPD_M1S1_DC_PIN  =13
+EPD_M2S2_DC_PIN  =22
+
+EPD_M1S1_RST_PIN =6
+EPD_M2S2_RST_PIN =23
+
+EPD_M1_BUSY_PIN  =5
+EPD_S1_BUSY_PIN  =19
+EPD_M2_BUSY_PIN  =27
+EPD_S2_BUSY_PIN  =24
+
+# controller -> (chip select pin, data/command pin)
+CONTROLLERS = (('M1', EPD_M1_CS_PIN, EPD_M1S1_DC_PIN), ('S1', EPD_S1_CS_PIN, EPD_M1S1_DC_PIN),
+               ('M2', EPD_M2_CS_PIN, EPD_M2S2_DC_PIN), ('S2', EPD_S2_CS_PIN, EPD_M2S2_DC_PIN))
+MAX_RECORDED_BYTES = 64  # longer data, i.e. the image planes, is recorded by its length and hash
+
+counters = {'gpio_writes': 0, 'spi_bytes': 0, 'spi_transfers': 0}
+pins = {}
+backend = 'rpigpio'
+transcript = None  # list of [controllers, 'command' or 'data', bytearray] while recording
+
+
+def install():
+    # must be called before display.epd12in48b is first imported
+    sys.modules['display.epdconfig'] = sys.modules[__name__]
+
+
+def reset_counters():
+    for key in counters:
+        counters[key] = 0
+
+
+def start_transcript():
+    global transcript
+    transcript = []
+
+
+def stop_transcript():
+    # returns the transcript recorded since start_transcript, as JSON friendly lists
+    global transcript
+    entries, transcript = transcript or [], None
+    result = []
+    for controllers, kind, data in entries:
+        if len(data) > MAX_RECORDED_BYTES:
+            result.append([controllers, kind, '{} bytes sha1:{}'.format(len(data), hashlib.sha1(data).hexdigest())])
+        else:
+            result.append([controllers, kind, data.hex()])
+    return result
+
+
+def record(values):
+    selected = [(name, dcPin) for name, csPin, dcPin in CONTROLLERS if pins.get(csPin, 1) == 0]
+    controllers = ''.join(name for name, dcPin in selected)
+    kind = 'data' if selected and pins.get(selected[0][1], 1) else 'command'
+    # consecutive data bytes are merged, however they were split into transfers
+    if kind == 'data' and transcript and transcript[-1][:2] == [controllers, kind]:
+        transcript[-1][2].extend(value & 0xFF for value in values)
+    else:
+        transcript.append([controllers, kind, bytearray(value & 0xFF for value in values)])
+
+
+def set_backend(name):
+    global backend
+    backend = name
+
+def digital_write(pin, value):
+    counters['gpio_writes'] += 1
+    pins[pin] = value
+
+def digital_write_lines(lines, values):
+    counters['gpio_writes'] += 1
+    pins.update(zip(lines, values))
+
+def digital_read(pin):
+    return 1  # busy pins are active low, so the panel always reports idle
+
+def spi_writebyte(value):
+    counters['spi_bytes'] += 1
+    counters['spi_transfers'] += 1
+    if transcript is not None:
+        record((value,))
+
+def spi_writebytes(values):
+    counters['spi_bytes'] += len(values)
+    counters['spi_transfers'] += 1
+    if transcript is not None:
+        record(values)
+
+def delay_ms(delaytime):
+    time.sleep(delaytime / 1000.0)
+
+def module_init():
+    return 0
+
+def module_exit():
+    pass
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks the GPIO backends (see display/gpiobackend.py) on the pin toggling around each byte sent to the panel:
+- per-line: one call per pin, as the driver used to do, e.g. 10 calls to select all four controllers for a command
+  and deselect them again
+- bulk: the data/command and chip select lines set together, e.g. 2 calls for the same command
+
+Both are timed for a command sent to all four controllers and for a data byte sent to one of them, which is what the
+image planes are made of. The SPI transfer itself is left out, as it is the same whichever backend drives the pins.
+
+The gpiod backend does not need a Pi: with --sim, a simulated chip with enough lines for the BCM pin numbers is created
+with the gpio-sim kernel module (needs root, and modprobe gpio-sim) and removed afterwards. RPi.GPIO only drives the
+pins of the Pi itself, so it is included with --rpigpio, on a Pi. For example:
+
+sudo python3 -m bench.gpio --sim                  # gpiod on a simulated chip, on any Linux machine
+sudo python3 -m bench.gpio --rpigpio              # gpiod on /dev/gpiochip0 and RPi.GPIO, on a Pi
+"""
+
+import argparse
+import os
+import time
+
+from bench import fakeepdconfig as pins
+from display.gpiobackend import make_backend
+
+SIM_CONFIG = '/sys/kernel/config/gpio-sim'
+SIM_DEVICE = 'maginkcal-bench'
+SIM_LINES = 28  # BCM pin numbers go up to 27
+
+OUTPUTS = {pins.EPD_M2S2_RST_PIN: 0, pins.EPD_M1S1_RST_PIN: 0, pins.EPD_M2S2_DC_PIN: 1, pins.EPD_M1S1_DC_PIN: 1,
+           pins.EPD_S1_CS_PIN: 1, pins.EPD_S2_CS_PIN: 1, pins.EPD_M1_CS_PIN: 1, pins.EPD_M2_CS_PIN: 1}
+INPUTS = [pins.EPD_S1_BUSY_PIN, pins.EPD_S2_BUSY_PIN, pins.EPD_M1_BUSY_PIN, pins.EPD_M2_BUSY_PIN]
+CS_PINS = (pins.EPD_M1_CS_PIN, pins.EPD_S1_CS_PIN, pins.EPD_M2_CS_PIN, pins.EPD_S2_CS_PIN)
+DC_PINS = (pins.EPD_M1S1_DC_PIN, pins.EPD_M2S2_DC_PIN)
+
+
+def write_file(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def create_sim_chip():
+    # returns the path of a new simulated chip
+    bank = os.path.join(SIM_CONFIG, SIM_DEVICE, 'bank0')
+    os.makedirs(bank)
+    write_file(os.path.join(bank, 'num_lines'), str(SIM_LINES))
+    write_file(os.path.join(SIM_CONFIG, SIM_DEVICE, 'live'), '1')
+    with open(os.path.join(bank, 'chip_name'), 'r') as f:
+        return '/dev/' + f.read().strip()
+
+
+def remove_sim_chip():
+    write_file(os.path.join(SIM_CONFIG, SIM_DEVICE, 'live'), '0')
+    os.rmdir(os.path.join(SIM_CONFIG, SIM_DEVICE, 'bank0'))
+    os.rmdir(os.path.join(SIM_CONFIG, SIM_DEVICE))
+
+
+def command_per_line(backend):
+    for pin in DC_PINS:
+        backend.write(pin, 0)
+    for pin in CS_PINS:
+        backend.write(pin, 0)
+    for pin in CS_PINS:
+        backend.write(pin, 1)
+
+
+def command_bulk(backend):
+    backend.write_lines(DC_PINS + CS_PINS, (0, 0, 0, 0, 0, 0))
+    backend.write_lines(CS_PINS, (1, 1, 1, 1))
+
+
+def data_per_line(backend):
+    backend.write(pins.EPD_M2S2_DC_PIN, 1)
+    backend.write(pins.EPD_S2_CS_PIN, 0)
+    backend.write(pins.EPD_S2_CS_PIN, 1)
+
+
+def data_bulk(backend):
+    backend.write_lines((pins.EPD_M2S2_DC_PIN, pins.EPD_S2_CS_PIN), (1, 0))
+    backend.write(pins.EPD_S2_CS_PIN, 1)
+
+
+def time_per_call(func, backend, count):
+    # returns the average time of a call in microseconds
+    start = time.perf_counter()
+    for _ in range(count):
+        func(backend)
+    return (time.perf_counter() - start) / count * 1e6
+
+
+def run_benchmarks(backendNames, count):
+    results = {}
+    for name in backendNames:
+        backend = make_backend(name)
+        try:
+            backend.setup(OUTPUTS, INPUTS)
+            for test in (command_per_line, command_bulk, data_per_line, data_bulk):
+                results[(name, test.__name__)] = time_per_call(test, backend, count)
+        finally:
+            backend.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the GPIO backends on the pin toggling around each byte.')
+    parser.add_argument('--sim', action='store_true', help='run gpiod on a simulated chip created with gpio-sim')
+    parser.add_argument('--chip', default='/dev/gpiochip0', help='chip for the gpiod backend, without --sim')
+    parser.add_argument('--rpigpio', action='store_true', help='also benchmark RPi.GPIO, on a Pi')
+    parser.add_argument('--count', type=int, default=20000, help='calls per test')
+    args = parser.parse_args()
+
+    chipPath = create_sim_chip() if args.sim else args.chip
+    try:
+        backendNames = ['gpiod:' + chipPath] + (['rpigpio'] if args.rpigpio else [])
+        results = run_benchmarks(backendNames, args.count)
+    finally:
+        if args.sim:
+            remove_sim_chip()
+
+    for (name, test), elapsed in results.items():
+        print('{:<24} {:<18} {:>8.2f}us'.format(name, test, elapsed))
+    # the image planes are 2 x 1304 x 984 / 8 data bytes
+    planeBytes = 2 * 1304 * 984 // 8
+    for name in backendNames:
+        saved = (results[(name, 'data_per_line')] - results[(name, 'data_bulk')]) * planeBytes / 1e6
+        print('{}: {:.2f}s less spent on the pins per update with bulk writes'.format(name, saved))
+
+
+if __name__ == '__main__':
+    main()
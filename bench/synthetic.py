@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Generators for synthetic calendars, so that the pipeline can be exercised without a Google account. Events are produced
+in the same shape as the items returned by the Google Calendar API events().list call, and a stand-in for the API
+service object serves them to GcalHelper.
+"""
+
+import datetime as dt
+import random
+import time
+
+WORDS = ['team', 'sync', 'lunch', 'dentist', 'review', 'school', 'pickup', 'birthday', 'planning', 'call', 'gym',
+         'dinner', 'flight', 'standup', 'workshop', 'piano', 'football', 'groceries', 'quarterly', 'retrospective']
+
+
+def make_summary(rng, isLong):
+    count = rng.randint(8, 16) if isLong else rng.randint(1, 4)
+    return ' '.join(rng.choice(WORDS) for _ in range(count)).capitalize()
+
+
+def make_event(rng, calId, index, startDatetime, days, allDayRatio, multiDayRatio, longSummaryRatio):
+    # a single event in the format returned by the Calendar API, placed randomly within the given window
+    day = startDatetime + dt.timedelta(days=rng.randrange(days))
+    updated = dt.datetime.now(dt.timezone.utc) - dt.timedelta(hours=rng.uniform(0, 24 * 14))
+    event = {'id': '{}-{}'.format(calId, index), 'iCalUID': '{}-{}@synthetic'.format(calId, index),
+             'summary': make_summary(rng, rng.random() < longSummaryRatio),
+             'updated': updated.strftime('%Y-%m-%dT%H:%M:%S.000Z')}
+    length = rng.randint(2, 4) if rng.random() < multiDayRatio else 0
+    if rng.random() < allDayRatio:
+        event['start'] = {'date': day.date().isoformat()}
+        event['end'] = {'date': (day.date() + dt.timedelta(days=length + 1)).isoformat()}
+    else:
+        start = day.replace(hour=rng.randint(7, 20), minute=rng.choice([0, 15, 30, 45]), second=0, microsecond=0)
+        end = start + dt.timedelta(days=length, minutes=rng.choice([30, 60, 90, 120]))
+        event['start'] = {'dateTime': start.isoformat()}
+        event['end'] = {'dateTime': end.isoformat()}
+    return event
+
+
+def make_calendars(calendarCount, eventsPerCalendar, startDatetime, days=35, allDayRatio=0.2, multiDayRatio=0.1,
+                   longSummaryRatio=0.1, seed=0):
+    # returns {calendarId: [event, ...]} with events sorted by start time, as the API would with orderBy='startTime'
+    rng = random.Random(seed)
+    calendars = {}
+    for c in range(calendarCount):
+        calId = 'calendar{}@synthetic'.format(c)
+        events = [make_event(rng, calId, i, startDatetime, days, allDayRatio, multiDayRatio, longSummaryRatio)
+                  for i in range(eventsPerCalendar)]
+        events.sort(key=lambda k: k['start'].get('dateTime', k['start'].get('date')))
+        calendars[calId] = events
+    return calendars
+
+
+class FakeRequest:
+
+    def __init__(self, response):
+        self.response = response
+
+    def execute(self):
+        return self.response
+
+
+class FakeEvents:
+
+    def __init__(self, calendars):
+        self.calendars = calendars
+
+    def list(self, calendarId, updatedMin=None, **kwargs):
+        items = list(self.calendars.get(calendarId, []))
+        if updatedMin is not None:
+            since = dt.datetime.fromisoformat(updatedMin.replace('Z', '+00:00'))
+            items = [item for item in items
+                     if dt.datetime.fromisoformat(item['updated'].replace('Z', '+00:00')) > since]
+        return FakeRequest({'items': items})
+
+    def watch(self, calendarId, body):
+        ttl = int(body.get('params', {}).get('ttl', 604800))
+        return FakeRequest({'kind': 'api#channel', 'id': body['id'], 'resourceId': 'resource-' + calendarId,
+                            'resourceUri': calendarId, 'token': body.get('token'),
+                            'expiration': str(int((time.time() + ttl) * 1000))})
+
+
+class FakeChannels:
+
+    def __init__(self):
+        self.stopped = []
+
+    def stop(self, body):
+        self.stopped.append(body)
+        return FakeRequest({})
+
+
+class FakeCalendarService:
+    # stand-in for the service object built by googleapiclient, serving synthetic calendars
+
+    def __init__(self, calendars):
+        self.calendars = calendars
+        self.fakeChannels = FakeChannels()
+
+    def events(self):
+        return FakeEvents(self.calendars)
+
+    def channels(self):
+        return self.fakeChannels
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks the commands and data sent to the panel against a recorded transcript, so that changes to the display driver
+(e.g. how the LUTs are sent) can be verified without a physical display. For each waveform, the fake display is
+initialised, shown the same frame twice and put to sleep, and everything sent over SPI is recorded along with the
+controllers it was sent to. The image planes are recorded by their length and hash.
+
+bench/transcript.json was recorded from this driver, so it only catches changes from here on. It does not show that the
+skipred and fast waveforms work on a panel. The LUTs of the full waveform are the same, register by register, as those
+the original Waveshare driver sent in Init, one byte at a time. For example:
+
+python3 -m bench.transcript --save   # record the transcript of the current driver
+python3 -m bench.transcript          # fail (exit code 1) if the driver now sends anything else
+"""
+
+import argparse
+import json
+import pathlib
+import sys
+
+from bench import fakeepdconfig
+
+DEFAULT_TRANSCRIPT = str(pathlib.Path(__file__).parent.absolute()) + '/transcript.json'
+
+
+def make_frame():
+    # a frame with some black and some red, always the same
+    from PIL import Image, ImageDraw
+    from render.framebuffer import encode_frame
+    blackImage = Image.new('L', (1304, 984), 255)
+    redImage = Image.new('L', (1304, 984), 255)
+    ImageDraw.Draw(blackImage).rectangle((100, 100, 700, 400), fill=0)
+    ImageDraw.Draw(redImage).ellipse((800, 500, 1000, 700), fill=0)
+    return encode_frame(blackImage, redImage)
+
+
+def record_transcripts():
+    # returns {waveform: transcript}
+    fakeepdconfig.install()
+    import display.epd12in48b as eink
+    from display.client import upload_frame
+    from display.waveforms import WAVEFORMS
+    from render.framebuffer import decode_frame
+
+    sections = decode_frame(make_frame())
+    transcripts = {}
+    for name in WAVEFORMS:
+        epd = eink.EPD()
+        fakeepdconfig.start_transcript()
+        epd.Init()
+        epd.set_waveform(name)
+        upload_frame(epd, sections)
+        upload_frame(epd, sections)  # the LUTs are loaded already and should not be sent again
+        epd.EPD_Sleep()
+        transcripts[name] = fakeepdconfig.stop_transcript()
+    return transcripts
+
+
+def compare(transcripts, recorded):
+    # returns a list of waveforms whose transcript differs from the recorded one
+    mismatches = []
+    for name, transcript in transcripts.items():
+        reference = recorded.get(name)
+        if reference is None:
+            print('{:<10} {:>5} entries   (not recorded)'.format(name, len(transcript)))
+            continue
+        if transcript == reference:
+            print('{:<10} {:>5} entries   ok'.format(name, len(transcript)))
+            continue
+        index = next((i for i, (a, b) in enumerate(zip(transcript, reference)) if a != b),
+                     min(len(transcript), len(reference)))
+        print('{:<10} {:>5} entries   MISMATCH at entry {}: {} instead of {}'.format(
+            name, len(transcript), index, transcript[index] if index < len(transcript) else 'nothing',
+            reference[index] if index < len(reference) else 'nothing'))
+        mismatches.append(name)
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check what is sent to the panel against a recorded transcript.')
+    parser.add_argument('--transcript', default=DEFAULT_TRANSCRIPT, help='recorded transcript JSON file')
+    parser.add_argument('--save', action='store_true', help='save the current transcript as the reference')
+    args = parser.parse_args()
+
+    transcripts = record_transcripts()
+    if args.save:
+        with open(args.transcript, 'w') as f:
+            json.dump(transcripts, f, indent=1)
+        print('Transcript saved to ' + args.transcript)
+        return
+
+    try:
+        with open(args.transcript, 'r') as f:
+            recorded = json.load(f)
+    except FileNotFoundError:
+        print('No transcript found at {}, run with --save to record one'.format(args.transcript))
+        sys.exit(1)
+    mismatches = compare(transcripts, recorded)
+    if mismatches:
+        print('Transcript differs for: {}'.format(', '.join(mismatches)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
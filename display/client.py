@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Thin client for a display node that does not render the calendar itself. It fetches the latest frame from a render
+server (python3 maginkcal.py --daemon with isRenderServer enabled) and uploads the planes to the panel as they are,
+so neither Chromium nor any image processing is needed on this device. The ETag of the last frame shown is kept in
+display/frame.etag, and the panel is left untouched when the server reports that the frame has not changed.
+
+python3 -m display.client http://<render server>:8091/frame
+"""
+
+import urllib.request
+import urllib.error
+import pathlib
+import sys
+import logging
+
+from render.framebuffer import decode_frame
+from pipeline.files import write_atomic
+
+DEFAULT_ETAG_FILE = str(pathlib.Path(__file__).parent.absolute()) + '/frame.etag'
+
+
+def fetch_frame(url, etag=None, timeout=30):
+    # returns (frame, etag), or (None, etag) if the frame has not changed
+    request = urllib.request.Request(url)
+    if etag:
+        request.add_header('If-None-Match', etag)
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.read(), response.headers.get('ETag')
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return None, etag
+        raise
+
+
+def upload_frame(epd, sections):
+    # Sends each section to its quadrant of the panel and refreshes it
+    senders = {'S2': (epd.S2_SendCommand, epd.S2_SendData), 'M2': (epd.M2_SendCommand, epd.M2_SendData),
+               'M1': (epd.M1_SendCommand, epd.M1_SendData), 'S1': (epd.S1_SendCommand, epd.S1_SendData)}
+    for name, command, data in sections:
+        sendCommand, sendData = senders[name]
+        sendCommand(command)
+        for value in data:
+            sendData(value)
+    epd.TurnOnDisplay()
+
+
+class DisplayClient:
+
+    def __init__(self, url, etagFile=DEFAULT_ETAG_FILE, timeout=30):
+        self.logger = logging.getLogger('maginkcal')
+        self.url = url
+        self.etagFile = etagFile
+        self.timeout = timeout
+
+    def load_etag(self):
+        try:
+            with open(self.etagFile, 'r') as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def save_etag(self, etag):
+        write_atomic(self.etagFile, etag or '')
+
+    def refresh(self):
+        # returns True if the panel was updated
+        frame, etag = fetch_frame(self.url, self.load_etag(), self.timeout)
+        if frame is None:
+            self.logger.info('Frame unchanged, display not updated.')
+            return False
+        sections = decode_frame(frame)
+        self.logger.info('Fetched frame {} ({} bytes).'.format(etag, len(frame)))
+
+        import display.epd12in48b as eink
+        epd = eink.EPD()
+        epd.Init()
+        try:
+            upload_frame(epd, sections)
+        finally:
+            epd.EPD_Sleep()
+        # only remembered once shown, so that a failed upload is retried next time
+        self.save_etag(etag)
+        self.logger.info('E-Ink display update complete.')
+        return True
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: python3 -m display.client <frame url>')
+        sys.exit(1)
+    logging.basicConfig(format='%(asctime)s %(levelname)s - %(message)s')
+    logging.getLogger('maginkcal').setLevel(logging.INFO)
+    DisplayClient(sys.argv[1]).refresh()
@@ -6,38 +6,75 @@ This part of the code exposes functions to interface with the eink display
 
 import display.epd12in48b as eink
 from PIL import Image
+from contextlib import nullcontext
 import logging
 
 
 class DisplayHelper:
 
-    def __init__(self, width, height):
-        # Initialise the display
+    def __init__(self, width, height, recorder=None, gpioBackend='rpigpio'):
+        # Initialise the display, driving its pins with gpioBackend (see display/gpiobackend.py)
         self.logger = logging.getLogger('maginkcal')
         self.screenwidth = width
         self.screenheight = height
-        self.epd = eink.EPD()
-        self.epd.Init()
+        self.recorder = recorder  # optionally an EnergyLogger to account for the time spent in each stage
+        self.bytesSent = 0  # image data sent to the panel so far
+        with self.stage('panel'):
+            eink.epdconfig.set_backend(gpioBackend)
+            self.epd = eink.EPD()
+            self.epd.Init()
 
-    def update(self, blackimg, redimg):
-        # Updates the display with the grayscale and red images
+    def stage(self, name):
+        if self.recorder is None:
+            return nullcontext()
+        return self.recorder.stage(name)
+
+    def update(self, blackimg, redimg, waveform='full'):
+        # Updates the display with the grayscale and red images, see display/waveforms.py for the waveforms
         # start displaying on eink display
         # self.epd.clear()
-        self.epd.display(blackimg, redimg)
-        self.logger.info('E-Ink display update complete.')
+        self.epd.set_waveform(waveform)
+        with self.stage('pack'):
+            blackbuf = self.epd.getbuffer(blackimg)
+            redbuf = self.epd.getbuffer(redimg)
+        with self.stage('upload'):
+            self.epd.send_buffers(blackbuf, redbuf)
+        self.bytesSent += len(blackbuf) + len(redbuf)
+        with self.stage('busy'):
+            self.epd.TurnOnDisplay()
+        self.logger.info('E-Ink display update complete ({} waveform).'.format(waveform))
+
+    def show_frame(self, frame, waveform='full'):
+        # Updates the display with a frame that was packed beforehand, see render/framebuffer.py
+        from render.framebuffer import decode_frame
+        from display.client import upload_frame
+        self.epd.set_waveform(waveform)
+        sections = decode_frame(frame)
+        with self.stage('upload'):
+            upload_frame(self.epd, sections)
+        self.bytesSent += sum(len(data) for name, command, data in sections)
+        self.logger.info('E-Ink display update complete ({} waveform).'.format(waveform))
 
     def calibrate(self, cycles=1):
         # Calibrates the display to prevent ghosting
         white = Image.new('1', (self.screenwidth, self.screenheight), 'white')
         black = Image.new('1', (self.screenwidth, self.screenheight), 'black')
-        for _ in range(cycles):
-            self.epd.display(black, white)
-            self.epd.display(white, black)
-            self.epd.display(white, white)
+        self.epd.set_waveform('full')
+        with self.stage('calibrate'):
+            for _ in range(cycles):
+                self.epd.display(black, white)
+                self.epd.display(white, black)
+                self.epd.display(white, white)
+                self.bytesSent += 6 * self.screenwidth * self.screenheight // 8
         self.logger.info('E-Ink display calibration complete.')
 
+    def wake(self):
+        # wake the display from deep sleep, which requires a reset and reinitialisation of the controllers
+        with self.stage('panel'):
+            self.epd.Init()
+        self.logger.info('E-Ink display woken up.')
+
     def sleep(self):
         # send E-Ink display to deep sleep
         self.epd.EPD_Sleep()
         self.logger.info('E-Ink display entered deep sleep.')
-
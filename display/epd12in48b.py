@@ -27,7 +27,11 @@
 # THE SOFTWARE.
 #
 import time
+import logging
 import display.epdconfig as epdconfig
+import display.waveforms as waveforms
+
+logger = logging.getLogger('maginkcal')
 
 EPD_WIDTH       = 1304
 EPD_HEIGHT      = 984
@@ -53,15 +57,28 @@ class EPD(object):
         self.EPD_M2_BUSY_PIN  = epdconfig.EPD_M2_BUSY_PIN
         self.EPD_S2_BUSY_PIN  = epdconfig.EPD_S2_BUSY_PIN
 
+        # the lines set together to select controllers, data/command first, then chip selects. The controllers only
+        # latch data/command with the last bit of a byte, so it can change together with the chip selects.
+        self.M1S1M2S2_CS_PINS = (self.EPD_M1_CS_PIN, self.EPD_S1_CS_PIN, self.EPD_M2_CS_PIN, self.EPD_S2_CS_PIN)
+        self.M1S1M2S2_LINES = (self.EPD_M1S1_DC_PIN, self.EPD_M2S2_DC_PIN) + self.M1S1M2S2_CS_PINS
+        self.M1M2_CS_PINS = (self.EPD_M1_CS_PIN, self.EPD_M2_CS_PIN)
+        self.M1M2_LINES = (self.EPD_M1S1_DC_PIN, self.EPD_M2S2_DC_PIN) + self.M1M2_CS_PINS
+        self.M1_LINES = (self.EPD_M1S1_DC_PIN, self.EPD_M1_CS_PIN)
+        self.S1_LINES = (self.EPD_M1S1_DC_PIN, self.EPD_S1_CS_PIN)
+        self.M2_LINES = (self.EPD_M2S2_DC_PIN, self.EPD_M2_CS_PIN)
+        self.S2_LINES = (self.EPD_M2S2_DC_PIN, self.EPD_S2_CS_PIN)
+        self.RST_PINS = (self.EPD_M1S1_RST_PIN, self.EPD_M2S2_RST_PIN)
+
+        self.waveform = 'full'  # waveform used by the next refresh, see display/waveforms.py
+        self.loadedWaveform = None  # waveform in the LUT registers of the controllers
+
     def Init(self):
-        print("EPD init...")
+        logger.debug("EPD init...")
         epdconfig.module_init()
         
-        epdconfig.digital_write(self.EPD_M1_CS_PIN, 1) 
-        epdconfig.digital_write(self.EPD_S1_CS_PIN, 1) 
-        epdconfig.digital_write(self.EPD_M2_CS_PIN, 1) 
-        epdconfig.digital_write(self.EPD_S2_CS_PIN, 1) 
+        epdconfig.digital_write_lines(self.M1S1M2S2_CS_PINS, (1, 1, 1, 1))
         self.Reset() 
+        self.loadedWaveform = None  # the LUT registers are cleared by the reset
 
         #panel setting
         self.M1_SendCommand(0x00) 
@@ -146,42 +163,39 @@ class EPD(object):
         self.M1_SendData(0x1c)
         self.M2_SendCommand(0x82)
         self.M2_SendData(0x1c)
-
-        self.SetLut()
+        # the LUTs are sent before the next refresh, once the waveform for it is known
         
     def display(self, BlackImage, RedImage):
         start = time.time()
         
-        Blackbuf = [0x00] * int(self.width * self.height / 8)
-        blackconvert = BlackImage.convert('1')       
-        bimwidth, bimheight = blackconvert.size 
-        Blackpixles = blackconvert.load()
-        temp=0;
-        for y in range(0, bimheight):
-            for x in range(0, bimwidth):
-                if Blackpixles[x, y] < 127:           # black
-                    Blackbuf[int((x + y*self.width)/8)] &= ~(0x80>>temp)
-                else:                           # white
-                    Blackbuf[int((x + y*self.width)/8)] |= (0x80>>temp)
-                temp=temp+1
-                if(temp==8):
-                    temp=0
-                    
-        Redbuf = [0x00] * int(self.width * self.height / 8)
-        redconvert = RedImage.convert('1')
-        rimwidth, rimheight = redconvert.size 
-        Redpixles = redconvert.load()
+        Blackbuf = self.getbuffer(BlackImage)
+        Redbuf = self.getbuffer(RedImage)
+        self.send_buffers(Blackbuf, Redbuf)
+                
+        end = time.time()
+        logger.debug("use time: %f"%(end - start))
+        self.TurnOnDisplay()
+
+    def getbuffer(self, image):
+        """Pack an image into a 1bpp buffer, MSB first, with white as 1"""
+        buf = [0x00] * int(self.width * self.height / 8)
+        imageconvert = image.convert('1')
+        imwidth, imheight = imageconvert.size 
+        pixels = imageconvert.load()
         temp=0;
-        for y in range(0, rimheight):
-            for x in range(0, rimwidth):
-                if Redpixles[x, y] < 127:           # black
-                    Redbuf[int((x + y*self.width)/8)] &= ~(0x80>>temp)
+        for y in range(0, imheight):
+            for x in range(0, imwidth):
+                if pixels[x, y] < 127:           # black
+                    buf[int((x + y*self.width)/8)] &= ~(0x80>>temp)
                 else:                           # white
-                    Redbuf[int((x + y*self.width)/8)] |= (0x80>>temp)
+                    buf[int((x + y*self.width)/8)] |= (0x80>>temp)
                 temp=temp+1
                 if(temp==8):
                     temp=0
-                    
+        return buf
+
+    def send_buffers(self, Blackbuf, Redbuf):
+        """Upload packed black and red buffers to the four quadrants of the panel, without refreshing it"""
         #S2 part 648*492
         self.S2_SendCommand(0x10)
         for y in  range(0, 492):
@@ -221,10 +235,6 @@ class EPD(object):
         for y in  range(492, 984):
             for x in  range(81, 163):
                 self.S1_SendData(~Redbuf[y*163 + x])
-                
-        end = time.time()
-        print("use time: %f"%(end - start))
-        self.TurnOnDisplay()
 
     def clear(self):
         """Clear contents of image buffer"""
@@ -267,21 +277,16 @@ class EPD(object):
                 self.S1_SendData(0x00)
                 
         end = time.time()
-        print (end)
-        print (start)
-        print("use time: %f" %(end - start))
+        logger.debug("use time: %f" %(end - start))
         
         self.TurnOnDisplay()
         
     def Reset(self):
-        epdconfig.digital_write(self.EPD_M1S1_RST_PIN, 1) 
-        epdconfig.digital_write(self.EPD_M2S2_RST_PIN, 1) 
+        epdconfig.digital_write_lines(self.RST_PINS, (1, 1))
         time.sleep(0.2) 
-        epdconfig.digital_write(self.EPD_M1S1_RST_PIN, 0) 
-        epdconfig.digital_write(self.EPD_M2S2_RST_PIN, 0) 
+        epdconfig.digital_write_lines(self.RST_PINS, (0, 0))
         time.sleep(0.01) 
-        epdconfig.digital_write(self.EPD_M1S1_RST_PIN, 1) 
-        epdconfig.digital_write(self.EPD_M2S2_RST_PIN, 1) 
+        epdconfig.digital_write_lines(self.RST_PINS, (1, 1))
         time.sleep(0.2) 
     
     def EPD_Sleep(self):
@@ -291,10 +296,11 @@ class EPD(object):
         self.M1S1M2S2_SendCommand(0X07)   	
         self.M1S1M2S2_SendData(0xA5) 
         time.sleep(0.3) 
-        print("module_exit")
+        logger.debug("module_exit")
         epdconfig.module_exit()
 
     def TurnOnDisplay(self):
+        self.SetLut()
         self.M1M2_SendCommand(0x04)  
         time.sleep(0.3) 
         self.M1S1M2S2_SendCommand(0x12) 
@@ -305,97 +311,69 @@ class EPD(object):
         
     """   M1S1M2S2 Write register address and data     """
     def M1S1M2S2_SendCommand(self, cmd):
-        epdconfig.digital_write(self.EPD_M1S1_DC_PIN, 0)
-        epdconfig.digital_write(self.EPD_M2S2_DC_PIN, 0)
-        
-        epdconfig.digital_write(self.EPD_M1_CS_PIN, 0)
-        epdconfig.digital_write(self.EPD_S1_CS_PIN, 0)
-        epdconfig.digital_write(self.EPD_M2_CS_PIN, 0)
-        epdconfig.digital_write(self.EPD_S2_CS_PIN, 0)
+        epdconfig.digital_write_lines(self.M1S1M2S2_LINES, (0, 0, 0, 0, 0, 0))
         epdconfig.spi_writebyte(cmd) 
-        epdconfig.digital_write(self.EPD_M1_CS_PIN, 1)
-        epdconfig.digital_write(self.EPD_S1_CS_PIN, 1)
-        epdconfig.digital_write(self.EPD_M2_CS_PIN, 1)
-        epdconfig.digital_write(self.EPD_S2_CS_PIN, 1)
+        epdconfig.digital_write_lines(self.M1S1M2S2_CS_PINS, (1, 1, 1, 1))
     
     def M1S1M2S2_SendData(self, val):
-        epdconfig.digital_write(self.EPD_M1S1_DC_PIN, 1)
-        epdconfig.digital_write(self.EPD_M2S2_DC_PIN, 1)
-
-        epdconfig.digital_write(self.EPD_M1_CS_PIN, 0)
-        epdconfig.digital_write(self.EPD_S1_CS_PIN, 0)
-        epdconfig.digital_write(self.EPD_M2_CS_PIN, 0)
-        epdconfig.digital_write(self.EPD_S2_CS_PIN, 0)
+        epdconfig.digital_write_lines(self.M1S1M2S2_LINES, (1, 1, 0, 0, 0, 0))
         epdconfig.spi_writebyte(val) 
-        epdconfig.digital_write(self.EPD_M1_CS_PIN, 1)
-        epdconfig.digital_write(self.EPD_S1_CS_PIN, 1)
-        epdconfig.digital_write(self.EPD_M2_CS_PIN, 1)
-        epdconfig.digital_write(self.EPD_S2_CS_PIN, 1)
+        epdconfig.digital_write_lines(self.M1S1M2S2_CS_PINS, (1, 1, 1, 1))
+
+    def M1S1M2S2_SendDataBulk(self, values):
+        """Send several data bytes to all four controllers, selecting them once for the whole transfer"""
+        epdconfig.digital_write_lines(self.M1S1M2S2_LINES, (1, 1, 0, 0, 0, 0))
+        epdconfig.spi_writebytes(values)
+        epdconfig.digital_write_lines(self.M1S1M2S2_CS_PINS, (1, 1, 1, 1))
 
     """   M1M2 Write register address and data     """
     def M1M2_SendCommand(self, cmd):
-        epdconfig.digital_write(self.EPD_M1S1_DC_PIN, 0)
-        epdconfig.digital_write(self.EPD_M2S2_DC_PIN, 0)
-        epdconfig.digital_write(self.EPD_M1_CS_PIN, 0)
-        epdconfig.digital_write(self.EPD_M2_CS_PIN, 0)
+        epdconfig.digital_write_lines(self.M1M2_LINES, (0, 0, 0, 0))
         epdconfig.spi_writebyte(cmd) 
-        epdconfig.digital_write(self.EPD_M1_CS_PIN, 1)
-        epdconfig.digital_write(self.EPD_M2_CS_PIN, 1)
+        epdconfig.digital_write_lines(self.M1M2_CS_PINS, (1, 1))
         
-    def M1M2_Sendata(self, val): 
-        epdconfig.digital_write(self.EPD_M1S1_DC_PIN, 1)
-        epdconfig.digital_write(self.EPD_M2S2_DC_PIN, 1)
-        epdconfig.digital_write(self.EPD_M1_CS_PIN, 0)
-        epdconfig.digital_write(self.EPD_M2_CS_PIN, 0)
+    def M1M2_Sendata(self, val):
+        epdconfig.digital_write_lines(self.M1M2_LINES, (1, 1, 0, 0))
         epdconfig.spi_writebyte(val) 
-        epdconfig.digital_write(self.EPD_M1_CS_PIN, 1)
-        epdconfig.digital_write(self.EPD_M2_CS_PIN, 1)   
+        epdconfig.digital_write_lines(self.M1M2_CS_PINS, (1, 1))
           
     """   S2 Write register address and data     """
     def S2_SendCommand(self, cmd):
-        epdconfig.digital_write(self.EPD_M2S2_DC_PIN, 0)
-        epdconfig.digital_write(self.EPD_S2_CS_PIN, 0)
+        epdconfig.digital_write_lines(self.S2_LINES, (0, 0))
         epdconfig.spi_writebyte(cmd)
         epdconfig.digital_write(self.EPD_S2_CS_PIN, 1)
     def S2_SendData(self, val):
-        epdconfig.digital_write(self.EPD_M2S2_DC_PIN, 1)
-        epdconfig.digital_write(self.EPD_S2_CS_PIN, 0)
+        epdconfig.digital_write_lines(self.S2_LINES, (1, 0))
         epdconfig.spi_writebyte(val)
         epdconfig.digital_write(self.EPD_S2_CS_PIN, 1)
         
     """   M2 Write register address and data     """
     def M2_SendCommand(self, cmd):
-        epdconfig.digital_write(self.EPD_M2S2_DC_PIN, 0)
-        epdconfig.digital_write(self.EPD_M2_CS_PIN, 0)
+        epdconfig.digital_write_lines(self.M2_LINES, (0, 0))
         epdconfig.spi_writebyte(cmd) 
         epdconfig.digital_write(self.EPD_M2_CS_PIN, 1)
     def M2_SendData(self, val):
-        epdconfig.digital_write(self.EPD_M2S2_DC_PIN, 1)
-        epdconfig.digital_write(self.EPD_M2_CS_PIN, 0)
+        epdconfig.digital_write_lines(self.M2_LINES, (1, 0))
         epdconfig.spi_writebyte(val) 
         epdconfig.digital_write(self.EPD_M2_CS_PIN, 1)
 
     """   S1 Write register address and data     """
     def S1_SendCommand(self, cmd):
-        epdconfig.digital_write(self.EPD_M1S1_DC_PIN, 0)
-        epdconfig.digital_write(self.EPD_S1_CS_PIN, 0)
+        epdconfig.digital_write_lines(self.S1_LINES, (0, 0))
         epdconfig.spi_writebyte(cmd)
         epdconfig.digital_write(self.EPD_S1_CS_PIN, 1)
     def S1_SendData(self, val):
-        epdconfig.digital_write(self.EPD_M1S1_DC_PIN, 1)
-        epdconfig.digital_write(self.EPD_S1_CS_PIN, 0)
+        epdconfig.digital_write_lines(self.S1_LINES, (1, 0))
         epdconfig.spi_writebyte(val)
         epdconfig.digital_write(self.EPD_S1_CS_PIN, 1)
         
     """   M1 Write register address and data     """
     def M1_SendCommand(self, cmd):
-        epdconfig.digital_write(self.EPD_M1S1_DC_PIN, 0)
-        epdconfig.digital_write(self.EPD_M1_CS_PIN, 0)
+        epdconfig.digital_write_lines(self.M1_LINES, (0, 0))
         epdconfig.spi_writebyte(cmd)
         epdconfig.digital_write(self.EPD_M1_CS_PIN, 1)
     def M1_SendData(self, val):
-        epdconfig.digital_write(self.EPD_M1S1_DC_PIN, 1)
-        epdconfig.digital_write(self.EPD_M1_CS_PIN, 0)
+        epdconfig.digital_write_lines(self.M1_LINES, (1, 0))
         epdconfig.spi_writebyte(val)
         epdconfig.digital_write(self.EPD_M1_CS_PIN, 1)
 
@@ -438,88 +416,25 @@ class EPD(object):
             busy = not(busy & 0x01) 
         time.sleep(0.2)            
 
-    lut_vcom1 = [
-        0x00,	0x10,	0x10,	0x01,	0x08,	0x01,
-        0x00,	0x06,	0x01,	0x06,	0x01,	0x05,
-        0x00,	0x08,	0x01,	0x08,	0x01,	0x06,
-        0x00,	0x06,	0x01,	0x06,	0x01,	0x05,
-        0x00,	0x05,	0x01,	0x1E,	0x0F,	0x06,
-        0x00,	0x05,	0x01,	0x1E,	0x0F,	0x01,
-        0x00,	0x04,	0x05,	0x08,	0x08,	0x01,
-        0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
-        0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
-        0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
-    ]
-    lut_ww1 = [
-        0x91,	0x10,	0x10,	0x01,	0x08,	0x01,
-        0x04,	0x06,	0x01,	0x06,	0x01,	0x05,
-        0x84,	0x08,	0x01,	0x08,	0x01,	0x06,
-        0x80,	0x06,	0x01,	0x06,	0x01,	0x05,
-        0x00,	0x05,	0x01,	0x1E,	0x0F,	0x06,
-        0x00,	0x05,	0x01,	0x1E,	0x0F,	0x01,
-        0x08,	0x04,	0x05,	0x08,	0x08,	0x01,
-        0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
-        0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
-        0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
-    ]
-    lut_bw1 = [
-        0xA8,	0x10,	0x10,	0x01,	0x08,	0x01,
-        0x84,	0x06,	0x01,	0x06,	0x01,	0x05,
-        0x84,	0x08,	0x01,	0x08,	0x01,	0x06,
-        0x86,	0x06,	0x01,	0x06,	0x01,	0x05,
-        0x8C,	0x05,	0x01,	0x1E,	0x0F,	0x06,
-        0x8C,	0x05,	0x01,	0x1E,	0x0F,	0x01,
-        0xF0,	0x04,	0x05,	0x08,	0x08,	0x01,
-        0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
-        0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
-        0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
-    ]
-    lut_wb1 = [
-        0x91,	0x10,	0x10,	0x01,	0x08,	0x01,
-        0x04,	0x06,	0x01,	0x06,	0x01,	0x05,
-        0x84,	0x08,	0x01,	0x08,	0x01,	0x06,
-        0x80,	0x06,	0x01,	0x06,	0x01,	0x05,
-        0x00,	0x05,	0x01,	0x1E,	0x0F,	0x06,
-        0x00,	0x05,	0x01,	0x1E,	0x0F,	0x01,
-        0x08,	0x04,	0x05,	0x08,	0x08,	0x01,
-        0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
-        0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
-        0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
-    ]
-    lut_bb1 = [
-        0x92,	0x10,	0x10,	0x01,	0x08,	0x01,
-        0x80,	0x06,	0x01,	0x06,	0x01,	0x05,
-        0x84,	0x08,	0x01,	0x08,	0x01,	0x06,
-        0x04,	0x06,	0x01,	0x06,	0x01,	0x05,
-        0x00,	0x05,	0x01,	0x1E,	0x0F,	0x06,
-        0x00,	0x05,	0x01,	0x1E,	0x0F,	0x01,
-        0x01,	0x04,	0x05,	0x08,	0x08,	0x01,
-        0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
-        0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
-        0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
-    ]
-    
+    # kept for compatibility, the waveforms are defined in display/waveforms.py
+    lut_vcom1 = waveforms.LUT_VCOM
+    lut_ww1 = waveforms.LUT_WW
+    lut_bw1 = waveforms.LUT_BW
+    lut_wb1 = waveforms.LUT_WB
+    lut_bb1 = waveforms.LUT_BB
+
+    def set_waveform(self, name):
+        """Select the waveform of the next refresh, see display/waveforms.py"""
+        if name not in waveforms.WAVEFORMS:
+            raise ValueError('Unknown waveform {}'.format(name))
+        self.waveform = name
+
     def SetLut(self):
-        self.M1S1M2S2_SendCommand(0x20) #vcom
-        for count in range(0, 60):
-            self.M1S1M2S2_SendData(self.lut_vcom1[count])
-
-        self.M1S1M2S2_SendCommand(0x21) #red not use
-        for count in range(0, 60):
-            self.M1S1M2S2_SendData(self.lut_ww1[count])
-
-        self.M1S1M2S2_SendCommand(0x22) #bw r
-        for count in range(0, 60):
-            self.M1S1M2S2_SendData(self.lut_bw1[count])   # bw=r
-
-        self.M1S1M2S2_SendCommand(0x23) #wb w
-        for count in range(0, 60):
-            self.M1S1M2S2_SendData(self.lut_wb1[count])   # wb=w
-
-        self.M1S1M2S2_SendCommand(0x24) #bb b
-        for count in range(0, 60):
-            self.M1S1M2S2_SendData(self.lut_bb1[count])   # bb=b
-            
-        self.M1S1M2S2_SendCommand(0x25) #bb b
-        for count in range(0, 60):
-            self.M1S1M2S2_SendData(self.lut_ww1[count])   # bb=b
+        """Send the LUTs of the selected waveform, unless they are loaded already"""
+        if self.loadedWaveform == self.waveform:
+            return
+        for register, lut in waveforms.WAVEFORMS[self.waveform].items():
+            self.M1S1M2S2_SendCommand(register)
+            self.M1S1M2S2_SendDataBulk(lut)
+        self.loadedWaveform = self.waveform
+        logger.debug("LUT loaded: %s" % self.waveform)
@@ -26,7 +26,6 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 #
-import RPi.GPIO as GPIO
 import time
 import os
 import logging
@@ -34,6 +33,8 @@ import sys
 
 from ctypes import *
 
+import display.gpiobackend as gpiobackend
+
 EPD_SCK_PIN   =11
 EPD_MOSI_PIN  =10
 
@@ -53,6 +54,9 @@ EPD_S1_BUSY_PIN  =19
 EPD_M2_BUSY_PIN  =27
 EPD_S2_BUSY_PIN  =24
 
+DEFAULT_BACKEND = 'rpigpio'
+backend = None  # see set_backend
+
 find_dirs = [
     os.path.dirname(os.path.realpath(__file__)),
     '/usr/local/lib',
@@ -73,63 +77,57 @@ if spi is None:
     RuntimeError('Cannot find DEV_Config.so')
 
 
+def set_backend(name):
+    # Selects how the GPIO pins are driven, see display/gpiobackend.py. Takes effect on the next module_init.
+    global backend
+    if backend is not None:
+        backend.close()
+    backend = gpiobackend.make_backend(name)
+
 def digital_write(pin, value):
-    GPIO.output(pin, value)
+    backend.write(pin, value)
+
+def digital_write_lines(pins, values):
+    # sets several output pins at once, with a single call where the backend allows it
+    backend.write_lines(pins, values)
 
 def digital_read(pin):
-    return GPIO.input(pin)
+    return backend.read(pin)
 
 def spi_writebyte(value): 
     spi.DEV_SPI_WriteByte(value)
+
+def spi_writebytes(values):
+    # SPI is bit-banged by DEV_Config.so, so the bytes are clocked out one at a time, but the caller only has to
+    # select the controllers once for all of them
+    write = spi.DEV_SPI_WriteByte
+    for value in values:
+        write(value)
  
 def delay_ms(delaytime):
     time.sleep(delaytime / 1000.0)
         
 def module_init():
-    GPIO.setmode(GPIO.BCM)
-    GPIO.setwarnings(False)
-    GPIO.setup(EPD_SCK_PIN, GPIO.OUT)    
-    GPIO.setup(EPD_MOSI_PIN, GPIO.OUT)
-    
+    if backend is None:
+        set_backend(DEFAULT_BACKEND)
     logging.debug("python call bcm2835 Lib")
-    
-    GPIO.setup(EPD_M2S2_RST_PIN, GPIO.OUT)    
-    GPIO.setup(EPD_M1S1_RST_PIN, GPIO.OUT)
-    GPIO.setup(EPD_M2S2_DC_PIN, GPIO.OUT)
-    GPIO.setup(EPD_M1S1_DC_PIN, GPIO.OUT)
-    GPIO.setup(EPD_S1_CS_PIN, GPIO.OUT)
-    GPIO.setup(EPD_S2_CS_PIN, GPIO.OUT)
-    GPIO.setup(EPD_M1_CS_PIN, GPIO.OUT)
-    GPIO.setup(EPD_M2_CS_PIN, GPIO.OUT)
-
-    GPIO.setup(EPD_S1_BUSY_PIN, GPIO.IN)
-    GPIO.setup(EPD_S2_BUSY_PIN, GPIO.IN)
-    GPIO.setup(EPD_M1_BUSY_PIN, GPIO.IN)
-    GPIO.setup(EPD_M2_BUSY_PIN, GPIO.IN)
-    
-    digital_write(EPD_M1_CS_PIN, 1)
-    digital_write(EPD_S1_CS_PIN, 1)
-    digital_write(EPD_M2_CS_PIN, 1)
-    digital_write(EPD_S2_CS_PIN, 1)
-    
-    digital_write(EPD_M2S2_RST_PIN, 0)
-    digital_write(EPD_M1S1_RST_PIN, 0)
-    digital_write(EPD_M2S2_DC_PIN, 1)
-    digital_write(EPD_M1S1_DC_PIN, 1)
+
+    # chip selects high (no controller selected), reset low, data/command high
+    backend.setup({EPD_M2S2_RST_PIN: 0, EPD_M1S1_RST_PIN: 0, EPD_M2S2_DC_PIN: 1, EPD_M1S1_DC_PIN: 1,
+                   EPD_S1_CS_PIN: 1, EPD_S2_CS_PIN: 1, EPD_M1_CS_PIN: 1, EPD_M2_CS_PIN: 1},
+                  [EPD_S1_BUSY_PIN, EPD_S2_BUSY_PIN, EPD_M1_BUSY_PIN, EPD_M2_BUSY_PIN],
+                  spiPins=[EPD_SCK_PIN, EPD_MOSI_PIN])
 
     spi.DEV_ModuleInit()
 
 def module_exit():
-    digital_write(EPD_M2S2_RST_PIN, 0)
-    digital_write(EPD_M1S1_RST_PIN, 0)
-    digital_write(EPD_M2S2_DC_PIN, 0)
-    digital_write(EPD_M1S1_DC_PIN, 0)
-    digital_write(EPD_S1_CS_PIN, 1)
-    digital_write(EPD_S2_CS_PIN, 1)
-    digital_write(EPD_M1_CS_PIN, 1)
-    digital_write(EPD_M2_CS_PIN, 1)
+    digital_write_lines((EPD_M2S2_RST_PIN, EPD_M1S1_RST_PIN, EPD_M2S2_DC_PIN, EPD_M1S1_DC_PIN,
+                         EPD_S1_CS_PIN, EPD_S2_CS_PIN, EPD_M1_CS_PIN, EPD_M2_CS_PIN), (0, 0, 0, 0, 1, 1, 1, 1))
 
 def spi_readbyte(Reg):
+    if not isinstance(backend, gpiobackend.RPiGPIOBackend):
+        raise RuntimeError('spi_readbyte needs the rpigpio backend')
+    GPIO = backend.GPIO
     GPIO.setup(EPD_MOSI_PIN, GPIO.IN)
     j=0
     # time.sleep(0.01)
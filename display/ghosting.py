@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Decides when the display needs calibrating, i.e. flushing through black, white and red to clear the ghosts that
+updates leave behind, from how much each pixel has actually changed since the last calibration. A calibration is a
+few full refreshes in a row, the most expensive thing the panel does, so rather than calibrating on a fixed day of
+the week, it is only done once the ghosting risk crosses a threshold.
+
+After each update, the pixels that changed in either plane are found by comparing the frame with the one shown before
+(see render/framebuffer.py), and added up per pixel into a churn map, weighted by the waveform of the update: the
+faster waveforms leave more ghosting behind (see display/waveforms.py). The map is an 8 bit image of the panel that
+saturates at 255, kept in display/churn.png. The risk is the mean churn of the worst area of BLOCK x BLOCK pixels,
+since a few scattered pixels do not make a visible ghost but a line of text that changed over and over does.
+"""
+
+import pathlib
+import io
+import logging
+from PIL import Image, ImageChops
+
+from render.framebuffer import decode_planes, ROW_BYTES, ROWS
+from pipeline.files import write_atomic
+
+DEFAULT_CHURN_FILE = str(pathlib.Path(__file__).parent.absolute()) + '/churn.png'
+BLOCK = 16
+WAVEFORM_WEIGHTS = {'full': 1, 'skipred': 2, 'fast': 3}  # churn added for each pixel changed by an update
+
+
+def get_changed_pixels(frame, previousFrame):
+    # Returns a mask of the pixels that differ between the frames in either plane, as an 'L' image of 0 and 255
+    planes = decode_planes(frame)
+    previousPlanes = decode_planes(previousFrame)
+    changed = Image.new('1', (ROW_BYTES * 8, ROWS), 0)
+    for command, plane in planes.items():
+        if command in previousPlanes:
+            changed = ImageChops.logical_or(changed, ImageChops.logical_xor(plane, previousPlanes[command]))
+    return changed.convert('L')
+
+
+class GhostingTracker:
+
+    def __init__(self, threshold, churnFile=DEFAULT_CHURN_FILE):
+        self.logger = logging.getLogger('maginkcal')
+        self.threshold = threshold  # risk at which the display is calibrated, see get_risk
+        self.churnFile = churnFile
+        self.churn = self.load_churn()
+
+    def load_churn(self):
+        try:
+            with Image.open(self.churnFile) as image:
+                if image.mode == 'L' and image.size == (ROW_BYTES * 8, ROWS):
+                    return image.copy()
+        except (OSError, ValueError):
+            pass
+        return Image.new('L', (ROW_BYTES * 8, ROWS), 0)
+
+    def save_churn(self):
+        data = io.BytesIO()
+        self.churn.save(data, format='PNG')
+        write_atomic(self.churnFile, data.getvalue())
+
+    def get_risk(self):
+        # mean weighted number of changes per pixel, in the worst BLOCK x BLOCK area since the last calibration
+        return self.churn.reduce(BLOCK).getextrema()[1]
+
+    def is_calibration_due(self):
+        risk = self.get_risk()
+        if risk < self.threshold:
+            return False
+        self.logger.info('Ghosting risk {} reached the threshold of {}, calibrating.'.format(risk, self.threshold))
+        return True
+
+    def add_update(self, frame, previousFrame, waveform):
+        # Adds the pixels changed by an update to the churn map. Without the previous frame, what changed is unknown
+        # and nothing is added.
+        if previousFrame is None:
+            return
+        try:
+            changed = get_changed_pixels(frame, previousFrame)
+        except ValueError as e:
+            self.logger.info('Unable to compare with the previous frame: {}'.format(e))
+            return
+        weight = WAVEFORM_WEIGHTS.get(waveform, WAVEFORM_WEIGHTS['fast'])
+        self.churn = ImageChops.add(self.churn, changed.point(lambda value: weight if value else 0))
+        self.save_churn()
+        self.logger.info('Ghosting risk is now {} of {}.'.format(self.get_risk(), self.threshold))
+
+    def reset(self):
+        # the display was just calibrated, so the ghosts are gone
+        self.churn = Image.new('L', (ROW_BYTES * 8, ROWS), 0)
+        self.save_churn()
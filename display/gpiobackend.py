@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ways of driving the GPIO pins of the panel (chip selects, data/command, reset and busy), selected with "gpioBackend" in
+config.json:
+- rpigpio: RPi.GPIO, as in the Waveshare driver. Each pin is a separate call, and setting several pins at once only
+  loops over them.
+- gpiod: the Linux GPIO character device, through the libgpiod Python bindings (pip install gpiod, version 2 or
+  later). All the lines are requested together, so the chip selects and data/command lines of a transfer are set with
+  a single ioctl. Also works on boards other than the Pi, and on the gpio-sim kernel module, see bench/gpio.py.
+  "gpiod:/dev/gpiochip4" selects another chip than the default /dev/gpiochip0, e.g. the header of a Pi 5 on older
+  kernels.
+
+Either way, SCK and MOSI are clocked by DEV_Config.so, which sets them up itself.
+"""
+
+import logging
+
+DEFAULT_CHIP = '/dev/gpiochip0'
+CONSUMER = 'maginkcal'
+
+
+class RPiGPIOBackend:
+
+    def __init__(self):
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+
+    def setup(self, outputs, inputs, spiPins=()):
+        # outputs: pin -> initial value, inputs: pins. Pins are numbered as on the SoC (BCM).
+        self.GPIO.setmode(self.GPIO.BCM)
+        self.GPIO.setwarnings(False)
+        for pin in spiPins:
+            self.GPIO.setup(pin, self.GPIO.OUT)
+        for pin, value in outputs.items():
+            self.GPIO.setup(pin, self.GPIO.OUT, initial=value)
+        for pin in inputs:
+            self.GPIO.setup(pin, self.GPIO.IN)
+
+    def write(self, pin, value):
+        self.GPIO.output(pin, value)
+
+    def write_lines(self, pins, values):
+        self.GPIO.output(list(pins), list(values))
+
+    def read(self, pin):
+        return self.GPIO.input(pin)
+
+    def close(self):
+        pass
+
+
+class GpiodBackend:
+
+    def __init__(self, chipPath=DEFAULT_CHIP):
+        import gpiod
+        from gpiod.line import Direction, Value
+        self.gpiod = gpiod
+        self.Direction = Direction
+        self.values = (Value.INACTIVE, Value.ACTIVE)
+        self.chipPath = chipPath
+        self.request = None
+        self.lineValues = {}  # (pins, values) -> {line offset: Value}, as the same few combinations are set over and over
+
+    def setup(self, outputs, inputs, spiPins=()):
+        # Pins are the line offsets on the chip, which on the Pi are the BCM numbers. The lines are kept requested
+        # until close(), so setting up again (e.g. when the panel is woken up) only resets the outputs.
+        outputValues = {pin: self.values[value] for pin, value in outputs.items()}
+        if self.request is not None:
+            self.request.set_values(outputValues)
+            return
+        self.request = self.gpiod.request_lines(
+            self.chipPath, consumer=CONSUMER,
+            config={tuple(outputs): self.gpiod.LineSettings(direction=self.Direction.OUTPUT),
+                    tuple(inputs): self.gpiod.LineSettings(direction=self.Direction.INPUT)},
+            output_values=outputValues)
+        logging.getLogger('maginkcal').debug('Requested {} lines of {}'.format(len(outputs) + len(inputs),
+                                                                               self.chipPath))
+
+    def write(self, pin, value):
+        self.request.set_value(pin, self.values[value])
+
+    def write_lines(self, pins, values):
+        key = (pins, values)
+        lineValues = self.lineValues.get(key)
+        if lineValues is None:
+            lineValues = self.lineValues[key] = {pin: self.values[value] for pin, value in zip(pins, values)}
+        self.request.set_values(lineValues)
+
+    def read(self, pin):
+        return 1 if self.request.get_value(pin) == self.values[1] else 0
+
+    def close(self):
+        if self.request is not None:
+            self.request.release()
+            self.request = None
+
+
+def make_backend(name):
+    # name: 'rpigpio', 'gpiod' or 'gpiod:<chip path>'
+    kind, _, chipPath = name.partition(':')
+    if kind == 'rpigpio':
+        return RPiGPIOBackend()
+    if kind == 'gpiod':
+        return GpiodBackend(chipPath or DEFAULT_CHIP)
+    raise ValueError('Unknown GPIO backend {}'.format(name))
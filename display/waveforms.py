@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Refresh waveforms for the 12.48" tri-colour panel. A waveform is the set of look-up tables (LUTs) that the controllers
+follow to drive the particles during a refresh, one per register. Each LUT is made of 10 groups of 6 bytes: the voltage
+levels of the 4 phases of the group, the number of frames of each phase, and the number of times the group is
+repeated. A full tri-colour refresh spends most of its time in the long groups that pull the red particles up, so
+updates that do not need them can use a shorter waveform:
+- full: the waveform from Waveshare, for any update
+- skipred: the red plane has not changed since the last update, so the red particles are only driven once, to hold
+  them in place, instead of being pulled up again from scratch
+- fast: there is no red on the display, before or after the update, so the red groups are dropped altogether and the
+  black and white particles are shaken fewer times
+
+The fast waveforms leave more ghosting behind than the full one, which brings the next calibration forward (see
+display/ghosting.py), and the full waveform is used together with the calibration.
+
+Only the full waveform is known to work: its LUTs are those the Waveshare driver sent. skipred and fast are derived from
+it and have not been tried on a panel, which is why "waveform" defaults to "full" rather than "auto" in config.json.
+"""
+
+import logging
+
+GROUP_BYTES = 6  # level selection, frames of phases A to D, repeat count
+GROUPS = 10
+RED_GROUPS = (4, 5)  # the long groups (30 + 15 frames) that drive the red particles
+SHAKE_GROUPS = (1, 2, 3)  # shake the black and white particles loose before they are driven
+
+LUT_VCOM = [
+    0x00,	0x10,	0x10,	0x01,	0x08,	0x01,
+    0x00,	0x06,	0x01,	0x06,	0x01,	0x05,
+    0x00,	0x08,	0x01,	0x08,	0x01,	0x06,
+    0x00,	0x06,	0x01,	0x06,	0x01,	0x05,
+    0x00,	0x05,	0x01,	0x1E,	0x0F,	0x06,
+    0x00,	0x05,	0x01,	0x1E,	0x0F,	0x01,
+    0x00,	0x04,	0x05,	0x08,	0x08,	0x01,
+    0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
+    0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
+    0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
+]
+LUT_WW = [
+    0x91,	0x10,	0x10,	0x01,	0x08,	0x01,
+    0x04,	0x06,	0x01,	0x06,	0x01,	0x05,
+    0x84,	0x08,	0x01,	0x08,	0x01,	0x06,
+    0x80,	0x06,	0x01,	0x06,	0x01,	0x05,
+    0x00,	0x05,	0x01,	0x1E,	0x0F,	0x06,
+    0x00,	0x05,	0x01,	0x1E,	0x0F,	0x01,
+    0x08,	0x04,	0x05,	0x08,	0x08,	0x01,
+    0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
+    0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
+    0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
+]
+LUT_BW = [
+    0xA8,	0x10,	0x10,	0x01,	0x08,	0x01,
+    0x84,	0x06,	0x01,	0x06,	0x01,	0x05,
+    0x84,	0x08,	0x01,	0x08,	0x01,	0x06,
+    0x86,	0x06,	0x01,	0x06,	0x01,	0x05,
+    0x8C,	0x05,	0x01,	0x1E,	0x0F,	0x06,
+    0x8C,	0x05,	0x01,	0x1E,	0x0F,	0x01,
+    0xF0,	0x04,	0x05,	0x08,	0x08,	0x01,
+    0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
+    0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
+    0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
+]
+LUT_WB = [
+    0x91,	0x10,	0x10,	0x01,	0x08,	0x01,
+    0x04,	0x06,	0x01,	0x06,	0x01,	0x05,
+    0x84,	0x08,	0x01,	0x08,	0x01,	0x06,
+    0x80,	0x06,	0x01,	0x06,	0x01,	0x05,
+    0x00,	0x05,	0x01,	0x1E,	0x0F,	0x06,
+    0x00,	0x05,	0x01,	0x1E,	0x0F,	0x01,
+    0x08,	0x04,	0x05,	0x08,	0x08,	0x01,
+    0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
+    0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
+    0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
+]
+LUT_BB = [
+    0x92,	0x10,	0x10,	0x01,	0x08,	0x01,
+    0x80,	0x06,	0x01,	0x06,	0x01,	0x05,
+    0x84,	0x08,	0x01,	0x08,	0x01,	0x06,
+    0x04,	0x06,	0x01,	0x06,	0x01,	0x05,
+    0x00,	0x05,	0x01,	0x1E,	0x0F,	0x06,
+    0x00,	0x05,	0x01,	0x1E,	0x0F,	0x01,
+    0x01,	0x04,	0x05,	0x08,	0x08,	0x01,
+    0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
+    0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
+    0x00,	0x00,	0x00,	0x00,	0x00,	0x00,
+]
+
+
+def set_repeats(lut, repeats):
+    # repeats: group index -> number of times the group is run
+    lut = list(lut)
+    for group, count in repeats.items():
+        lut[group * GROUP_BYTES + GROUP_BYTES - 1] = count
+    return lut
+
+
+def drop_groups(lut, groups):
+    # the groups that follow move up, so that the LUT still ends with empty groups
+    kept = [lut[i * GROUP_BYTES:(i + 1) * GROUP_BYTES] for i in range(GROUPS) if i not in groups]
+    return [value for group in kept for value in group] + [0x00] * GROUP_BYTES * (GROUPS - len(kept))
+
+
+def make_waveform(transform):
+    # register -> LUT, in the order they are sent
+    return {0x20: bytes(transform(LUT_VCOM)),  # vcom
+            0x21: bytes(transform(LUT_WW)),  # red not use
+            0x22: bytes(transform(LUT_BW)),  # bw r
+            0x23: bytes(transform(LUT_WB)),  # wb w
+            0x24: bytes(transform(LUT_BB)),  # bb b
+            0x25: bytes(transform(LUT_WW))}
+
+
+WAVEFORMS = {
+    'full': make_waveform(lambda lut: lut),
+    'skipred': make_waveform(lambda lut: set_repeats(lut, {4: 1})),
+    'fast': make_waveform(lambda lut: drop_groups(set_repeats(lut, {group: 2 for group in SHAKE_GROUPS}),
+                                                  RED_GROUPS)),
+}
+
+
+def get_red_planes(frame):
+    from render.framebuffer import decode_frame, RED_COMMAND
+    return [data for name, command, data in decode_frame(frame) if command == RED_COMMAND]
+
+
+def choose_waveform(frame, previousFrame=None):
+    # Picks the fastest waveform that suits the change from the previous frame to this one (framebuffers, see
+    # render/framebuffer.py). Without a previous frame, what is on the display is unknown, so the full waveform is used.
+    if previousFrame is None:
+        return 'full'
+    try:
+        previousRed = get_red_planes(previousFrame)
+    except ValueError as e:
+        logging.getLogger('maginkcal').info('Unable to read the previous frame: {}'.format(e))
+        return 'full'
+    red = get_red_planes(frame)
+    # the red plane is inverted, so no red at all is a plane of zeros
+    if not any(any(data) for data in red) and not any(any(data) for data in previousRed):
+        return 'fast'
+    if red == previousRed:
+        return 'skipred'
+    return 'full'
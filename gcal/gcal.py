@@ -10,6 +10,8 @@ import datetime as dt
 import pickle
 import os.path
 import pathlib
+import uuid
+from contextlib import nullcontext
 from googleapiclient.discovery import build
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
@@ -18,11 +20,18 @@ import logging
 
 class GcalHelper:
 
-    def __init__(self):
+    def __init__(self, service=None):
         self.logger = logging.getLogger('maginkcal')
+        self.currPath = str(pathlib.Path(__file__).parent.absolute())
+        if service is not None:
+            # an already built (or stand-in) Calendar API service, e.g. for benchmarking without a Google account
+            self.service = service
+            self.cache = {}
+            self.metrics = None
+            return
+
         # Initialise the Google Calendar using the provided credentials and token
         SCOPES = ['https://www.googleapis.com/auth/calendar.readonly']
-        self.currPath = str(pathlib.Path(__file__).parent.absolute())
 
         creds = None
         # The file token.pickle stores the user's access and refresh tokens, and is
@@ -44,6 +53,8 @@ class GcalHelper:
                 pickle.dump(creds, token)
 
         self.service = build('calendar', 'v3', credentials=creds, cache_discovery=False)
+        self.cache = {}  # calendar id -> (timeMin, timeMax, API response), reused for calendars known to be unchanged
+        self.metrics = None  # optionally a MetricsHelper, to keep track of the latency of each calendar
 
     def list_calendars(self):
         # helps to retrieve ID for calendars within the account
@@ -58,6 +69,21 @@ class GcalHelper:
             cal_id = calendar['id']
             self.logger.info("%s\t%s" % (summary, cal_id))
 
+    def watch_calendar(self, calendarId, address, token, ttlSeconds):
+        # Registers a push notification channel for changes to the events of a calendar. Google will POST to the
+        # given address (which must be HTTPS and reachable from the internet) whenever the events change.
+        body = {'id': str(uuid.uuid4()), 'type': 'web_hook', 'address': address, 'token': token,
+                'params': {'ttl': str(int(ttlSeconds))}}
+        channel = self.service.events().watch(calendarId=calendarId, body=body).execute()
+        self.logger.info('Watching calendar {} until {}'.format(
+            calendarId, dt.datetime.fromtimestamp(int(channel['expiration']) / 1000)))
+        return {'id': channel['id'], 'resourceId': channel['resourceId'], 'calendarId': calendarId,
+                'expiration': int(channel['expiration']) / 1000}
+
+    def stop_channel(self, channel):
+        # Stops push notifications for a channel returned by watch_calendar
+        self.service.channels().stop(body={'id': channel['id'], 'resourceId': channel['resourceId']}).execute()
+
     def to_datetime(self, isoDatetime, localTZ):
         # replace Z with +00:00 is a workaround until datetime library decides what to do with the Z notation
         toDatetime = dt.datetime.fromisoformat(isoDatetime.replace('Z', '+00:00'))
@@ -82,8 +108,12 @@ class GcalHelper:
         # check if event stretches across multiple days
         return start.date() != end.date()
 
-    def retrieve_events(self, calendars, startDatetime, endDatetime, localTZ, thresholdHours):
+    def retrieve_events(self, calendars, startDatetime, endDatetime, localTZ, thresholdHours, dirtyCalendars=None,
+                        priority=None):
         # Call the Google Calendar API and return a list of events that fall within the specified dates
+        # If dirtyCalendars is given (e.g. from push notifications), only those calendars are fetched again and the
+        # previous response is reused for the others, as long as it covers the same dates
+        # Events found in several calendars are only returned once, see merge_calendars
         eventList = []
 
         minTimeStr = startDatetime.isoformat()
@@ -92,19 +122,75 @@ class GcalHelper:
             return eventList
 
         self.logger.info('Retrieving events between ' + minTimeStr + ' and ' + maxTimeStr + '...')
-        events_result = []
+        calendarEvents = {}
         for cal in calendars:
-            events_result.append(
-                self.service.events().list(calendarId=cal, timeMin=minTimeStr,
-                                           timeMax=maxTimeStr, singleEvents=True,
-                                           orderBy='startTime').execute()
-            )
-
+            cached = self.cache.get(cal)
+            if dirtyCalendars is not None and cal not in dirtyCalendars and cached is not None \
+                    and cached[:2] == (minTimeStr, maxTimeStr):
+                calendarEvents[cal] = cached[2].get('items', [])
+                continue
+            calendarEvents[cal] = self.fetch_calendar(cal, minTimeStr, maxTimeStr)
+
+        return self.normalize_events(self.merge_calendars(calendarEvents, priority), localTZ, thresholdHours)
+
+    def get_instance_key(self, event):
+        # Identifies an occurrence of an event across calendars: the same meeting has the same iCalUID in the calendar
+        # of every attendee, and each occurrence of a recurring one keeps its original start time even when moved
+        start = event.get('originalStartTime') or event['start']
+        if start.get('dateTime') is not None:
+            # the same time may be written with the offset of each calendar's time zone
+            when = dt.datetime.fromisoformat(start['dateTime'].replace('Z', '+00:00')).astimezone(dt.timezone.utc)
+        else:
+            when = start.get('date')
+        return event['iCalUID'], when
+
+    def merge_calendars(self, calendarEvents, priority=None):
+        # Combines the raw events of several calendars ({calendar id: events}), keeping a single copy of events that
+        # appear in more than one of them. The copy from the calendar that comes first in priority (or else in
+        # calendarEvents) is kept, e.g. that of the organiser's calendar.
+        rank = {cal: i for i, cal in enumerate(priority or [])}
+        ordered = sorted(calendarEvents, key=lambda cal: rank.get(cal, len(rank)))
+        index = set()
         events = []
-        for eve in events_result:
-            events += eve.get('items', [])
-            # events = events_result.get('items', [])
-
+        duplicates = 0
+        for cal in ordered:
+            for event in calendarEvents[cal]:
+                if 'iCalUID' not in event:
+                    events.append(event)
+                    continue
+                key = self.get_instance_key(event)
+                if key in index:
+                    duplicates += 1
+                    continue
+                index.add(key)
+                events.append(event)
+        if duplicates:
+            self.logger.info('Collapsed {} events that appear in more than one calendar.'.format(duplicates))
+        return events
+
+    def fetch_calendar(self, calendarId, minTimeStr, maxTimeStr):
+        # Returns the raw events of a single calendar, as returned by the API, that fall within the specified dates
+        with self.metrics.time('maginkcal_calendar_fetch_seconds', calendar=calendarId) \
+                if self.metrics is not None else nullcontext():
+            result = self.service.events().list(calendarId=calendarId, timeMin=minTimeStr,
+                                                timeMax=maxTimeStr, singleEvents=True,
+                                                orderBy='startTime').execute()
+        self.cache[calendarId] = (minTimeStr, maxTimeStr, result)
+        return result.get('items', [])
+
+    def is_changed_since(self, calendars, updatedMin):
+        # Checks if any event of the calendars was added, changed or deleted since the given time, which takes a single
+        # small request per calendar instead of fetching all of the events again
+        for cal in calendars:
+            result = self.service.events().list(calendarId=cal, updatedMin=updatedMin.isoformat(), showDeleted=True,
+                                                singleEvents=True, maxResults=1, fields='items(id)').execute()
+            if result.get('items'):
+                return True
+        return False
+
+    def normalize_events(self, events, localTZ, thresholdHours):
+        # Converts raw events from the API into the list of events that is rendered, sorted by start time
+        eventList = []
         if not events:
             self.logger.info('No upcoming events found.')
         for event in events:
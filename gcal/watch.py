@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Push notifications for calendar changes. A watch channel is registered with Google for each configured calendar, and
+renewed before it expires. Google then POSTs a notification to the webhook address whenever the events of a calendar
+change, and the small HTTP receiver in here marks that calendar as dirty, so that a refresh only runs (and only fetches
+the calendars that changed) after a real change.
+
+Google only delivers notifications to a public HTTPS address, so the receiver (which listens on plain HTTP) is meant to
+sit behind a reverse proxy or tunnel that forwards webhookAddress to webhookPort on the RPi.
+
+To try the receiver without Google, post a notification for one of the channels in gcal/channels.json:
+python3 -m gcal.watch http://127.0.0.1:8090/ <channel id> <token>
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import urllib.request
+import urllib.error
+import threading
+import pathlib
+import json
+import sys
+import time
+import logging
+
+from pipeline.files import write_atomic
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if length:
+            self.rfile.read(length)  # notifications carry no useful body, the details are in the headers
+        isAccepted = self.server.watchService.handle_notification(self.headers)
+        self.send_response(200 if isAccepted else 403)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        self.server.watchService.logger.debug('Webhook: ' + format % args)
+
+
+def post_notification(url, channelId, token, state='exists', messageNumber=1, timeout=5):
+    # Stand-in for Google, posts a change notification the same way the Calendar API does
+    request = urllib.request.Request(url, data=b'', method='POST', headers={
+        'X-Goog-Channel-ID': channelId, 'X-Goog-Channel-Token': token, 'X-Goog-Resource-State': state,
+        'X-Goog-Message-Number': str(messageNumber)})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+class WatchHelper:
+
+    def __init__(self, gcalService, calendars, address, token, host='127.0.0.1', port=8090, ttlHours=24 * 7,
+                 renewMarginMinutes=60, stateFile=None):
+        self.logger = logging.getLogger('maginkcal')
+        self.gcalService = gcalService
+        self.calendars = calendars
+        self.address = address  # public HTTPS address that Google will post notifications to
+        self.token = token  # echoed back by Google with every notification, to reject spoofed ones
+        self.host = host
+        self.port = port
+        self.ttl = ttlHours * 3600
+        self.renewMargin = renewMarginMinutes * 60
+        if stateFile is None:
+            stateFile = str(pathlib.Path(__file__).parent.absolute()) + '/channels.json'
+        self.stateFile = stateFile
+        self.channels = self.load_channels()  # calendar id -> channel
+        self.dirty = set()
+        self.lock = threading.Lock()
+        self.stopEvent = threading.Event()
+        self.onChange = None
+        self.server = None
+
+    def load_channels(self):
+        try:
+            with open(self.stateFile, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_channels(self):
+        write_atomic(self.stateFile, json.dumps(self.channels))
+
+    def renew(self):
+        # (Re)registers channels for calendars that have none, or whose channel is about to expire.
+        # Returns the number of seconds until the next renewal is due.
+        now = time.time()
+        for cal in self.calendars:
+            channel = self.channels.get(cal)
+            if channel is not None and channel['expiration'] - now > self.renewMargin:
+                continue
+            try:
+                newChannel = self.gcalService.watch_calendar(cal, self.address, self.token, self.ttl)
+            except Exception as e:
+                self.logger.error('Unable to watch calendar {}: {}'.format(cal, e))
+                continue
+            with self.lock:
+                self.channels[cal] = newChannel
+                # changes may have been missed while no channel was active
+                self.dirty.add(cal)
+            if channel is not None:
+                self.stop_channel(channel)
+        # drop channels of calendars that are no longer configured
+        for cal in [cal for cal in self.channels if cal not in self.calendars]:
+            self.stop_channel(self.channels.pop(cal))
+        self.save_channels()
+
+        expirations = [channel['expiration'] for channel in self.channels.values()]
+        if len(expirations) < len(self.calendars):
+            return 60  # some calendars could not be watched, try again soon
+        return max(60, min(expirations) - self.renewMargin - time.time())
+
+    def stop_channel(self, channel):
+        try:
+            self.gcalService.stop_channel(channel)
+        except Exception as e:
+            self.logger.info('Unable to stop channel for {}: {}'.format(channel['calendarId'], e))
+
+    def handle_notification(self, headers):
+        channelId = headers.get('X-Goog-Channel-ID')
+        if headers.get('X-Goog-Channel-Token') != self.token:
+            self.logger.info('Rejected notification with invalid token for channel {}'.format(channelId))
+            return False
+        with self.lock:
+            calendar = next((cal for cal, channel in self.channels.items() if channel['id'] == channelId), None)
+            if calendar is None:
+                # e.g. a channel that has since been renewed, it will expire by itself
+                return True
+            state = headers.get('X-Goog-Resource-State')
+            if state == 'sync':
+                return True  # sent once when a channel is created, not an actual change
+            self.dirty.add(calendar)
+        self.logger.info('Calendar {} changed ({})'.format(calendar, state))
+        if self.onChange is not None:
+            self.onChange()
+        return True
+
+    def pop_dirty(self):
+        # returns the calendars that changed since the last call
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+        return dirty
+
+    def mark_dirty(self, calendars):
+        with self.lock:
+            self.dirty.update(calendars)
+
+    def renew_loop(self):
+        while not self.stopEvent.is_set():
+            delay = self.renew()
+            self.stopEvent.wait(delay)
+
+    def start(self, onChange=None):
+        self.onChange = onChange
+        self.server = ThreadingHTTPServer((self.host, self.port), WebhookHandler)
+        self.server.daemon_threads = True
+        self.server.watchService = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.logger.info('Webhook receiver listening on {}:{}'.format(*self.server.server_address[:2]))
+        threading.Thread(target=self.renew_loop, daemon=True).start()
+
+    def stop(self):
+        self.stopEvent.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        for channel in self.channels.values():
+            self.stop_channel(channel)
+        self.channels = {}
+        self.save_channels()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print('Usage: python3 -m gcal.watch <receiver url> <channel id> <token> [state]')
+        sys.exit(1)
+    print(post_notification(sys.argv[1], sys.argv[2], sys.argv[3], *sys.argv[4:5]))
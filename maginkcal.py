@@ -7,106 +7,765 @@ I posted on GitHub so please go easy on me. There are still many parts of the co
 conversions) that are not tested comprehensively, since my calendar/events are largely based on the timezone I'm in.
 There will also be work needed to adjust the calendar rendering for different screen sizes, such as modifying of the
 CSS stylesheets in the "render" folder.
+
+By default, the script refreshes the calendar once and exits (shutting down the RPi if so configured). For displays that
+are powered from the mains, "--daemon" keeps the script running and refreshes the calendar on a schedule instead.
 """
 import datetime as dt
-import sys
+import argparse
+import pathlib
 
 from pytz import timezone
 from gcal.gcal import GcalHelper
+from gcal.watch import WatchHelper
 from render.render import RenderHelper
 from power.power import PowerHelper
+from power.scheduler import WakeScheduler
+from power.energy import EnergyLogger
+from pipeline.pipeline import PipelineHelper, StageTimeoutError
+from pipeline.tracing import Tracer, Profiler
+from pipeline.daemon import DaemonHelper, send_command
+from pipeline.farm import FarmHelper
+from pipeline.logs import LogHelper
+from pipeline.metrics import MetricsHelper
+from pipeline.files import write_atomic
+from render.framebuffer import encode_frame
+from display.waveforms import choose_waveform
+from render.server import FrameServer
+from contextlib import nullcontext
 import json
+import pickle
+import time
+import os
 import logging
 
+CURR_PATH = str(pathlib.Path(__file__).parent.absolute())
+SNAPSHOT_VERSION = 1  # bumped when the layout of the saved events changes, older snapshots are then ignored
 
-def main():
-    # Basic configuration settings (user replaceable)
-    configFile = open('config.json')
-    config = json.load(configFile)
-
-    displayTZ = timezone(config['displayTZ']) # list of timezones - print(pytz.all_timezones)
-    thresholdHours = config['thresholdHours']  # considers events updated within last 12 hours as recently updated
-    maxEventsPerDay = config['maxEventsPerDay']  # limits number of events to display (remainder displayed as '+X more')
-    isDisplayToScreen = config['isDisplayToScreen']  # set to true when debugging rendering without displaying to screen
-    isShutdownOnComplete = config['isShutdownOnComplete']  # set to true to conserve power, false if in debugging mode
-    batteryDisplayMode = config['batteryDisplayMode']  # 0: do not show / 1: always show / 2: show when battery is low
-    weekStartDay = config['weekStartDay']  # Monday = 0, Sunday = 6
-    dayOfWeekText = config['dayOfWeekText'] # Monday as first item in list
-    screenWidth = config['screenWidth']  # Width of E-Ink display. Default is landscape. Need to rotate image to fit.
-    screenHeight = config['screenHeight']  # Height of E-Ink display. Default is landscape. Need to rotate image to fit.
-    imageWidth = config['imageWidth']  # Width of image to be generated for display.
-    imageHeight = config['imageHeight'] # Height of image to be generated for display.
-    rotateAngle = config['rotateAngle']  # If image is rendered in portrait orientation, angle to rotate to fit screen
-    calendars = config['calendars']  # Google calendar ids
-    is24hour = config['is24h']  # set 24 hour time
-
-    # Create and configure logger
-    logging.basicConfig(filename="logfile.log", format='%(asctime)s %(levelname)s - %(message)s', filemode='a')
-    logger = logging.getLogger('maginkcal')
-    logger.addHandler(logging.StreamHandler(sys.stdout))  # print logger to stdout
-    logger.setLevel(logging.INFO)
-    logger.info("Starting daily calendar update")
 
-    try:
+class CalendarSettings:
+    # The settings of a display from its config file, along with the dates and contents they make it show. Used on
+    # their own where no refresh is run on this RPi, e.g. for the panels rendered with --farm.
+
+    def __init__(self, config):
+        self.logger = logging.getLogger('maginkcal')
+        self.displayTZ = timezone(config['displayTZ']) # list of timezones - print(pytz.all_timezones)
+        self.thresholdHours = config['thresholdHours']  # considers events updated within last 12 hours as recently updated
+        self.maxEventsPerDay = config['maxEventsPerDay']  # limits number of events to display (remainder displayed as '+X more')
+        self.isDisplayToScreen = config['isDisplayToScreen']  # set to true when debugging rendering without displaying to screen
+        self.isShutdownOnComplete = config['isShutdownOnComplete']  # set to true to conserve power, false if in debugging mode
+        self.batteryDisplayMode = config['batteryDisplayMode']  # 0: do not show / 1: always show / 2: show when battery is low
+        self.weekStartDay = config['weekStartDay']  # Monday = 0, Sunday = 6
+        self.dayOfWeekText = config['dayOfWeekText'] # Monday as first item in list
+        self.screenWidth = config['screenWidth']  # Width of E-Ink display. Default is landscape. Need to rotate image to fit.
+        self.screenHeight = config['screenHeight']  # Height of E-Ink display. Default is landscape. Need to rotate image to fit.
+        self.imageWidth = config['imageWidth']  # Width of image to be generated for display.
+        self.imageHeight = config['imageHeight'] # Height of image to be generated for display.
+        self.rotateAngle = config['rotateAngle']  # If image is rendered in portrait orientation, angle to rotate to fit screen
+        self.calendars = config['calendars']  # Google calendar ids
+        # calendars whose copy of an event shared with other calendars is shown, by default in the order of calendars
+        self.calendarPriority = config.get('calendarPriority', [])
+        self.is24hour = config['is24h']  # set 24 hour time
+        self.isAdaptiveWake = config.get('isAdaptiveWake', False)  # schedule next wake via PiSugar based on calendar content
+        self.wakeTime = config.get('wakeTime', '06:00')  # preferred time of day to refresh after the date changes
+        self.maxWakeIntervalHours = config.get('maxWakeIntervalHours', 24)  # upper bound between wakes, to catch remote changes
+        self.minWakeIntervalMinutes = config.get('minWakeIntervalMinutes', 30)  # lower bound between wakes
+        self.lowBatteryLevel = config.get('lowBatteryLevel', 20)  # below this level, only wake for the day rollover
+        self.isEnergyLogging = config.get('isEnergyLogging', False)  # record time and battery drain of each stage to disk
+        self.isTracing = config.get('isTracing', False)  # write nested timing spans of each run to trace.jsonl
+        self.refreshIntervalMinutes = config.get('refreshIntervalMinutes', 60)  # daemon mode: time between refreshes
+        self.controlSocket = config.get('controlSocket', '/tmp/maginkcal.sock')  # daemon mode: socket to force a refresh
+        self.webhookAddress = config.get('webhookAddress', '')  # daemon mode: public HTTPS address for push notifications
+        self.webhookToken = config.get('webhookToken', '')  # daemon mode: secret echoed back with each notification
+        self.webhookHost = config.get('webhookHost', '127.0.0.1')  # daemon mode: local address of the webhook receiver
+        self.webhookPort = config.get('webhookPort', 8090)  # daemon mode: local port of the webhook receiver
+        self.watchTtlHours = config.get('watchTtlHours', 24 * 7)  # daemon mode: requested lifetime of watch channels
+        self.isRenderServer = config.get('isRenderServer', False)  # publish each frame for thin display clients
+        self.renderServerHost = config.get('renderServerHost', '0.0.0.0')  # daemon mode: address of the frame server
+        self.renderServerPort = config.get('renderServerPort', 8091)  # daemon mode: port of the frame server
+        self.isSaveRenderFiles = config.get('isSaveRenderFiles', False)  # keep render/calendar.html and .png, for debugging
+        # 'browser' (HTML template through Selenium), 'devtools' (HTML template without chromedriver) or 'pil' (no browser)
+        self.renderBackend = config.get('renderBackend', 'browser')
+        self.isInlineCss = config.get('isInlineCss', False)  # render from the template with a purged, inlined stylesheet
+        self.isDomPatching = config.get('isDomPatching', False)  # daemon mode: patch only what changed into the open page
+        self.calibrationThreshold = config.get('calibrationThreshold', 12)  # ghosting risk at which to calibrate, see display/ghosting.py
+        self.calibrationCycles = config.get('calibrationCycles', 0)  # flushes per calibration, 0: a full refresh only
+        self.waveform = config.get('waveform', 'full')  # refresh waveform, or 'auto' to pick one from what has changed
+        self.runBudgetSeconds = config.get('runBudgetSeconds', 0)  # give up on stages still running after this, 0: no limit
+        self.stageDeadlines = config.get('stageDeadlines', {})  # stage name -> seconds into the run by which it has to finish
+        self.snapshotFile = CURR_PATH + '/gcal/snapshot.pickle'  # events of the last successful fetch
+        self.lastFrameFile = CURR_PATH + '/render/last_frame.bin'  # framebuffer last shown on the display
+        self.stageFrameFile = CURR_PATH + '/render/stage_frame.bin'  # framebuffer of --stage render, for --stage display
+        self.gpioBackend = config.get('gpioBackend', 'rpigpio')  # 'rpigpio', or 'gpiod' for the GPIO character device
+        self.metricsFile = config.get('metricsFile', '')  # Prometheus textfile for node_exporter, '': no metrics
+        self.isPrecompute = config.get('isPrecompute', False)  # render the next morning's frame ahead of time
+        self.nextFrameFile = CURR_PATH + '/render/next_frame.bin'  # framebuffer precomputed for the next wake
+        self.nextFrameInfoFile = CURR_PATH + '/render/next_frame.json'  # what the precomputed framebuffer was made from
+
+    def get_clock(self, currDatetime):
+        # dates shown on the calendar as of the given datetime
+        currDate = currDatetime.date()
+        calStartDate = currDate - dt.timedelta(days=((currDate.weekday() + (7 - self.weekStartDay)) % 7))
+        calEndDate = calStartDate + dt.timedelta(days=(5 * 7 - 1))
+        calStartDatetime = self.displayTZ.localize(dt.datetime.combine(calStartDate, dt.datetime.min.time()))
+        calEndDatetime = self.displayTZ.localize(dt.datetime.combine(calEndDate, dt.datetime.max.time()))
+        return {'currDatetime': currDatetime, 'currDate': currDate, 'calStartDate': calStartDate,
+                'calStartDatetime': calStartDatetime, 'calEndDatetime': calEndDatetime}
+
+    def get_cal_dict(self, clock, eventList, batteryLevel):
+        # Populate dictionary with information to be rendered on e-ink display
+        return {'events': eventList, 'calStartDate': clock['calStartDate'], 'today': clock['currDate'],
+                'lastRefresh': clock['currDatetime'], 'batteryLevel': batteryLevel,
+                'batteryDisplayMode': self.batteryDisplayMode, 'dayOfWeekText': self.dayOfWeekText,
+                'weekStartDay': self.weekStartDay, 'maxEventsPerDay': self.maxEventsPerDay,
+                'is24hour': self.is24hour}
+
+
+class CalendarApp(CalendarSettings):
+
+    def __init__(self, config, isProfile=False, isDaemon=False):
+        super().__init__(config)
+        self.isTracing = self.isTracing or isProfile  # the profile includes the trace
+        self.isProfile = isProfile
+        self.isDaemon = isDaemon
+
+        self.tracer = Tracer() if self.isTracing else None
+        self.powerService = PowerHelper()
+        self.renderService = RenderHelper(self.imageWidth, self.imageHeight, self.rotateAngle)
+        # in daemon mode, the browser is kept open between refreshes
+        self.renderService.isPersistentBrowser = isDaemon
+        self.renderService.isSaveFiles = self.isSaveRenderFiles
+        self.renderService.backend = self.renderBackend
+        self.renderService.isInlineCss = self.isInlineCss
+        self.renderService.isDomPatching = self.isDomPatching
+        if self.tracer is not None:
+            self.tracer.instrument(self.powerService, ['get_battery', 'get_status', 'sync_time',
+                                                       'set_next_boot_datetime'])
+            self.tracer.instrument(self.renderService, ['start_browser', 'process_inputs', 'generate_html',
+                                                        'get_screenshot', 'split_colours'])
+        self.energy = EnergyLogger(self.powerService) if self.isEnergyLogging else None
+        self.metrics = MetricsHelper(self.metricsFile, recorder=self.energy) if self.metricsFile else None
+        # the metrics pass the stages on to the energy logger, if both are enabled
+        self.recorder = self.metrics or self.energy
+        self.renderService.recorder = self.recorder
+        self.scheduler = None
+        if self.isAdaptiveWake:
+            self.scheduler = WakeScheduler(self.displayTZ, self.thresholdHours, self.wakeTime,
+                                           self.maxWakeIntervalHours, self.minWakeIntervalMinutes,
+                                           self.lowBatteryLevel)
+        # services that are kept alive across refreshes in daemon mode
+        self.gcalService = None
+        self.displayService = None
+        self.ghostingService = None  # created along with the panel
+        self.watchService = None  # set in daemon mode when push notifications are enabled
+        self.frameServer = FrameServer(self.renderServerHost, self.renderServerPort) if self.isRenderServer else None
+        self.results = {}
+        self.eventsCheckedAt = None  # time (UTC) as of which the events in hand are known to be current
+
+    def stage(self, name):
+        # records a stage that is not part of rendering or the display with the energy logger and metrics, if enabled
+        if self.recorder is None:
+            return nullcontext()
+        return self.recorder.stage(name)
+
+    def sync_clock(self, results):
         # Establish current date and time information
         # Note: For Python datetime.weekday() - Monday = 0, Sunday = 6
         # For this implementation, each week starts on a Sunday and the calendar begins on the nearest elapsed Sunday
         # The calendar will also display 5 weeks of events to cover the upcoming month, ending on a Saturday
-        powerService = PowerHelper()
-        powerService.sync_time()
-        currBatteryLevel = powerService.get_battery()
-        logger.info('Battery level at start: {:.3f}'.format(currBatteryLevel))
+        with self.stage('sync'):
+            self.powerService.sync_time()
+        currDatetime = dt.datetime.now(self.displayTZ)
+        self.logger.info("Time synchronised to {}".format(currDatetime))
+        return self.get_clock(currDatetime)
 
-        currDatetime = dt.datetime.now(displayTZ)
-        logger.info("Time synchronised to {}".format(currDatetime))
-        currDate = currDatetime.date()
-        calStartDate = currDate - dt.timedelta(days=((currDate.weekday() + (7 - weekStartDay)) % 7))
-        calEndDate = calStartDate + dt.timedelta(days=(5 * 7 - 1))
-        calStartDatetime = displayTZ.localize(dt.datetime.combine(calStartDate, dt.datetime.min.time()))
-        calEndDatetime = displayTZ.localize(dt.datetime.combine(calEndDate, dt.datetime.max.time()))
+    def read_battery(self, results):
+        currBatteryLevel = self.powerService.get_battery()
+        self.logger.info('Battery level at start: {:.3f}'.format(currBatteryLevel))
+        if self.energy is not None:
+            self.energy.set_battery(batteryStart=currBatteryLevel)
+        return currBatteryLevel
 
+    def init_gcal(self, results):
+        if self.gcalService is None:
+            with self.stage('auth'):
+                self.gcalService = GcalHelper()
+            self.gcalService.metrics = self.metrics
+            if self.tracer is not None:
+                self.tracer.instrument(self.gcalService, ['retrieve_events', 'is_changed_since'])
+        return self.gcalService
+
+    def fetch_events(self, results):
         # Using Google Calendar to retrieve all events within start and end date (inclusive)
+        if results['check'] is not None:
+            return results['check']['events']  # unchanged since the last fetch
+        clock = results['clock']
         start = dt.datetime.now()
-        gcalService = GcalHelper()
-        eventList = gcalService.retrieve_events(calendars, calStartDatetime, calEndDatetime, displayTZ, thresholdHours)
-        logger.info("Calendar events retrieved in " + str(dt.datetime.now() - start))
+        checkedAt = dt.datetime.now(dt.timezone.utc)
+        # with push notifications, only calendars that reported a change are fetched again
+        dirtyCalendars = self.watchService.pop_dirty() if self.watchService is not None else None
+        try:
+            with self.stage('fetch'):
+                eventList = results['auth'].retrieve_events(self.calendars, clock['calStartDatetime'],
+                                                            clock['calEndDatetime'], self.displayTZ,
+                                                            self.thresholdHours, dirtyCalendars,
+                                                            self.calendarPriority)
+        except Exception:
+            if dirtyCalendars:
+                self.watchService.mark_dirty(dirtyCalendars)
+            raise
+        self.logger.info("Calendar events retrieved in " + str(dt.datetime.now() - start))
+        self.eventsCheckedAt = checkedAt
+        self.save_snapshot(clock, eventList)
+        return eventList
 
-        # Populate dictionary with information to be rendered on e-ink display
-        calDict = {'events': eventList, 'calStartDate': calStartDate, 'today': currDate, 'lastRefresh': currDatetime,
-                   'batteryLevel': currBatteryLevel, 'batteryDisplayMode': batteryDisplayMode,
-                   'dayOfWeekText': dayOfWeekText, 'weekStartDay': weekStartDay, 'maxEventsPerDay': maxEventsPerDay,
-                   'is24hour': is24hour}
-
-        renderService = RenderHelper(imageWidth, imageHeight, rotateAngle)
-        calBlackImage, calRedImage = renderService.process_inputs(calDict)
-
-        if isDisplayToScreen:
-            from display.display import DisplayHelper
-            displayService = DisplayHelper(screenWidth, screenHeight)
-            if currDate.weekday() == weekStartDay:
-                # calibrate display once a week to prevent ghosting
-                displayService.calibrate(cycles=0)  # to calibrate in production
-            displayService.update(calBlackImage, calRedImage)
+    def save_snapshot(self, clock, eventList):
+        # the dates are kept with the events, so that they can be rendered again exactly as they were fetched
+        snapshot = {'version': SNAPSHOT_VERSION, 'clock': clock, 'events': eventList}
+        self.save_file(self.snapshotFile, pickle.dumps(snapshot))
+
+    def load_snapshot(self):
+        data = self.load_file(self.snapshotFile)
+        if data is None:
+            return None
+        try:
+            snapshot = pickle.loads(data)
+        except Exception as e:
+            self.logger.info('Unable to read the saved events: {}'.format(e))
+            return None
+        if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION:
+            self.logger.info('Ignoring saved events from another version.')
+            return None
+        return snapshot
+
+    def start_browser(self, results):
+        if results['check'] is not None:
+            return  # nothing to render
+        if self.renderService.driver is None and self.renderBackend != 'pil':
+            self.renderService.start_browser()
+
+    def render_calendar(self, results):
+        calDict = self.get_cal_dict(results['clock'], results['fetch'], results['battery'])
+        signature = self.renderService.get_signature(calDict)
+        if self.scheduler is not None and not self.scheduler.is_content_changed(signature):
+            self.logger.info("Display content unchanged since last refresh, skipping render.")
+            return None
+        if results['check'] is not None:
+            return {'images': None, 'frame': results['check']['frame'], 'signature': signature}
+        return {'images': self.renderService.process_inputs(calDict), 'signature': signature}
+
+    def get_events_as_of(self, eventList, asOf):
+        # the events as they would be shown at the given time, when some may no longer count as recently updated
+        threshold = dt.timedelta(hours=self.thresholdHours)
+        return [dict(event, isUpdated=asOf - event['updatedDatetime'] < threshold) for event in eventList]
+
+    def get_next_day_wake(self, currDatetime):
+        hour, minute = self.wakeTime.split(':')
+        nextDate = currDatetime.date() + dt.timedelta(days=1)
+        return self.displayTZ.localize(dt.datetime.combine(nextDate, dt.time(int(hour), int(minute))))
+
+    def check_precomputed(self, results):
+        # Returns the frame precomputed during the previous wake (see precompute_frame) if it is still what would be
+        # rendered now, in which case there is nothing to fetch or render, else None
+        if not self.isPrecompute:
+            return None
+        frame = self.load_file(self.nextFrameFile)
+        info = self.load_file(self.nextFrameInfoFile)
+        snapshot = self.load_snapshot()
+        if frame is None or info is None or snapshot is None:
+            return None
+        info = json.loads(info)
+        clock = results['clock']
+        # the date, battery icon and recently updated events have to be as they were foreseen
+        calDict = self.get_cal_dict(clock, self.get_events_as_of(snapshot['events'], clock['currDatetime']),
+                                    results['battery'])
+        if self.renderService.get_signature(calDict) != info['signature']:
+            self.logger.info('Precomputed frame is out of date.')
+            return None
+        checkedAt = dt.datetime.now(dt.timezone.utc)
+        with self.stage('fetch'):
+            isChanged = results['auth'].is_changed_since(self.calendars, dt.datetime.fromisoformat(info['checkedAt']))
+        if isChanged:
+            self.logger.info('Events changed since the frame was precomputed.')
+            return None
+        self.eventsCheckedAt = checkedAt
+        self.logger.info('Using the precomputed frame.')
+        return {'frame': frame, 'events': calDict['events']}
+
+    def precompute_frame(self, results):
+        # Renders the frame for the next morning ahead of time, from the events in hand, while the display is being
+        # updated. The next wake then only has to check that nothing has changed in the meantime and upload it.
+        if not self.isPrecompute or self.eventsCheckedAt is None:
+            return None
+        if results['render'] is None:
+            return None  # nothing changed since the last refresh, which precomputed the frame already
+        clock = results['clock']
+        nextClock = self.get_clock(self.get_next_day_wake(clock['currDatetime']))
+        if nextClock['calStartDate'] != clock['calStartDate']:
+            # the events in hand do not cover the week the calendar moves on to
+            self.logger.info('Next frame not precomputed, the calendar moves on by a week.')
+            return None
+        calDict = self.get_cal_dict(nextClock, self.get_events_as_of(results['fetch'], nextClock['currDatetime']),
+                                    results['battery'])
+        info = {'signature': self.renderService.get_signature(calDict), 'checkedAt': self.eventsCheckedAt.isoformat(),
+                'wake': nextClock['currDatetime'].isoformat()}
+        previousInfo = self.load_file(self.nextFrameInfoFile)
+        previousInfo = json.loads(previousInfo) if previousInfo is not None else {}
+        if ((previousInfo.get('signature'), previousInfo.get('wake')) == (info['signature'], info['wake'])
+                and os.path.exists(self.nextFrameFile)):
+            # the frame in hand is still the one foreseen, and the events are known to be current as of now
+            self.save_file(self.nextFrameInfoFile, json.dumps(info).encode('utf-8'))
+            self.logger.info('Frame for {} precomputed already.'.format(nextClock['currDatetime']))
+            return None
+        calBlackImage, calRedImage = self.renderService.process_inputs(calDict)
+        frame = encode_frame(calBlackImage, calRedImage)
+        self.save_file(self.nextFrameFile, frame)
+        self.save_file(self.nextFrameInfoFile, json.dumps(info).encode('utf-8'))
+        self.logger.info('Frame for {} precomputed.'.format(nextClock['currDatetime']))
+        return frame
+
+    def init_panel(self, results):
+        if not self.isDisplayToScreen:
+            return None
+        if self.displayService is not None:
+            # panel was put to deep sleep at the end of the previous refresh
+            self.displayService.wake()
+            return self.displayService
+        from display.display import DisplayHelper
+        from display.ghosting import GhostingTracker
+        self.ghostingService = GhostingTracker(self.calibrationThreshold)
+        self.displayService = DisplayHelper(self.screenWidth, self.screenHeight, recorder=self.recorder,
+                                            gpioBackend=self.gpioBackend)
+        if self.tracer is not None:
+            self.tracer.instrument(self.displayService, ['update', 'calibrate', 'sleep', 'wake'])
+            self.tracer.instrument(self.displayService.epd, ['getbuffer', 'send_buffers', 'SetLut', 'TurnOnDisplay'])
+        return self.displayService
+
+    def update_display(self, results):
+        displayService = results['panel']
+        if displayService is None:
+            return
+        if results['render'] is None:
             displayService.sleep()
+            return
+        calBlackImage, calRedImage = results['render']['images'] or (None, None)
+        frame = results['render'].get('frame') or encode_frame(calBlackImage, calRedImage)
+        waveform = self.waveform
+        previousFrame = self.load_file(self.lastFrameFile)
+        if self.ghostingService.is_calibration_due():
+            # calibrate the display once enough has changed on it to leave ghosts behind
+            displayService.calibrate(cycles=self.calibrationCycles)
+            self.ghostingService.reset()
+            # the display was flushed to white, so the whole frame is drawn afresh
+            previousFrame = None
+            waveform = 'full'
+        elif waveform == 'auto':
+            waveform = choose_waveform(frame, previousFrame)
+        if calBlackImage is None:
+            displayService.show_frame(frame, waveform)  # precomputed
+        else:
+            displayService.update(calBlackImage, calRedImage, waveform)
+        displayService.sleep()
+        if self.scheduler is not None:
+            self.scheduler.record_refresh(results['render']['signature'])
+        self.save_file(self.lastFrameFile, frame)
+        self.ghostingService.add_update(frame, previousFrame, waveform)
+
+    def save_file(self, path, data):
+        write_atomic(path, data)
+
+    def load_file(self, path):
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def fallback(self, pipeline, runStart):
+        # A stage failed or overran its deadline before the display was updated. Rather than leaving yesterday's
+        # calendar on the display, show what we can if there is time left in the budget. Like the display stage, the
+        # fallback is not given up on once it has started driving the panel.
+        displayService = pipeline.results.get('panel')
+        if displayService is None or 'display' in pipeline.results or 'display' in pipeline.starts:
+            return  # no panel, the display was updated already, or it is the update itself that failed
+        if self.runBudgetSeconds and time.monotonic() - runStart >= self.runBudgetSeconds:
+            self.logger.info('No time left in the budget for a fallback.')
+            return
+        fallbackPipeline = PipelineHelper(tracer=self.tracer)
+        fallbackPipeline.add_stage('fallback', lambda results: self.show_fallback(pipeline.results, displayService))
+        try:
+            fallbackPipeline.run()
+        except Exception as e:
+            self.logger.error('Fallback failed: {}'.format(e))
+
+    def show_fallback(self, results, displayService):
+        # Draws the last good events (without a browser) with the current date and battery level, or else shows the
+        # last frame as it was
+        clock = results.get('clock') or self.get_clock(dt.datetime.now(self.displayTZ))
+        eventList = results.get('fetch')
+        if eventList is None:
+            snapshot = self.load_snapshot()
+            eventList = snapshot['events'] if snapshot is not None else None
+        if eventList is not None:
+            self.logger.info('Falling back to drawing the {} events.'.format(
+                'fresh' if 'fetch' in results else 'saved'))
+            calDict = self.get_cal_dict(clock, eventList, results.get('battery', -1))
+            calBlackImage, calRedImage = self.renderService.draw_calendar(calDict)
+            displayService.update(calBlackImage, calRedImage)
+            frame = encode_frame(calBlackImage, calRedImage)
+            self.ghostingService.add_update(frame, self.load_file(self.lastFrameFile), 'full')
+            self.save_file(self.lastFrameFile, frame)
+        else:
+            frame = self.load_file(self.lastFrameFile)
+            if frame is None:
+                self.logger.info('Nothing to fall back to.')
+                displayService.sleep()
+                return
+            self.logger.info('Falling back to the last frame shown.')
+            displayService.show_frame(frame)
+        displayService.sleep()
+
+    def publish_frame(self, results):
+        # Encodes the planes for thin display clients, which are served by the frame server in daemon mode
+        if self.frameServer is None or results['render'] is None:
+            return None
+        frame = results['render'].get('frame') or encode_frame(*results['render']['images'])
+        self.frameServer.publish(frame)
+        return frame
+
+    def read_battery_end(self, results):
+        currBatteryLevel = self.powerService.get_battery()
+        self.logger.info('Battery level at end: {:.3f}'.format(currBatteryLevel))
+        if self.energy is not None:
+            self.energy.set_battery(batteryEnd=currBatteryLevel)
+        return currBatteryLevel
 
-        currBatteryLevel = powerService.get_battery()
-        logger.info('Battery level at end: {:.3f}'.format(currBatteryLevel))
+    def build_pipeline(self):
+        # The refresh is broken down into stages that form a dependency graph. Stages without a path between them are
+        # run concurrently, e.g. the browser and the eInk panel are warmed up while the calendar events are fetched.
+        #
+        #   clock ----+----------+
+        #   auth -----+-> check -+-> fetch --+
+        #   battery --+          +-----------+-> render --+-> publish
+        #                        +-> browser-+            +-> display -> batteryEnd
+        #   panel ----------------------------------------+
+        #                                                 +-> precompute
+        #
+        # With a precomputed frame that is still current, the check stage hands it over and fetch and render do next
+        # to nothing. The frame for the next morning is then precomputed while the display is being updated.
+        #
+        # cProfile only sees the thread it is started on, so stages are run one after another when profiling
+        # Updating the panel is never given up on for the budget: the script would go on to shut the RPi down while
+        # the panel is still being driven, without putting it to sleep
+        pipeline = PipelineHelper(tracer=self.tracer, isSequential=self.isProfile, deadlines=self.stageDeadlines,
+                                  budget=self.runBudgetSeconds or None, unbudgeted=('display', 'batteryEnd'))
+        pipeline.add_stage('clock', self.sync_clock)
+        pipeline.add_stage('battery', self.read_battery)
+        pipeline.add_stage('auth', self.init_gcal)
+        pipeline.add_stage('check', self.check_precomputed, deps=['clock', 'battery', 'auth'])
+        pipeline.add_stage('fetch', self.fetch_events, deps=['clock', 'auth', 'check'])
+        pipeline.add_stage('browser', self.start_browser, deps=['check'])
+        pipeline.add_stage('render', self.render_calendar, deps=['clock', 'battery', 'fetch', 'browser', 'check'])
+        pipeline.add_stage('panel', self.init_panel)
+        pipeline.add_stage('display', self.update_display, deps=['clock', 'render', 'panel'])
+        pipeline.add_stage('publish', self.publish_frame, deps=['render'])
+        pipeline.add_stage('precompute', self.precompute_frame, deps=['clock', 'battery', 'fetch', 'render'])
+        pipeline.add_stage('batteryEnd', self.read_battery_end, deps=['display'])
+        return pipeline
 
-    except Exception as e:
-        logger.error(e)
+    def refresh(self):
+        # Runs one full refresh of the calendar, returns the results of each stage that completed
+        if self.energy is not None:
+            self.energy.new_run()
+        pipeline = self.build_pipeline()
+        runStart = time.monotonic()
+        bytesSent = self.displayService.bytesSent if self.displayService is not None else 0
+        try:
+            with self.stage('run'):
+                pipeline.run()
+        except Exception as e:
+            self.logger.error(e)
+            self.fallback(pipeline, runStart)
+            # the browser may be in a bad state, start afresh next time
+            if any(isinstance(error, StageTimeoutError) for error in pipeline.errors.values()):
+                self.renderService.abandon_browser()
+            else:
+                self.renderService.close_browser()
+        finally:
+            if not self.renderService.isPersistentBrowser:
+                # browser was warmed up but never used, e.g. because the fetch failed
+                self.renderService.close_browser()
+            if self.energy is not None:
+                self.energy.flush()
+            if self.tracer is not None:
+                self.tracer.flush()
+            if self.metrics is not None:
+                self.record_metrics(pipeline, bytesSent)
+        self.results = pipeline.results
+        return pipeline.results
+
+    def record_metrics(self, pipeline, bytesSent):
+        # Adds the refresh to the metrics and writes them out, bytesSent being the display's count before the refresh
+        results = pipeline.results
+        for name, (start, end) in pipeline.timings.items():
+            self.metrics.observe('maginkcal_stage_seconds', end - start, stage=name)
+        if pipeline.errors:
+            result = 'failed'
+        elif results.get('render') is None:
+            result = 'skipped'  # nothing changed since the last refresh
+        elif results.get('check') is not None:
+            result = 'precomputed'
+        else:
+            result = 'rendered'
+        self.metrics.inc('maginkcal_refreshes_total', result=result)
+        if self.displayService is not None:
+            self.metrics.inc('maginkcal_spi_bytes_total', self.displayService.bytesSent - bytesSent)
+        if 'fetch' in results:
+            self.metrics.set('maginkcal_events', len(results['fetch']))
+        for name, when in (('battery', 'start'), ('batteryEnd', 'end')):
+            if results.get(name, -1) >= 0:
+                self.metrics.set('maginkcal_battery_level', results[name], when=when)
+        self.metrics.set('maginkcal_last_refresh_timestamp_seconds', int(time.time()))
+        self.metrics.flush()
+
+    def next_refresh(self, currDatetime):
+        # Daemon mode: with adaptive wake, refresh when the content is next expected to change, else on a fixed interval
+        # With push notifications, changes trigger a refresh by themselves, so only the day rollover is scheduled
+        if self.scheduler is not None:
+            return self.scheduler.next_wake(currDatetime, self.results.get('fetch', []),
+                                            self.results.get('battery', -1))
+        if self.watchService is not None:
+            nextDate = currDatetime.date() + dt.timedelta(days=1)
+            rollover = self.displayTZ.localize(dt.datetime.combine(nextDate, dt.time(0, 1)))
+            return min(rollover, currDatetime + dt.timedelta(hours=self.maxWakeIntervalHours))
+        return currDatetime + dt.timedelta(minutes=self.refreshIntervalMinutes)
+
+    def fetch_stage(self):
+        # Fetches the events and saves them to the snapshot, without rendering anything
+        results = {'clock': self.get_clock(dt.datetime.now(self.displayTZ)), 'auth': self.init_gcal({}), 'check': None}
+        eventList = self.fetch_events(results)
+        self.logger.info('Saved {} events to {}'.format(len(eventList), self.snapshotFile))
+
+    def render_stage(self):
+        # Renders the events of the snapshot, as of the dates they were fetched for, and saves the packed planes
+        snapshot = self.load_snapshot()
+        if snapshot is None:
+            raise FileNotFoundError('No events saved in {}, run --stage fetch first'.format(self.snapshotFile))
+        if 'battery' not in self.results:
+            # read once, so that repeated renders only time the render itself
+            self.results['battery'] = self.read_battery({})
+        calDict = self.get_cal_dict(snapshot['clock'], snapshot['events'], self.results['battery'])
+        calBlackImage, calRedImage = self.renderService.process_inputs(calDict)
+        frame = encode_frame(calBlackImage, calRedImage)
+        self.save_file(self.stageFrameFile, frame)
+        self.logger.info('Saved frame to {} ({} bytes)'.format(self.stageFrameFile, len(frame)))
+
+    def display_stage(self):
+        # Shows the saved packed planes on the display, without fetching or rendering anything
+        frame = self.load_file(self.stageFrameFile)
+        if frame is None:
+            raise FileNotFoundError('No frame saved in {}, run --stage render first'.format(self.stageFrameFile))
+        displayService = self.init_panel({})
+        if displayService is None:
+            raise RuntimeError('isDisplayToScreen is disabled in config.json')
+        displayService.show_frame(frame)
+        displayService.sleep()
+
+    def run_stage(self, name, repeat=1):
+        # Runs a single stage of the refresh on its own, reading its input from and saving its output to disk, so that
+        # each stage can be profiled and tuned without running the others. With repeat, the stage is run again and
+        # again, e.g. to benchmark the render of the same events. Returns the duration of each run.
+        stages = {'fetch': self.fetch_stage, 'render': self.render_stage, 'display': self.display_stage}
+        # the browser stays open across repeats, as it would in daemon mode
+        self.renderService.isPersistentBrowser = True
+        timings = []
+        for i in range(repeat):
+            if self.energy is not None:
+                self.energy.new_run()
+                self.energy.set_battery(batteryStart=self.energy.sample_battery())
+            start = time.perf_counter()
+            with self.stage('run'):
+                stages[name]()
+            timings.append(time.perf_counter() - start)
+            if self.energy is not None:
+                self.energy.set_battery(batteryEnd=self.energy.sample_battery())
+                self.energy.flush()
+        if self.tracer is not None:
+            self.tracer.flush()
+        ordered = sorted(timings)
+        self.logger.info('Stage {} ran {} times: first {:.3f}s, min {:.3f}s, median {:.3f}s, max {:.3f}s'.format(
+            name, repeat, timings[0], ordered[0], ordered[len(ordered) // 2], ordered[-1]))
+        return timings
+
+    def close(self):
+        self.renderService.close()
+        self.powerService.close()
+
+
+def setup_logging(config):
+    # Create and configure logger. Records are written by a background thread, to a size limited and rotated log file,
+    # optionally buffered in RAM (e.g. logBufferDir "/dev/shm") and appended to the log file once per refresh
+    logService = LogHelper(config.get('logFile', 'logfile.log'), config.get('logMaxBytes', 1024 * 1024),
+                           config.get('logBackupCount', 3), config.get('logBufferDir') or None)
+    logService.start()
+    return logService
+
+
+def load_config(configPath='config.json'):
+    # Basic configuration settings (user replaceable)
+    with open(configPath) as configFile:
+        return json.load(configFile)
+
+
+def main(isProfile=False):
+    config = load_config()
+    logService = setup_logging(config)
+    logger = logging.getLogger('maginkcal')
+    logger.info("Starting daily calendar update")
+
+    profiler = Profiler() if isProfile else None
+    if profiler is not None:
+        profiler.start()
+
+    app = CalendarApp(config, isProfile=isProfile)
+    currDatetime = dt.datetime.now(app.displayTZ)
+    isScheduledWake = app.scheduler is not None and app.scheduler.is_scheduled_wake(currDatetime)
+
+    results = app.refresh()
+    if 'clock' in results:
+        currDatetime = results['clock']['currDatetime']
 
     logger.info("Completed daily calendar update")
 
+    if app.isAdaptiveWake:
+        # schedule the next wake for when the display content is next expected to change
+        nextWake = app.scheduler.next_wake(currDatetime, results.get('fetch', []), results.get('battery', -1))
+        app.powerService.set_next_boot_datetime(nextWake)
+    app.close()
+    if profiler is not None:
+        profiler.stop()
+
     logger.info("Checking if configured to shutdown safely - Current hour: {}".format(currDatetime.hour))
-    if isShutdownOnComplete:
-        # implementing a failsafe so that we don't shutdown when debugging
-        # checking if it's 6am in the morning, which is the time I've set PiSugar to wake and refresh the calendar
-        # if it is 6am, shutdown the RPi. if not 6am, assume I'm debugging the code, so do not shutdown
-        if currDatetime.hour == 6:
-            logger.info("Shutting down safely.")
-            import os
-            os.system("sudo shutdown -h now")
+    # implementing a failsafe so that we don't shutdown when debugging
+    # checking if it's 6am in the morning, which is the time I've set PiSugar to wake and refresh the calendar
+    # if it is 6am, shutdown the RPi. if not 6am, assume I'm debugging the code, so do not shutdown
+    # with adaptive wake, being woken up by the alarm we scheduled ourselves counts as well
+    isShutdown = app.isShutdownOnComplete and (currDatetime.hour == 6 or isScheduledWake)
+    if isShutdown:
+        logger.info("Shutting down safely.")
+    logService.stop()  # the log is written out before shutting down
+    if isShutdown:
+        os.system("sudo shutdown -h now")
+
+
+def daemon():
+    # Keeps the Google Calendar service, browser and display driver alive and refreshes the calendar on a schedule.
+    # Meant for mains powered displays, so the RPi is never shut down in this mode.
+    config = load_config()
+    logService = setup_logging(config)
+    logger = logging.getLogger('maginkcal')
+    logger.info("Starting calendar daemon")
+
+    app = CalendarApp(config, isDaemon=True)
+
+    def refresh():
+        try:
+            app.refresh()
+        finally:
+            logService.flush()
+
+    daemonService = DaemonHelper(refresh, lambda: app.next_refresh(dt.datetime.now(app.displayTZ)),
+                                 app.controlSocket)
+    if app.webhookAddress:
+        # refresh when Google notifies us of a change to one of the calendars
+        app.watchService = WatchHelper(app.init_gcal({}), app.calendars, app.webhookAddress, app.webhookToken,
+                                       app.webhookHost, app.webhookPort, app.watchTtlHours)
+        app.watchService.start(onChange=daemonService.request_refresh)
+    if app.frameServer is not None:
+        app.frameServer.start()
+    try:
+        daemonService.run()
+    finally:
+        if app.watchService is not None:
+            app.watchService.stop()
+        if app.frameServer is not None:
+            app.frameServer.stop()
+        app.close()
+        logger.info("Calendar daemon stopped")
+        logService.stop()
+
+
+def stage(name, repeat=1, snapshotFile=None, frameFile=None):
+    # Runs one stage of the refresh on its own, see CalendarApp.run_stage
+    config = load_config()
+    logService = setup_logging(config)
+    logger = logging.getLogger('maginkcal')
+    logger.info("Starting {} stage".format(name))
+
+    app = CalendarApp(config)
+    if snapshotFile:
+        app.snapshotFile = snapshotFile
+    if frameFile:
+        app.stageFrameFile = frameFile
+    try:
+        app.run_stage(name, repeat)
+    finally:
+        app.close()
+        logService.stop()
+
+
+def farm(configPaths, outputDir, workers=None):
+    # Renders one framebuffer per config file, for several displays driven from this RPi. The battery levels of the
+    # display nodes are unknown here, so the battery icon is hidden.
+    logService = setup_logging({})
+    logger = logging.getLogger('maginkcal')
+    logger.info("Starting render of {} panels".format(len(configPaths)))
+
+    settings = {pathlib.Path(path).stem: CalendarSettings(load_config(path)) for path in configPaths}
+    clocks = {name: app.get_clock(dt.datetime.now(app.displayTZ)) for name, app in settings.items()}
+    farmService = FarmHelper(GcalHelper(), outputDir, workers)
+    panels = [{'calendars': app.calendars, 'calendarPriority': app.calendarPriority,
+               'startDatetime': clocks[name]['calStartDatetime'], 'endDatetime': clocks[name]['calEndDatetime'],
+               'displayTZ': app.displayTZ, 'thresholdHours': app.thresholdHours} for name, app in settings.items()]
+    eventLists = farmService.fetch_events(panels)
+
+    jobs = []
+    for (name, app), eventList in zip(settings.items(), eventLists):
+        app.batteryDisplayMode = 0
+        jobs.append({'name': name, 'imageWidth': app.imageWidth, 'imageHeight': app.imageHeight,
+                     'rotateAngle': app.rotateAngle, 'backend': app.renderBackend, 'isInlineCss': app.isInlineCss,
+                     'isDomPatching': app.isDomPatching, 'calDict': app.get_cal_dict(clocks[name], eventList, -1)})
+    frameFiles = farmService.render(jobs)
+    logger.info("Completed render of {} panels".format(len(frameFiles)))
+    logService.stop()
+    return frameFiles
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description='Refresh the E-Ink calendar.')
+    parser.add_argument('--profile', action='store_true',
+                        help='run the stages sequentially, saving cProfile and tracemalloc snapshots to profile/')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running and refresh the calendar on a schedule, for mains powered displays')
+    parser.add_argument('--control', choices=['refresh', 'status', 'stop'],
+                        help='send a command to a running daemon')
+    parser.add_argument('--farm', nargs='+', metavar='CONFIG',
+                        help='render one framebuffer per display config file, in parallel')
+    parser.add_argument('--output', default='farm', help='folder for the framebuffers rendered with --farm')
+    parser.add_argument('--workers', type=int, help='number of processes rendering panels with --farm')
+    parser.add_argument('--stage', choices=['fetch', 'render', 'display'],
+                        help='only fetch the events to a snapshot, render the snapshot to a frame, or show the frame')
+    parser.add_argument('--repeat', type=int, default=1, help='number of times to run the --stage, for benchmarking')
+    parser.add_argument('--snapshot', help='events saved by --stage fetch (default: gcal/snapshot.pickle)')
+    parser.add_argument('--frame', help='frame saved by --stage render (default: render/stage_frame.bin)')
+    args = parser.parse_args()
+    if args.control:
+        print(send_command(load_config().get('controlSocket', '/tmp/maginkcal.sock'), args.control))
+    elif args.stage:
+        stage(args.stage, args.repeat, args.snapshot, args.frame)
+    elif args.farm:
+        farm(args.farm, args.output, args.workers)
+    elif args.daemon:
+        daemon()
+    else:
+        main(isProfile=args.profile)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Runs the calendar refresh repeatedly within a single long-running process, so that interpreter startup, imports, OAuth,
+browser launch and display initialisation are only paid for once. A control socket (a Unix domain socket) accepts one
+command per connection:
+- refresh: refresh the calendar now instead of waiting for the next scheduled refresh
+- status: returns a line of JSON describing the last and next refreshes
+- stop: finish any refresh in progress and exit
+"""
+
+import datetime as dt
+import socketserver
+import threading
+import signal
+import socket
+import json
+import os
+import logging
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        command = self.rfile.readline().decode('utf-8').strip()
+        response = self.server.daemonService.handle_command(command)
+        self.wfile.write((response + '\n').encode('utf-8'))
+
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def send_command(socketPath, command, timeout=10):
+    # Sends a command to a running daemon and returns its response
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socketPath)
+        sock.sendall((command + '\n').encode('utf-8'))
+        response = b''
+        while not response.endswith(b'\n'):
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            response += chunk
+    return response.decode('utf-8').strip()
+
+
+class DaemonHelper:
+
+    def __init__(self, refreshFunc, nextRefreshFunc, socketPath):
+        self.logger = logging.getLogger('maginkcal')
+        self.refreshFunc = refreshFunc  # runs a single refresh
+        self.nextRefreshFunc = nextRefreshFunc  # returns the (timezone aware) datetime of the next scheduled refresh
+        self.socketPath = socketPath
+        self.wakeEvent = threading.Event()  # set to cut the wait until the next refresh short
+        self.isStopping = False
+        self.isRefreshing = False
+        self.refreshCount = 0
+        self.lastRefresh = None
+        self.nextRefresh = None
+        self.server = None
+
+    def handle_command(self, command):
+        if command == 'refresh':
+            self.logger.info('Refresh requested through control socket.')
+            self.request_refresh()
+            return 'ok'
+        elif command == 'status':
+            return json.dumps({'refreshing': self.isRefreshing, 'refreshCount': self.refreshCount,
+                               'lastRefresh': self.lastRefresh.isoformat() if self.lastRefresh else None,
+                               'nextRefresh': self.nextRefresh.isoformat() if self.nextRefresh else None})
+        elif command == 'stop':
+            self.stop()
+            return 'ok'
+        return 'unknown command: ' + command
+
+    def start_control_server(self):
+        if os.path.exists(self.socketPath):
+            os.remove(self.socketPath)  # left behind by a previous daemon that did not exit cleanly
+        self.server = ControlServer(self.socketPath, ControlHandler)
+        self.server.daemonService = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.logger.info('Control socket listening on ' + self.socketPath)
+
+    def request_refresh(self):
+        # refresh as soon as possible, or right after the refresh in progress
+        self.wakeEvent.set()
+
+    def stop(self, *args):
+        self.isStopping = True
+        self.wakeEvent.set()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.start_control_server()
+        try:
+            while not self.isStopping:
+                self.wakeEvent.clear()
+                self.isRefreshing = True
+                try:
+                    self.refreshFunc()
+                except Exception as e:
+                    self.logger.error(e)
+                finally:
+                    self.isRefreshing = False
+                self.refreshCount += 1
+                self.lastRefresh = dt.datetime.now().astimezone()
+
+                self.nextRefresh = self.nextRefreshFunc()
+                delay = (self.nextRefresh - dt.datetime.now(self.nextRefresh.tzinfo)).total_seconds()
+                self.logger.info('Next refresh at {}'.format(self.nextRefresh))
+                self.wakeEvent.wait(max(0, delay))
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+            if os.path.exists(self.socketPath):
+                os.remove(self.socketPath)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Renders several displays in one go, each with its own config.json, instead of running maginkcal.py once per panel. The
+Google Calendar service is authenticated once, and a calendar shown on several panels is fetched once, covering the
+dates of all of them. The panels are then rendered in parallel in a pool of processes, each of which keeps its own
+headless browser open for all the panels it renders. Every panel ends up as a framebuffer (see render/framebuffer.py)
+in the output folder, named after its config file, ready to be served to or copied onto the display node.
+
+Each worker process runs a Chromium instance, so the number of workers should be chosen with the available memory in
+mind, as well as the number of cores.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing.util
+import time
+import os
+import logging
+
+workerRenderers = {}  # (width, height, angle, backend, isInlineCss, isDomPatching) -> RenderHelper, per worker process
+
+
+def close_renderers():
+    for renderService in workerRenderers.values():
+        renderService.close()
+    workerRenderers.clear()
+
+
+def init_worker():
+    # browsers are kept open across panels, and closed when the worker process exits
+    multiprocessing.util.Finalize(None, close_renderers, exitpriority=10)
+
+
+def render_panel(job):
+    # Runs in a worker process: renders one panel and writes its framebuffer, returns (name, frame size, duration)
+    from render.render import RenderHelper
+    from render.framebuffer import encode_frame
+    from pipeline.files import write_atomic
+    start = time.perf_counter()
+    key = (job['imageWidth'], job['imageHeight'], job['rotateAngle'], job.get('backend', 'browser'),
+           job.get('isInlineCss', False), job.get('isDomPatching', False))
+    renderService = workerRenderers.get(key)
+    if renderService is None:
+        renderService = RenderHelper(*key[:3])
+        renderService.isPersistentBrowser = True
+        renderService.backend = key[3]
+        renderService.isInlineCss = key[4]
+        renderService.isDomPatching = key[5]
+        workerRenderers[key] = renderService
+    # panels rendered at the same time by different workers must not overwrite each other's HTML and screenshot
+    renderService.outputName = 'calendar-' + job['name']
+    calBlackImage, calRedImage = renderService.process_inputs(job['calDict'])
+    frame = encode_frame(calBlackImage, calRedImage)
+    write_atomic(job['frameFile'], frame)
+    return job['name'], len(frame), time.perf_counter() - start
+
+
+class FarmHelper:
+
+    def __init__(self, gcalService, outputDir='farm', workers=None):
+        self.logger = logging.getLogger('maginkcal')
+        self.gcalService = gcalService
+        self.outputDir = outputDir
+        self.workers = workers or os.cpu_count()
+
+    def fetch_events(self, panels):
+        # panels: list of {'calendars', 'calendarPriority', 'startDatetime', 'endDatetime', 'displayTZ',
+        #                  'thresholdHours'}
+        # Returns the list of events of each panel, fetching every calendar only once
+        windows = {}
+        for panel in panels:
+            for cal in panel['calendars']:
+                start, end = windows.get(cal, (panel['startDatetime'], panel['endDatetime']))
+                windows[cal] = (min(start, panel['startDatetime']), max(end, panel['endDatetime']))
+        rawEvents = {}
+        for cal, (start, end) in windows.items():
+            rawEvents[cal] = self.gcalService.fetch_calendar(cal, start.isoformat(), end.isoformat())
+        self.logger.info('Fetched {} calendars for {} panels ({} without deduplication).'.format(
+            len(windows), len(panels), sum(len(panel['calendars']) for panel in panels)))
+
+        eventLists = []
+        for panel in panels:
+            events = self.gcalService.merge_calendars({cal: rawEvents[cal] for cal in panel['calendars']},
+                                                      panel.get('calendarPriority'))
+            eventList = self.gcalService.normalize_events(events, panel['displayTZ'], panel['thresholdHours'])
+            # the shared fetch may cover a wider range of dates than this panel shows
+            eventLists.append([event for event in eventList if event['endDatetime'] >= panel['startDatetime']
+                               and event['startDatetime'] <= panel['endDatetime']])
+        return eventLists
+
+    def render(self, jobs):
+        # jobs: list of {'name', 'imageWidth', 'imageHeight', 'rotateAngle', 'backend', 'isInlineCss', 'isDomPatching',
+        # 'calDict'}
+        # Returns {name: path of the framebuffer} for the panels that were rendered successfully
+        if not jobs:
+            return {}
+        os.makedirs(self.outputDir, exist_ok=True)
+        for job in jobs:
+            job['frameFile'] = os.path.join(self.outputDir, job['name'] + '.bin')
+        frameFiles = {}
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=min(self.workers, len(jobs)), initializer=init_worker) as executor:
+            futures = {executor.submit(render_panel, job): job for job in jobs}
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    name, size, duration = future.result()
+                except Exception as e:
+                    self.logger.error('Panel {} failed: {}'.format(job['name'], e))
+                    continue
+                frameFiles[name] = job['frameFile']
+                self.logger.info('Panel {} rendered in {:.2f}s ({} bytes).'.format(name, duration, size))
+        elapsed = time.perf_counter() - start
+        self.logger.info('Rendered {} of {} panels in {:.1f}s with {} workers, {:.1f} panels per minute.'.format(
+            len(frameFiles), len(jobs), elapsed, min(self.workers, len(jobs)), len(frameFiles) / elapsed * 60))
+        return frameFiles
@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Writes the state and output files of the calendar (frames, schedules, metrics, caches) so that a reader, or the next
+boot after a power cut, never sees a partly written file: the data goes to a temporary file next to it first, which is
+then moved into place. The temporary file is named after the process and thread writing it, since the threads of the
+daemon and the worker processes of the farm may write the same file at the same time.
+"""
+
+import threading
+import os
+
+
+def write_atomic(path, data):
+    # data: bytes, or str which is written as text
+    tmpFile = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmpFile, 'w' if isinstance(data, str) else 'wb') as f:
+            f.write(data)
+        os.replace(tmpFile, path)
+    except BaseException:
+        try:
+            os.remove(tmpFile)
+        except OSError:
+            pass
+        raise
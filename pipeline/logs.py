@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Logging that stays off the refresh path and is easy on the SD card. Log records are put on a queue by the logging calls
+and written out by a background thread, and the log file is rotated once it reaches a size limit, keeping a number of
+old files around.
+
+Optionally, the log is first written to a buffer in a RAM backed folder (e.g. /dev/shm), and only appended to the log
+file on the SD card once per refresh, which turns the many small writes of a refresh into a single one. Whatever is
+still in the buffer when the RPi loses power is lost, so the buffer is also flushed before shutting down.
+"""
+
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import threading
+import queue
+import sys
+import os
+import logging
+
+FORMAT = '%(asctime)s %(levelname)s - %(message)s'
+
+
+class LogHelper:
+
+    def __init__(self, logFile='logfile.log', maxBytes=1024 * 1024, backupCount=3, bufferDir=None):
+        self.logFile = logFile
+        self.maxBytes = maxBytes
+        self.backupCount = backupCount
+        self.bufferFile = os.path.join(bufferDir, 'maginkcal.log') if bufferDir else None
+        self.lock = threading.Lock()
+        self.queue = queue.SimpleQueue()
+        self.fileHandler = None
+        self.queueHandler = None
+        self.listener = None
+
+    def start(self, level=logging.INFO):
+        if self.bufferFile is not None:
+            # left over by a run that did not get to flush it
+            self.flush()
+            self.fileHandler = logging.FileHandler(self.bufferFile, mode='a')
+        else:
+            self.fileHandler = RotatingFileHandler(self.logFile, maxBytes=self.maxBytes,
+                                                   backupCount=self.backupCount)
+        self.fileHandler.setFormatter(logging.Formatter(FORMAT))
+        consoleHandler = logging.StreamHandler(sys.stdout)  # print logger to stdout
+        consoleHandler.addFilter(logging.Filter('maginkcal'))
+        self.listener = QueueListener(self.queue, self.fileHandler, consoleHandler)
+        self.listener.start()
+
+        # records of other libraries (e.g. warnings) end up in the log file as well, like with logging.basicConfig
+        self.queueHandler = QueueHandler(self.queue)
+        logging.getLogger().addHandler(self.queueHandler)
+        logger = logging.getLogger('maginkcal')
+        logger.setLevel(level)
+        return logger
+
+    def rotate(self):
+        for i in range(self.backupCount - 1, 0, -1):
+            if os.path.exists('{}.{}'.format(self.logFile, i)):
+                os.replace('{}.{}'.format(self.logFile, i), '{}.{}'.format(self.logFile, i + 1))
+        if self.backupCount > 0:
+            os.replace(self.logFile, self.logFile + '.1')
+        else:
+            os.remove(self.logFile)
+
+    def flush(self):
+        # Appends the buffered log to the log file on the SD card, in a single write
+        if self.bufferFile is None:
+            return
+        with self.lock:
+            if self.fileHandler is not None:
+                self.fileHandler.acquire()
+            try:
+                if self.fileHandler is not None:
+                    self.fileHandler.flush()
+                try:
+                    with open(self.bufferFile, 'rb') as f:
+                        buffered = f.read()
+                except OSError:
+                    return
+                if not buffered:
+                    return
+                if os.path.exists(self.logFile) and os.path.getsize(self.logFile) + len(buffered) > self.maxBytes:
+                    self.rotate()
+                with open(self.logFile, 'ab') as f:
+                    f.write(buffered)
+                # the handler keeps the buffer open in append mode, so truncating it in place is enough
+                os.truncate(self.bufferFile, 0)
+            finally:
+                if self.fileHandler is not None:
+                    self.fileHandler.release()
+
+    def stop(self):
+        # Writes out the records still on the queue, then flushes the buffer
+        if self.listener is not None:
+            logging.getLogger().removeHandler(self.queueHandler)
+            self.listener.stop()
+            self.listener = None
+        self.flush()
+        if self.fileHandler is not None:
+            self.fileHandler.close()
+            self.fileHandler = None
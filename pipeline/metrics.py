@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Performance metrics for a fleet of displays, written in the Prometheus text format to a file that the textfile
+collector of node_exporter picks up, e.g. /var/lib/prometheus/node-exporter/maginkcal.prom. Nothing has to keep running
+on the device to serve them. Counters and latency histograms are kept across boots in a small state file, so that they
+keep accumulating from one wake to the next like those of a long running process would.
+
+Both files are written once per refresh, each to a temporary file in the same folder first and then renamed, so that
+node_exporter never reads a half written file. Timings of the steps of a refresh are collected through the same
+stage() calls as the EnergyLogger, which can be chained behind this.
+"""
+
+from contextlib import contextmanager, nullcontext
+import pathlib
+import threading
+import time
+import json
+import logging
+
+from pipeline.files import write_atomic
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, 120, 300)
+# name -> (type, help, histogram buckets)
+METRICS = {
+    'maginkcal_refreshes_total': ('counter', 'Refreshes by result: rendered, precomputed, skipped or failed.', None),
+    'maginkcal_stage_seconds': ('histogram', 'Duration of the pipeline stages of a refresh.', LATENCY_BUCKETS),
+    'maginkcal_step_seconds': ('histogram', 'Duration of the steps within the stages, e.g. split, pack and busy.',
+                               LATENCY_BUCKETS),
+    'maginkcal_calendar_fetch_seconds': ('histogram', 'Latency of fetching the events of each calendar.',
+                                         LATENCY_BUCKETS),
+    'maginkcal_spi_bytes_total': ('counter', 'Bytes sent to the display over SPI.', None),
+    'maginkcal_events': ('gauge', 'Number of events on the calendar at the last refresh.', None),
+    'maginkcal_battery_level': ('gauge', 'Battery level in percent, at the start and end of the last refresh.', None),
+    'maginkcal_last_refresh_timestamp_seconds': ('gauge', 'Time of the last refresh.', None),
+}
+DEFAULT_STATE_FILE = str(pathlib.Path(__file__).parent.absolute()) + '/metrics.json'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = ('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for key, value in sorted(labels.items()))
+    return '{' + ','.join(escaped) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsHelper:
+
+    def __init__(self, metricsFile, stateFile=DEFAULT_STATE_FILE, recorder=None):
+        self.logger = logging.getLogger('maginkcal')
+        self.metricsFile = metricsFile
+        self.stateFile = stateFile
+        self.recorder = recorder  # optionally an EnergyLogger, whose stages are recorded as well
+        self.lock = threading.Lock()
+        self.values = self.load_state()  # name -> {formatted labels -> value, or histogram state}
+
+    def load_state(self):
+        try:
+            with open(self.stateFile, 'r') as f:
+                values = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        # metrics that are no longer defined, or whose buckets changed, start afresh
+        for name in list(values):
+            kind, text, buckets = METRICS.get(name, (None, None, None))
+            if kind is None or (kind == 'histogram' and any(
+                    len(series['buckets']) != len(buckets) for series in values[name].values())):
+                del values[name]
+        return values
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            series = self.values.setdefault(name, {})
+            key = format_labels(labels)
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values.setdefault(name, {})[format_labels(labels)] = value
+
+    def observe(self, name, value, **labels):
+        buckets = METRICS[name][2]
+        with self.lock:
+            series = self.values.setdefault(name, {})
+            key = format_labels(labels)
+            histogram = series.setdefault(key, {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0})
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @contextmanager
+    def time(self, name, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    @contextmanager
+    def stage(self, name):
+        # same as EnergyLogger.stage, so that this can be handed to the helpers as their recorder
+        with self.recorder.stage(name) if self.recorder is not None else nullcontext():
+            with self.time('maginkcal_step_seconds', step=name):
+                yield
+
+    def render(self):
+        # Returns the metrics in the Prometheus text exposition format
+        lines = []
+        with self.lock:
+            for name, (kind, text, buckets) in METRICS.items():
+                series = self.values.get(name)
+                if not series:
+                    continue
+                lines.append('# HELP {} {}'.format(name, text))
+                lines.append('# TYPE {} {}'.format(name, kind))
+                for key, value in sorted(series.items()):
+                    if kind != 'histogram':
+                        lines.append('{}{} {}'.format(name, key, format_value(value)))
+                        continue
+                    labels = key[1:-1] + ',' if key else ''
+                    for bound, count in zip(buckets + (float('inf'),), value['buckets'] + [value['count']]):
+                        lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, labels, format_value(bound), count))
+                    lines.append('{}_sum{} {}'.format(name, key, format_value(value['sum'])))
+                    lines.append('{}_count{} {}'.format(name, key, value['count']))
+        return '\n'.join(lines) + '\n'
+
+    def write_file(self, path, text):
+        write_atomic(path, text)
+
+    def flush(self):
+        # Saves the state for the next boot and updates the metrics file
+        with self.lock:
+            state = json.dumps(self.values)
+        try:
+            self.write_file(self.stateFile, state)
+            self.write_file(self.metricsFile, self.render())
+        except OSError as e:
+            self.logger.info('Unable to save metrics: {}'.format(e))
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This is a small orchestrator that runs the stages of a calendar refresh concurrently. Each stage declares the stages it
+depends on, and is started in its own thread as soon as those have completed. That way slow but independent work (such
+as warming up the browser or resetting the eInk panel) overlaps with the network fetch, and the total wake time shrinks
+to the longest chain of dependent stages, which is reported as the critical path at the end of each run.
+
+Stages can be given deadlines (in seconds from the start of the run), as well as a budget for the whole run. A stage
+that has not finished by then is reported as timed out and the stages depending on it are skipped, so that a hung
+network call or browser cannot keep the RPi awake. Python threads cannot be killed, so an overrunning stage is abandoned
+rather than stopped, which is why stages run in daemon threads that do not hold up the exit of the script. Stages that
+must not be abandoned halfway, such as updating the eInk panel, can be left out of the budget, and are then only held
+to a deadline of their own, if given one.
+"""
+
+from concurrent.futures import Future, InvalidStateError, wait
+import contextvars
+import threading
+import time
+import logging
+
+
+class StageFailedError(Exception):
+    # raised by a stage whose dependency did not complete successfully
+    pass
+
+
+class StageTimeoutError(Exception):
+    # recorded for a stage that did not finish before its deadline or the end of the budget
+    pass
+
+
+class PipelineHelper:
+
+    def __init__(self, tracer=None, isSequential=False, deadlines=None, budget=None, unbudgeted=()):
+        self.logger = logging.getLogger('maginkcal')
+        self.tracer = tracer  # optional Tracer, each stage is then recorded as a span
+        self.isSequential = isSequential  # run all stages on the calling thread, e.g. for profiling
+        self.deadlines = deadlines or {}  # stage name -> seconds from the start of the run, by which it has to finish
+        self.budget = budget  # seconds from the start of the run by which all stages have to finish
+        self.unbudgeted = set(unbudgeted)  # names of the stages the budget does not apply to
+        self.stages = {}  # stage name -> (function, list of dependency names), in insertion order
+        self.results = {}
+        self.errors = {}
+        self.timings = {}  # stage name -> (start, end) in seconds, relative to the start of the run
+        self.starts = {}
+
+    def add_stage(self, name, func, deps=()):
+        # func is called with a dictionary of the results of its dependencies, keyed by stage name
+        if name in self.stages:
+            raise ValueError('Stage already defined: ' + name)
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError('Stage ' + name + ' depends on undefined stage ' + dep)
+        self.stages[name] = (func, list(deps))
+
+    def run_stage(self, name, futures, runStart):
+        func, deps = self.stages[name]
+        depResults = {}
+        for dep in deps:
+            wait([futures[dep]])  # block until the dependency has finished, or timed out
+            if dep in self.errors or futures[dep].exception() is not None:
+                raise StageFailedError('Stage ' + name + ' skipped as ' + dep + ' failed')
+            depResults[dep] = self.results[dep]
+
+        start = time.monotonic() - runStart
+        self.starts[name] = start
+        try:
+            if self.tracer is not None:
+                with self.tracer.span('stage.' + name):
+                    result = func(depResults)
+            else:
+                result = func(depResults)
+            if name not in self.errors:  # a stage that timed out has been given up on, its result is ignored
+                self.results[name] = result
+        except Exception as e:
+            self.errors.setdefault(name, e)
+        finally:
+            self.timings.setdefault(name, (start, time.monotonic() - runStart))
+
+    def run_stage_thread(self, name, futures, runStart):
+        try:
+            futures[name].set_result(self.run_stage(name, futures, runStart))
+        except StageFailedError as e:
+            self.set_exception(futures[name], e)
+        except InvalidStateError:
+            pass  # the stage timed out in the meantime
+
+    def set_exception(self, future, e):
+        try:
+            future.set_exception(e)
+        except InvalidStateError:
+            pass
+
+    def get_deadline(self, name):
+        budget = None if name in self.unbudgeted else self.budget
+        deadlines = [d for d in (self.deadlines.get(name), budget) if d is not None]
+        return min(deadlines) if deadlines else None
+
+    def run(self):
+        # Stages are started in the order they were added, which is always a valid topological order since a stage
+        # can only depend on stages defined before it. One thread per stage so that no stage waiting on its
+        # dependencies can starve another of a thread. Deadlines are not enforced when running sequentially.
+        self.results = {}
+        self.errors = {}
+        self.timings = {}
+        self.starts = {}
+        runStart = time.monotonic()
+        futures = {}
+        if self.isSequential:
+            for name in self.stages:
+                futures[name] = Future()
+                try:
+                    futures[name].set_result(self.run_stage(name, futures, runStart))
+                except StageFailedError as e:
+                    futures[name].set_exception(e)
+        else:
+            for name in self.stages:
+                futures[name] = Future()
+            for name in self.stages:
+                # each stage runs in a copy of the caller's context, so that trace spans nest under the caller
+                context = contextvars.copy_context()
+                threading.Thread(target=context.run, args=(self.run_stage_thread, name, futures, runStart),
+                                 name='stage-' + name, daemon=True).start()
+            for name in self.stages:
+                deadline = self.get_deadline(name)
+                timeout = None if deadline is None else max(0.0, runStart + deadline - time.monotonic())
+                if not wait([futures[name]], timeout).done:
+                    self.logger.error('Stage {} did not finish within {}s, giving up on it'.format(name, deadline))
+                    self.errors[name] = StageTimeoutError('Stage ' + name + ' timed out after ' + str(deadline) + 's')
+                    self.timings.setdefault(name, (self.starts.get(name, deadline), deadline))
+                    self.set_exception(futures[name], self.errors[name])
+        for name in self.stages:
+            try:
+                futures[name].result()
+            except (StageFailedError, StageTimeoutError) as e:
+                self.errors.setdefault(name, e)
+        self.report()
+
+        # surface the first genuine failure (i.e. not a skipped dependent) to the caller
+        for name in self.stages:
+            if name in self.errors and not isinstance(self.errors[name], StageFailedError):
+                raise self.errors[name]
+        return self.results
+
+    def critical_path(self):
+        # Walk back from the stage that finished last, each time following the dependency that finished last
+        if not self.timings:
+            return []
+        path = [max(self.timings, key=lambda k: self.timings[k][1])]
+        while True:
+            deps = [dep for dep in self.stages[path[-1]][1] if dep in self.timings]
+            if not deps:
+                break
+            path.append(max(deps, key=lambda k: self.timings[k][1]))
+        path.reverse()
+        return path
+
+    def report(self):
+        for name in self.stages:
+            if name not in self.timings:
+                self.logger.info('Stage {} did not run: {}'.format(name, self.errors.get(name)))
+                continue
+            start, end = self.timings[name]
+            self.logger.info('Stage {} ran from {:.3f}s to {:.3f}s ({:.3f}s){}'.format(
+                name, start, end, end - start, ' - FAILED' if name in self.errors else ''))
+        path = self.critical_path()
+        if path:
+            total = self.timings[path[-1]][1]
+            busy = sum(self.timings[k][1] - self.timings[k][0] for k in self.timings)
+            self.logger.info('Critical path: {} ({:.3f}s wall time, {:.3f}s of stage time)'.format(
+                ' -> '.join(path), total, busy))
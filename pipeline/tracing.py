@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A lightweight tracing layer. Spans are opened around pipeline stages and around the methods of the helper classes, and
+nest according to the call stack (including across the threads started by the PipelineHelper). Each span is written as
+one line of JSON once the run is complete, e.g.
+
+{"name": "RenderHelper.get_screenshot", "id": 7, "parent": 5, "thread": "stage-render",
+ "start": 1700000000.123, "duration": 2.345, "error": null}
+
+There is also a profiling mode that captures cProfile statistics and a tracemalloc snapshot for a full run.
+"""
+
+from contextlib import contextmanager
+import contextvars
+import functools
+import itertools
+import cProfile
+import pstats
+import tracemalloc
+import threading
+import time
+import json
+import os
+import logging
+
+currentSpan = contextvars.ContextVar('currentSpan', default=None)
+
+
+class Tracer:
+
+    def __init__(self, traceFile='trace.jsonl'):
+        self.logger = logging.getLogger('maginkcal')
+        self.traceFile = traceFile
+        self.ids = itertools.count(1)
+        self.spans = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, **attrs):
+        spanId = next(self.ids)
+        parent = currentSpan.get()
+        token = currentSpan.set(spanId)
+        record = {'name': name, 'id': spanId, 'parent': parent, 'thread': threading.current_thread().name,
+                  'start': time.time(), 'duration': None, 'error': None}
+        if attrs:
+            record['attrs'] = attrs
+        start = time.monotonic()
+        try:
+            yield record
+        except Exception as e:
+            record['error'] = repr(e)
+            raise
+        finally:
+            record['duration'] = round(time.monotonic() - start, 6)
+            currentSpan.reset(token)
+            with self.lock:
+                self.spans.append(record)
+
+    def wrap(self, name, func):
+        @functools.wraps(func)
+        def traced(*args, **kwargs):
+            with self.span(name):
+                return func(*args, **kwargs)
+        return traced
+
+    def instrument(self, obj, methods):
+        # Replaces the given methods on an instance with traced versions, spans are named "<class>.<method>"
+        className = type(obj).__name__
+        for method in methods:
+            setattr(obj, method, self.wrap(className + '.' + method, getattr(obj, method)))
+        return obj
+
+    def flush(self):
+        with self.lock:
+            spans, self.spans = self.spans, []
+        if not spans:
+            return
+        spans.sort(key=lambda k: k['start'])
+        try:
+            with open(self.traceFile, 'a') as f:
+                f.write(''.join(json.dumps(span) + '\n' for span in spans))
+        except OSError as e:
+            self.logger.info('Unable to save trace: {}'.format(e))
+
+
+class Profiler:
+    # Captures cProfile statistics and a tracemalloc snapshot. Note that cProfile only sees the thread it was started
+    # on, so the pipeline should be run sequentially while profiling.
+
+    def __init__(self, outputDir='profile', topCount=15):
+        self.logger = logging.getLogger('maginkcal')
+        self.outputDir = outputDir
+        self.topCount = topCount
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        tracemalloc.start(10)
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        os.makedirs(self.outputDir, exist_ok=True)
+        prefix = os.path.join(self.outputDir, time.strftime('%Y%m%d-%H%M%S'))
+        self.profile.dump_stats(prefix + '.prof')
+        snapshot.dump(prefix + '.tracemalloc')
+
+        stats = pstats.Stats(self.profile)
+        self.logger.info('Profile saved to {}.prof, memory snapshot to {}.tracemalloc'.format(prefix, prefix))
+        for line in self.get_top_functions(stats):
+            self.logger.info(line)
+        self.logger.info('Memory: {:.1f} MiB at end of run, {:.1f} MiB peak'.format(current / 2 ** 20, peak / 2 ** 20))
+        for stat in snapshot.statistics('lineno')[:self.topCount]:
+            self.logger.info('Memory: {}'.format(stat))
+
+    def get_top_functions(self, stats):
+        lines = []
+        for (filename, line, name), (cc, nc, tt, ct, callers) in sorted(
+                stats.stats.items(), key=lambda k: k[1][3], reverse=True)[:self.topCount]:
+            lines.append('Profile: {:>9.3f}s cumulative {:>9.3f}s own {:>8} calls  {}:{}({})'.format(
+                ct, tt, nc, os.path.basename(filename), line, name))
+        return lines
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This keeps track of how long each stage of a refresh takes and how much the battery level drops while it runs, so that
+we can tell which part of the refresh is draining the battery. Records are buffered during the run and appended to a
+compact binary time series on the device in one write at the end, which survives reboots.
+
+Each record is 13 bytes: run timestamp (uint32, epoch seconds), stage id (uint8), duration (uint32, milliseconds) and
+the battery level at the start and end of the run (uint16 each, hundredths of a percent, 0xFFFF if unavailable).
+
+The battery is only read at the start and end of a refresh, by the stages that read it anyway, and not around each
+stage: every reading is a round trip to the PiSugar server, on the path being measured, and the PiSugar only reports
+the level to a fraction of a percent, so the drain of a single stage would be mostly noise. The report instead shares
+out the drain of each run between its stages by their duration, and averages over many runs. Stages may run
+concurrently, so these shares are estimates.
+Run "python3 -m power.energy" to print a report of the recorded data.
+"""
+
+from contextlib import contextmanager
+import datetime as dt
+import argparse
+import pathlib
+import struct
+import threading
+import time
+import logging
+
+# Stage ids are stored on disk, so new stages must only ever be appended to the end of this list
+STAGES = ('run', 'sync', 'auth', 'fetch', 'template', 'launch', 'browser', 'split', 'panel', 'pack', 'upload', 'busy',
+          'calibrate')
+RECORD = struct.Struct('<IBIHH')
+NO_BATTERY = 0xFFFF
+DEFAULT_FILE = str(pathlib.Path(__file__).parent.absolute()) + '/energy.dat'
+
+
+class EnergyLogger:
+
+    def __init__(self, powerService=None, dataFile=DEFAULT_FILE):
+        self.logger = logging.getLogger('maginkcal')
+        self.powerService = powerService  # battery is not sampled if no PowerHelper is provided
+        self.dataFile = dataFile
+        self.runTimestamp = int(time.time())
+        self.batteryStart = -1.0  # battery level at the start and end of the run, see set_battery
+        self.batteryEnd = -1.0
+        self.records = []
+        self.lock = threading.Lock()
+
+    def new_run(self):
+        # records of subsequent stages are attributed to a new run, e.g. for each refresh in daemon mode
+        self.runTimestamp = int(time.time())
+        self.batteryStart = self.batteryEnd = -1.0
+
+    def sample_battery(self):
+        if self.powerService is None:
+            return -1.0
+        return self.powerService.get_battery()
+
+    def set_battery(self, batteryStart=None, batteryEnd=None):
+        # Hands over the battery levels read during the run, which are stored with each of its stages on flush
+        if batteryStart is not None:
+            self.batteryStart = batteryStart
+        if batteryEnd is not None:
+            self.batteryEnd = batteryEnd
+
+    @contextmanager
+    def stage(self, name):
+        stageId = STAGES.index(name)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = int((time.monotonic() - start) * 1000)
+            with self.lock:
+                self.records.append((self.runTimestamp, stageId, duration))
+
+    def flush(self):
+        with self.lock:
+            records, self.records = self.records, []
+        if not records:
+            return
+        battery = (encode_battery(self.batteryStart), encode_battery(self.batteryEnd))
+        try:
+            with open(self.dataFile, 'ab') as f:
+                f.write(b''.join(RECORD.pack(*record, *battery) for record in records))
+        except OSError as e:
+            self.logger.info('Unable to save energy records: {}'.format(e))
+
+
+def encode_battery(level):
+    if level < 0:
+        return NO_BATTERY
+    return min(int(round(level * 100)), 10000)
+
+
+def decode_battery(value):
+    if value == NO_BATTERY:
+        return -1.0
+    return value / 100.0
+
+
+def load_records(dataFile=DEFAULT_FILE):
+    # returns a list of (runTimestamp, stage name, duration in seconds, battery at start, battery at end)
+    with open(dataFile, 'rb') as f:
+        data = f.read()
+    data = data[:len(data) - len(data) % RECORD.size]  # ignore a partially written trailing record
+    records = []
+    for runTimestamp, stageId, duration, batteryStart, batteryEnd in RECORD.iter_unpack(data):
+        name = STAGES[stageId] if stageId < len(STAGES) else 'stage{}'.format(stageId)
+        records.append((runTimestamp, name, duration / 1000.0, decode_battery(batteryStart),
+                        decode_battery(batteryEnd)))
+    return records
+
+
+def get_drain(batteryStart, batteryEnd):
+    # battery drop in percent, or None if unknown or the battery was being charged
+    if batteryStart < 0 or batteryEnd < 0 or batteryEnd > batteryStart:
+        return None
+    return batteryStart - batteryEnd
+
+
+def report(records, capacityMah, days):
+    cutoff = time.time() - days * 86400
+    records = [record for record in records if record[0] >= cutoff]
+    runs = sorted(set(record[0] for record in records))
+    print('{} runs recorded over the last {} days'.format(len(runs), days))
+    if not runs:
+        return
+
+    # the drain of each run is shared out between its stages by their duration
+    runDurations = {record[0]: record[2] for record in records if record[1] == 'run' and record[2] > 0}
+    print('\n{:<10} {:>6} {:>10} {:>10} {:>12}'.format('stage', 'count', 'avg time', 'max time', 'avg mAh'))
+    for name in STAGES:
+        stageRecords = [record for record in records if record[1] == name]
+        if not stageRecords:
+            continue
+        durations = [record[2] for record in stageRecords]
+        drains = [get_drain(record[3], record[4]) * min(record[2] / runDurations[record[0]], 1.0)
+                  for record in stageRecords
+                  if record[0] in runDurations and get_drain(record[3], record[4]) is not None]
+        mah = '{:.3f}'.format(sum(drains) / len(drains) / 100.0 * capacityMah) if drains else '-'
+        print('{:<10} {:>6} {:>9.2f}s {:>9.2f}s {:>12}'.format(name, len(durations), sum(durations) / len(durations),
+                                                             max(durations), mah))
+
+    # trend of the whole-run drain, per day
+    print('\n{:<12} {:>6} {:>10} {:>12} {:>14}'.format('date', 'runs', 'avg time', 'mAh/refresh', 'refreshes/charge'))
+    perDay = {}
+    for record in records:
+        if record[1] == 'run':
+            perDay.setdefault(dt.date.fromtimestamp(record[0]), []).append(record)
+    for day in sorted(perDay):
+        durations = [record[2] for record in perDay[day]]
+        drains = [d for d in (get_drain(record[3], record[4]) for record in perDay[day]) if d is not None]
+        if drains and sum(drains) > 0:
+            avgDrain = sum(drains) / len(drains)
+            mah = '{:.2f}'.format(avgDrain / 100.0 * capacityMah)
+            refreshes = '{:.0f}'.format(100.0 / avgDrain)
+        else:
+            mah, refreshes = '-', '-'
+        print('{:<12} {:>6} {:>9.2f}s {:>12} {:>14}'.format(day.isoformat(), len(durations),
+                                                           sum(durations) / len(durations), mah, refreshes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report the energy and time spent per refresh stage.')
+    parser.add_argument('--file', default=DEFAULT_FILE, help='energy data file to read')
+    parser.add_argument('--capacity', type=float, default=1200, help='battery capacity in mAh (PiSugar2: 1200)')
+    parser.add_argument('--days', type=int, default=30, help='only report on the last number of days')
+    args = parser.parse_args()
+    try:
+        records = load_records(args.file)
+    except FileNotFoundError:
+        print('No energy data recorded yet in ' + args.file)
+        return
+    report(records, args.capacity, args.days)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A stand-in for the PiSugar power manager that speaks the same line-based TCP protocol. Useful for trying out the
+PowerHelper on a machine without a PiSugar attached, e.g. "python3 -m power.fakepisugar 8423".
+"""
+
+import socketserver
+import threading
+import sys
+
+
+class FakePiSugarHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for raw in self.rfile:
+            command = raw.decode('utf-8').strip()
+            if not command:
+                continue
+            self.server.commands.append(command)
+            self.wfile.write((self.server.respond(command) + '\n').encode('utf-8'))
+
+
+class FakePiSugarServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, battery=85.0, charging=False):
+        super().__init__((host, port), FakePiSugarHandler)
+        self.battery = battery
+        self.charging = charging
+        self.alarm = None
+        self.commands = []  # every command received, in order
+
+    def respond(self, command):
+        if command == 'get battery':
+            return 'battery: {}'.format(self.battery)
+        elif command == 'get battery_charging':
+            return 'battery_charging: {}'.format(str(self.charging).lower())
+        elif command == 'rtc_rtc2pi':
+            return 'rtc_rtc2pi: done'
+        elif command == 'get rtc_alarm_time':
+            return 'rtc_alarm_time: {}'.format(self.alarm)
+        elif command.startswith('rtc_alarm_set '):
+            self.alarm = command.split()[1]
+            return 'rtc_alarm_set: done'
+        return 'Invalid request.'
+
+    def start(self):
+        # serve from a background thread, returns the port actually bound
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.server_address[1]
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8423
+    server = FakePiSugarServer(port=port)
+    print('Fake PiSugar server listening on port {}'.format(port))
+    server.serve_forever()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This is a native client for the TCP interface exposed by the PiSugar power manager (127.0.0.1:8423 by default). The
+server takes one command per line (e.g. "get battery") and answers each with one line of the form "battery: 85.2".
+A single connection is kept open, and multiple commands are written in one go so that all of them are answered within
+a single round trip, instead of spawning echo and nc for every command.
+"""
+
+import socket
+import threading
+import logging
+
+
+class PiSugarError(Exception):
+    # raised when the PiSugar server cannot be reached or returns something we cannot make sense of
+    pass
+
+
+class PiSugarConnectionClosed(PiSugarError):
+    # the server closed the connection, e.g. because it was restarted since the connection was opened
+    pass
+
+
+def parse_response(line):
+    # Responses are of the form "<key>: <value>", e.g. "battery: 85.2" or "rtc_alarm_set: done"
+    key, sep, value = line.partition(':')
+    if not sep:
+        raise PiSugarError('Invalid response from PiSugar: ' + repr(line))
+    return key.strip(), value.strip()
+
+
+def parse_bool(value):
+    if value.lower() in ('true', 'false'):
+        return value.lower() == 'true'
+    raise PiSugarError('Invalid boolean from PiSugar: ' + repr(value))
+
+
+class PiSugarClient:
+
+    def __init__(self, host='127.0.0.1', port=8423, timeout=2.0):
+        self.logger = logging.getLogger('maginkcal')
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self.buffer = b''
+        self.lock = threading.Lock()  # the connection may be shared by concurrent pipeline stages
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def connect(self):
+        if self.sock is None:
+            try:
+                self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            except OSError as e:
+                raise PiSugarError('Unable to connect to PiSugar server: {}'.format(e))
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.buffer = b''
+        return self.sock
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            finally:
+                self.sock = None
+                self.buffer = b''
+
+    def read_line(self):
+        while b'\n' not in self.buffer:
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise PiSugarConnectionClosed('Connection closed by PiSugar server')
+            self.buffer += chunk
+        line, _, self.buffer = self.buffer.partition(b'\n')
+        return line.decode('utf-8').strip()
+
+    def exchange(self, commands):
+        self.connect()
+        self.sock.sendall(''.join(cmd + '\n' for cmd in commands).encode('utf-8'))
+        return [parse_response(self.read_line()) for _ in commands]
+
+    def query(self, commands):
+        # Sends all commands in a single write and returns the parsed (key, value) responses in the same order.
+        # A stale connection (e.g. the server was restarted) is reopened once before giving up. A server that does
+        # not answer is not asked again, as that would only wait out the timeout a second time.
+        with self.lock:
+            try:
+                return self.exchange_or_close(commands)
+            except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError, PiSugarConnectionClosed) as e:
+                self.logger.info('PiSugar connection failed ({}), retrying'.format(e))
+            try:
+                return self.exchange_or_close(commands)
+            except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError) as e:
+                raise PiSugarError('Unable to talk to PiSugar server: {}'.format(e))
+
+    def exchange_or_close(self, commands):
+        # the connection is closed on any failure, as the responses may no longer line up with the commands
+        try:
+            return self.exchange(commands)
+        except socket.timeout:
+            self.close()
+            raise PiSugarError('Timed out waiting for PiSugar server')
+        except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError, PiSugarError):
+            self.close()
+            raise
+        except OSError as e:
+            self.close()
+            raise PiSugarError('Unable to talk to PiSugar server: {}'.format(e))
+
+    def get_status(self):
+        # battery level and charging state in one round trip
+        (_, battery), (_, charging) = self.query(['get battery', 'get battery_charging'])
+        try:
+            battery = float(battery)
+        except ValueError:
+            raise PiSugarError('Invalid battery level from PiSugar: ' + repr(battery))
+        return {'battery': battery, 'charging': parse_bool(charging)}
+
+    def get_battery(self):
+        (_, battery), = self.query(['get battery'])
+        try:
+            return float(battery)
+        except ValueError:
+            raise PiSugarError('Invalid battery level from PiSugar: ' + repr(battery))
+
+    def rtc_to_pi(self):
+        # sets the system time of the RPi from the PiSugar RTC
+        (_, result), = self.query(['rtc_rtc2pi'])
+        return result
+
+    def set_alarm(self, datetime, repeat=127):
+        # datetime must be timezone aware. repeat is a bitmask of weekdays (Sunday = bit 0), 127 for every day
+        (_, result), = self.query(['rtc_alarm_set {} {}'.format(datetime.isoformat(), repeat)])
+        return result
@@ -5,40 +5,54 @@ This script exposes the functions to interface with PiSugar. Mainly to retrieve
 to trigger the syncing of the PiSugar
 """
 
-import subprocess
+from power.pisugar import PiSugarClient, PiSugarError
 import logging
 
 class PowerHelper:
 
-    def __init__(self):
+    def __init__(self, host='127.0.0.1', port=8423, timeout=2.0):
         self.logger = logging.getLogger('maginkcal')
+        # a single connection to the PiSugar server is reused for all commands issued during a run
+        self.client = PiSugarClient(host, port, timeout)
 
     def get_battery(self):
-        # start displaying on eink display
-        # command = ['echo "get battery" | nc -q 0 127.0.0.1 8423']
         battery_float = -1
         try:
-            ps = subprocess.Popen(('echo', 'get battery'), stdout=subprocess.PIPE)
-            result = subprocess.check_output(('nc', '-q', '0', '127.0.0.1', '8423'), stdin=ps.stdout)
-            ps.wait()
-            result_str = result.decode('utf-8').rstrip()
-            battery_level = result_str.split()[-1]
-            battery_float = float(battery_level)
-            #battery_level = "{:.3f}".format(battery_float)
-        except (ValueError, subprocess.CalledProcessError) as e:
-            self.logger.info('Invalid battery output')
+            battery_float = self.client.get_battery()
+        except PiSugarError as e:
+            self.logger.info('Invalid battery output: {}'.format(e))
         return battery_float
 
+    def get_status(self):
+        # battery level and charging state retrieved in a single round trip
+        try:
+            return self.client.get_status()
+        except PiSugarError as e:
+            self.logger.info('Invalid battery output: {}'.format(e))
+        return {'battery': -1, 'charging': None}
+
     def set_next_boot_datetime(self, datetime):
-        # TODO: For directly scheduling next boot instead of using PiSugar's web interface
-        # Currently, it can be done manually through the PiSugar web interface
+        # Schedules the next boot through the PiSugar RTC alarm instead of using PiSugar's web interface.
+        # The alarm fires at a time of day on a set of weekdays (bitmask, Sunday = bit 0), so restricting it to the
+        # weekday of the given datetime lets us schedule up to a week ahead.
+        repeat = 1 << ((datetime.weekday() + 1) % 7)
+        try:
+            result = self.client.set_alarm(datetime, repeat)
+        except PiSugarError as e:
+            self.logger.info('Unable to set next boot time: {}'.format(e))
+            return False
+        if result != 'done':
+            self.logger.info('Unable to set next boot time: {}'.format(result))
+            return False
+        self.logger.info('Next boot set to {}'.format(datetime))
         return True
 
     def sync_time(self):
         # To sync PiSugar RTC with current time
         try:
-            ps = subprocess.Popen(('echo', 'rtc_rtc2pi'), stdout=subprocess.PIPE)
-            result = subprocess.check_output(('nc', '-q', '0', '127.0.0.1', '8423'), stdin=ps.stdout)
-            ps.wait()
-        except subprocess.CalledProcessError:
-            self.logger.info('Invalid time sync command')
\ No newline at end of file
+            self.client.rtc_to_pi()
+        except PiSugarError as e:
+            self.logger.info('Invalid time sync command: {}'.format(e))
+
+    def close(self):
+        self.client.close()
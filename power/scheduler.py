@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This works out when the RPi should next be woken up by the PiSugar RTC. Instead of waking up on a fixed schedule, the
+next wake is set to the earliest point in time at which the display content would change:
+- the day rollover, since the current date is highlighted and the calendar shifts by a week on the week start day
+- the moment a recently updated event stops being considered recently updated, since it turns from red to black
+Changes made remotely to the calendar cannot be predicted, so the interval between wakes is also capped at a configured
+maximum. When the battery is low, only the day rollover is considered.
+
+The state file keeps track of the signature of the content last pushed to the display, so that a wake which finds
+nothing changed can skip rendering and refreshing the panel altogether.
+"""
+
+import datetime as dt
+import json
+import pathlib
+import logging
+
+from pipeline.files import write_atomic
+
+
+class WakeScheduler:
+
+    def __init__(self, displayTZ, thresholdHours, wakeTime='06:00', maxIntervalHours=24, minIntervalMinutes=30,
+                 lowBatteryLevel=20, stateFile=None):
+        self.logger = logging.getLogger('maginkcal')
+        self.displayTZ = displayTZ
+        self.thresholdHours = thresholdHours
+        hour, minute = wakeTime.split(':')
+        self.wakeTime = dt.time(int(hour), int(minute))
+        # PiSugar alarms repeat weekly, so an alarm more than a week ahead cannot be expressed
+        self.maxInterval = min(dt.timedelta(hours=maxIntervalHours), dt.timedelta(days=6, hours=23))
+        self.minInterval = dt.timedelta(minutes=minIntervalMinutes)
+        self.lowBatteryLevel = lowBatteryLevel
+        if stateFile is None:
+            stateFile = str(pathlib.Path(__file__).parent.absolute()) + '/schedule.json'
+        self.stateFile = stateFile
+        self.state = self.load_state()
+
+    def load_state(self):
+        try:
+            with open(self.stateFile, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_state(self):
+        write_atomic(self.stateFile, json.dumps(self.state))
+
+    def is_content_changed(self, signature):
+        return self.state.get('signature') != signature
+
+    def record_refresh(self, signature):
+        self.state['signature'] = signature
+        self.save_state()
+
+    def is_scheduled_wake(self, currDatetime, tolerance=dt.timedelta(minutes=15)):
+        # checks if we were woken up by the alarm we scheduled, as opposed to being booted up manually for debugging
+        nextWake = self.state.get('nextWake')
+        if nextWake is None:
+            return False
+        return abs(currDatetime - dt.datetime.fromisoformat(nextWake)) <= tolerance
+
+    def get_rollover_wake(self, currDatetime):
+        # first occurrence of the daily wake time after the next midnight
+        nextDate = currDatetime.astimezone(self.displayTZ).date() + dt.timedelta(days=1)
+        return self.displayTZ.localize(dt.datetime.combine(nextDate, self.wakeTime))
+
+    def get_event_changes(self, currDatetime, eventList):
+        # points in time at which an event stops being highlighted as recently updated
+        changes = []
+        for event in eventList:
+            if event['isUpdated']:
+                changes.append(event['updatedDatetime'] + dt.timedelta(hours=self.thresholdHours))
+        return [change for change in changes if change > currDatetime]
+
+    def next_wake(self, currDatetime, eventList, batteryLevel):
+        isLowBattery = 0 <= batteryLevel < self.lowBatteryLevel
+        candidates = [self.get_rollover_wake(currDatetime)]
+        if not isLowBattery:
+            candidates += self.get_event_changes(currDatetime, eventList)
+        candidates.append(currDatetime + self.maxInterval)
+
+        nextWake = max(min(candidates), currDatetime + self.minInterval)
+        nextWake = nextWake.astimezone(self.displayTZ)
+        if nextWake.second or nextWake.microsecond:
+            # the RTC alarm has a resolution of one minute, round up so that we never wake before the change
+            nextWake = nextWake.replace(second=0, microsecond=0) + dt.timedelta(minutes=1)
+        self.logger.info('Next wake scheduled for {}{}'.format(nextWake, ' (low battery)' if isLowBattery else ''))
+        self.state['nextWake'] = nextWake.isoformat()
+        self.save_state()
+        return nextWake
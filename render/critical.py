@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Builds render/calendar_inline.html, a copy of calendar_template.html with a single inlined stylesheet that only keeps
+the CSS rules the calendar can use, and with the battery sprite embedded as a data URI. The template links the whole
+of bootstrap.min.css for a handful of utility classes, so without this Chromium parses thousands of unused rules and
+fetches the stylesheets and the image on every render.
+
+The classes, elements and attributes in use are collected from the HTML that RenderHelper.generate_html produces for
+a sample calendar that goes through each of its branches (today, days of other months, updated events, '+X more'),
+with each battery icon. A selector is kept when all of the classes, ids, element names and attributes it mentions are
+in use, in the manner of PurgeCSS: pseudo-classes are assumed to match. @media and @supports blocks keep the rules of
+theirs that are used (except @media print), @font-face and @keyframes are kept if the kept rules refer to them, and
+any other at-rule is dropped. The rules stay in their original order, so the cascade is unchanged.
+
+Selected with "isInlineCss": true in config.json. The inlined template is rebuilt whenever it is older than the
+template, stylesheets, battery sprite or the code that emits the HTML. It can also be built ahead of time, and the
+time Chromium takes from loading the page to the screenshot compared for both templates:
+
+python3 -m render.critical                        # build the inlined template
+python3 -m render.critical --measure 20           # and time 20 screenshots of each template
+"""
+
+import datetime as dt
+import base64
+import re
+import os
+import logging
+
+from pipeline.files import write_atomic
+
+TEMPLATE_NAME = 'calendar_template.html'
+INLINE_TEMPLATE_NAME = 'calendar_inline.html'
+STYLESHEET_PATTERN = re.compile(r'[ \t]*<link rel="stylesheet" href="([^"]+)">\n?')
+IMAGE_PATTERN = re.compile(r'src="([^"]+\.png)"')
+CONTAINER_RULES = ('@media', '@supports')  # at-rules whose blocks hold rules, purged like the top level
+SOURCES = (TEMPLATE_NAME, 'bootstrap.min.css', 'styles.css', 'battery.png', 'render.py', 'critical.py')
+
+
+def strip_comments(css):
+    return re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+
+
+def split_rules(css):
+    # Returns the top level rules as (prelude, block) pairs, e.g. ('.month', 'font-size: 13rem;'). At-rules without
+    # a block, e.g. @charset, are left out.
+    rules = []
+    start = 0
+    i = 0
+    while i < len(css):
+        char = css[i]
+        if char in '"\'':
+            i = css.index(char, i + 1)
+        elif char == ';' and css[start:i].lstrip().startswith('@'):
+            start = i + 1
+        elif char == '{':
+            depth = 1
+            blockStart = i + 1
+            while depth:
+                i += 1
+                if css[i] in '"\'':
+                    i = css.index(css[i], i + 1)
+                elif css[i] == '{':
+                    depth += 1
+                elif css[i] == '}':
+                    depth -= 1
+            rules.append((css[start:blockStart - 1].strip(), css[blockStart:i]))
+            start = i + 1
+        i += 1
+    return rules
+
+
+def split_selectors(prelude):
+    # splits a selector list on the commas that are not within brackets, e.g. of :not(a, b)
+    selectors = []
+    depth = 0
+    start = 0
+    for i, char in enumerate(prelude):
+        if char in '([':
+            depth += 1
+        elif char in ')]':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            selectors.append(prelude[start:i].strip())
+            start = i + 1
+    selectors.append(prelude[start:].strip())
+    return [selector for selector in selectors if selector]
+
+
+def is_selector_used(selector, used):
+    # used: {'classes', 'ids', 'elements', 'attributes'} -> sets of names
+    attributes = re.findall(r'\[\s*([\w-]+)', selector)
+    selector = re.sub(r'\[[^\]]*\]', ' ', selector)
+    selector = re.sub(r'::?[\w-]+\([^)]*\)', ' ', selector)  # e.g. :not(.disabled), :nth-child(n+29)
+    selector = re.sub(r'::?[\w-]+', ' ', selector)
+    classes = re.findall(r'\.([\w-]+)', selector)
+    ids = re.findall(r'#([\w-]+)', selector)
+    elements = re.findall(r'(?:^|[\s>+~])([a-zA-Z][\w-]*)', re.sub(r'[.#][\w-]+', ' ', selector))
+    return (all(name in used['attributes'] for name in attributes) and
+            all(name in used['classes'] for name in classes) and
+            all(name in used['ids'] for name in ids) and
+            all(name.lower() in used['elements'] for name in elements))
+
+
+def compact(block):
+    return ' '.join(line.strip() for line in block.splitlines() if line.strip())
+
+
+def purge_rules(rules, used):
+    # Returns the kept rules as (kind, name, text), kind being 'rule', 'font-face' or 'keyframes', so that the rules
+    # the kept ones refer to can be picked out afterwards
+    kept = []
+    for prelude, block in rules:
+        if prelude.startswith('@media print'):
+            continue  # never applies to a screenshot
+        if prelude.startswith(CONTAINER_RULES):
+            inner = purge_rules(split_rules(block), used)
+            if inner:
+                kept.append(('rule', None, prelude + '{' + '\n'.join(text for kind, name, text in inner) + '}'))
+        elif prelude.startswith('@font-face'):
+            family = re.search(r'font-family\s*:\s*["\']?([^;"\']+)', block)
+            family = family.group(1).strip() if family else None
+            kept.append(('font-face', family, prelude + '{' + compact(block) + '}'))
+        elif re.match(r'@(-[\w]+-)?keyframes', prelude):
+            kept.append(('keyframes', prelude.split()[-1], prelude + '{' + compact(block) + '}'))
+        elif not prelude.startswith('@'):
+            selectors = [selector for selector in split_selectors(prelude) if is_selector_used(selector, used)]
+            if selectors:
+                kept.append(('rule', None, ','.join(selectors) + '{' + compact(block) + '}'))
+    return kept
+
+
+def purge_css(css, used):
+    # Returns the rules of the stylesheet that the calendar can use, one per line
+    kept = purge_rules(split_rules(strip_comments(css)), used)
+    styleText = '\n'.join(text for kind, name, text in kept if kind == 'rule')
+    return '\n'.join(text for kind, name, text in kept
+                     if kind == 'rule' or (name is not None and re.search(r'\b' + re.escape(name) + r'\b', styleText)))
+
+
+def collect_used(html):
+    used = {'classes': set(), 'ids': set(), 'elements': set(), 'attributes': set()}
+    for classNames in re.findall(r'class="([^"]*)"', html):
+        used['classes'].update(classNames.split())
+    used['ids'].update(re.findall(r'id="([^"]*)"', html))
+    used['elements'].update(name.lower() for name in re.findall(r'<([a-zA-Z][\w-]*)', html))
+    for tag in re.findall(r'<[a-zA-Z][^>]*>', html):
+        used['attributes'].update(re.findall(r'\s([\w-]+)=', tag))
+    return used
+
+
+def make_sample_cal_dicts():
+    # Calendars that go through every branch of generate_html, with each battery icon
+    today = dt.date(2024, 5, 15)
+    calStartDate = dt.date(2024, 4, 28)
+
+    def make_event(summary, start, end, allday=False, isUpdated=False, isMultiday=False):
+        return {'summary': summary, 'startDatetime': start, 'endDatetime': end, 'allday': allday,
+                'isUpdated': isUpdated, 'isMultiday': isMultiday}
+
+    def at(day, hour):
+        return dt.datetime.combine(day, dt.time(hour))
+    events = [make_event('Other month', at(dt.date(2024, 4, 29), 9), at(dt.date(2024, 4, 29), 10)),
+              make_event('Updated', at(today, 9), at(today, 10), isUpdated=True),
+              make_event('All day', at(today, 0), at(today + dt.timedelta(days=1), 0), allday=True),
+              make_event('Multiday', at(dt.date(2024, 5, 20), 8), at(dt.date(2024, 5, 22), 8), isMultiday=True)]
+    events += [make_event('Busy {}'.format(i), at(dt.date(2024, 5, 20), 9 + i), at(dt.date(2024, 5, 20), 10 + i))
+               for i in range(4)]
+    calDict = {'events': events, 'calStartDate': calStartDate, 'today': today, 'lastRefresh': at(today, 6),
+               'batteryLevel': 100, 'batteryDisplayMode': 0, 'dayOfWeekText': ['M', 'T', 'W', 'T', 'F', 'S', 'S'],
+               'weekStartDay': 6, 'maxEventsPerDay': 3, 'is24hour': False}
+    calDicts = [calDict]
+    for batteryLevel in (100, 70, 50, 30, 10):
+        calDicts.append(dict(calDict, batteryLevel=batteryLevel, batteryDisplayMode=1))
+    return calDicts
+
+
+def to_data_uri(path):
+    with open(path, 'rb') as f:
+        return 'data:image/png;base64,' + base64.b64encode(f.read()).decode('ascii')
+
+
+def get_inline_template_file(currPath):
+    return os.path.join(currPath, INLINE_TEMPLATE_NAME)
+
+
+def is_stale(currPath):
+    try:
+        builtTime = os.path.getmtime(get_inline_template_file(currPath))
+    except OSError:
+        return True
+    return any(os.path.getmtime(os.path.join(currPath, name)) > builtTime for name in SOURCES)
+
+
+def build_inline_template(renderService):
+    # Writes the inlined template next to the original, and returns its path
+    currPath = renderService.currPath
+    with open(os.path.join(currPath, TEMPLATE_NAME), 'r') as f:
+        template = f.read()
+    sampleHtml = ''.join(renderService.generate_html(calDict, template=template)
+                         for calDict in make_sample_cal_dicts())
+    used = collect_used(sampleHtml)
+    used['elements'].add('style')
+
+    stylesheets = STYLESHEET_PATTERN.findall(template)
+    purged = []
+    for name in stylesheets:
+        with open(os.path.join(currPath, name), 'r') as f:
+            purged.append(purge_css(f.read(), used))
+    # the template goes through str.format, so the braces of the stylesheet are doubled up
+    style = '\n'.join(purged).replace('{', '{{').replace('}', '}}')
+    styleTag = '    <style>\n' + style + '\n    </style>\n'
+    parts = STYLESHEET_PATTERN.split(template)
+    # split() leaves the href of each link in between the rest of the template: the first becomes the stylesheet
+    inlined = parts[0] + styleTag + ''.join(parts[2::2])
+    inlined = IMAGE_PATTERN.sub(lambda m: 'src="{}"'.format(to_data_uri(os.path.join(currPath, m.group(1)))), inlined)
+
+    path = get_inline_template_file(currPath)
+    write_atomic(path, inlined)  # farm workers may be building it at the same time
+    logging.getLogger('maginkcal').info('Inlined {} stylesheets into {} ({} bytes of CSS kept)'.format(
+        len(stylesheets), INLINE_TEMPLATE_NAME, len(style)))
+    return path
+
+
+def measure(renderService, calDict, count):
+    # Returns the median time to load the page and take a screenshot, in seconds, for each template
+    import statistics
+    import time
+    timings = {False: [], True: []}
+    renderService.isPersistentBrowser = True
+    try:
+        for i in range(count):
+            for isInlineCss in (False, True):
+                renderService.isInlineCss = isInlineCss
+                html = renderService.generate_html(calDict)
+                renderService.close_browser()  # a fresh page each time, as for a render after a wake
+                renderService.start_browser()
+                start = time.perf_counter()
+                renderService.take_screenshot(html)
+                timings[isInlineCss].append(time.perf_counter() - start)
+    finally:
+        renderService.close_browser()
+    return {isInlineCss: statistics.median(values) for isInlineCss, values in timings.items()}
+
+
+def main():
+    import argparse
+    import json
+    from render.render import RenderHelper
+
+    parser = argparse.ArgumentParser(description='Build the calendar template with an inlined, purged stylesheet.')
+    parser.add_argument('--measure', type=int, default=0, metavar='COUNT',
+                        help='time COUNT screenshots with each template')
+    parser.add_argument('--backend', default='devtools', choices=['browser', 'devtools'],
+                        help='how the screenshots are taken')
+    parser.add_argument('--config', default='config.json', help='config file for the image size')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s - %(message)s')
+    logging.getLogger('maginkcal').setLevel(logging.INFO)
+
+    with open(args.config) as f:
+        config = json.load(f)
+    renderService = RenderHelper(config['imageWidth'], config['imageHeight'], config['rotateAngle'])
+    renderService.backend = args.backend
+    path = build_inline_template(renderService)
+
+    currPath = renderService.currPath
+    with open(os.path.join(currPath, TEMPLATE_NAME), 'r') as f:
+        linked = [os.path.join(currPath, name) for name in STYLESHEET_PATTERN.findall(f.read())]
+    before = sum(os.path.getsize(name) for name in linked) + os.path.getsize(os.path.join(currPath, 'battery.png'))
+    print('{} stylesheets and battery.png ({} bytes in {} files) inlined into {} ({} bytes)'.format(
+        len(linked), before, len(linked) + 1, path, os.path.getsize(path)))
+
+    if args.measure:
+        timings = measure(renderService, make_sample_cal_dicts()[1], args.measure)
+        print('Page load to screenshot, median of {}: {:.3f}s linked, {:.3f}s inlined ({:+.1%})'.format(
+            args.measure, timings[False], timings[True], (timings[True] - timings[False]) / timings[False]))
+
+
+if __name__ == '__main__':
+    main()
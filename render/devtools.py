@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Drives headless Chromium directly over the DevTools protocol, as a lighter alternative to Selenium. Selenium talks to
+the browser through a separate chromedriver process, with an HTTP round trip per WebDriver command, and sizing the
+viewport takes a few more of them plus a window resize. Here the browser is started with remote debugging enabled and
+commands are sent over a single websocket to its page: the viewport is set with a device metrics override, and the
+screenshot is clipped to the size of the image.
+
+Selected with "renderBackend": "devtools" in config.json. Needs websocket-client, which is installed with selenium.
+"""
+
+from urllib.request import urlopen
+import subprocess
+import tempfile
+import base64
+import shutil
+import json
+import time
+import os
+import logging
+
+# resolves once the page written into the browser has loaded, including its stylesheets and fonts
+WAIT_FOR_PAGE_EXPRESSION = '''
+new Promise(function (resolve) {
+    function check() {
+        if (document.readyState === 'complete') {
+            document.fonts.ready.then(function () { resolve(true); });
+        } else {
+            setTimeout(check, 10);
+        }
+    }
+    check();
+})
+'''
+
+
+class DevToolsError(Exception):
+    pass
+
+
+class DevToolsBrowser:
+
+    def __init__(self, chromePath, width, height, timeout=60):
+        self.logger = logging.getLogger('maginkcal')
+        self.chromePath = chromePath
+        self.width = width
+        self.height = height
+        self.timeout = timeout
+        self.process = None
+        self.userDataDir = None
+        self.ws = None
+        self.lastId = 0
+        self.events = []  # events received while waiting for the response to a command
+        self.currentUrl = None
+
+    def launch(self):
+        import websocket
+        self.userDataDir = tempfile.mkdtemp(prefix='maginkcal-chromium-')
+        # port 0 lets Chromium pick a free port, which it writes to DevToolsActivePort in the profile folder
+        self.process = subprocess.Popen(
+            [self.chromePath, '--headless', '--hide-scrollbars', '--no-sandbox', '--disable-dev-shm-usage',
+             '--force-device-scale-factor=1', '--remote-debugging-port=0', '--user-data-dir=' + self.userDataDir,
+             'about:blank'],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            port = self.wait_for_port()
+            with urlopen('http://127.0.0.1:{}/json/list'.format(port), timeout=self.timeout) as response:
+                targets = json.load(response)
+            pages = [target for target in targets if target.get('type') == 'page']
+            if not pages:
+                raise DevToolsError('No page to attach to')
+            # no Origin header, which Chromium would otherwise reject without --remote-allow-origins
+            self.ws = websocket.create_connection(pages[0]['webSocketDebuggerUrl'], timeout=self.timeout,
+                                                  suppress_origin=True)
+            self.send('Page.enable')
+            self.send('Emulation.setDeviceMetricsOverride', width=self.width, height=self.height,
+                      deviceScaleFactor=1, mobile=False)
+        except Exception:
+            self.kill()
+            raise
+
+    def wait_for_port(self):
+        portFile = os.path.join(self.userDataDir, 'DevToolsActivePort')
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise DevToolsError('Chromium exited with code {}'.format(self.process.returncode))
+            try:
+                with open(portFile, 'r') as f:
+                    lines = f.read().splitlines()
+                if lines and lines[0].isdigit():
+                    return int(lines[0])
+            except OSError:
+                pass
+            time.sleep(0.05)
+        raise DevToolsError('Chromium did not open its DevTools port')
+
+    def send(self, method, **params):
+        # Sends a command and returns its result, keeping the events that arrive in the meantime
+        self.lastId += 1
+        self.ws.send(json.dumps({'id': self.lastId, 'method': method, 'params': params}))
+        while True:
+            message = json.loads(self.ws.recv())
+            if message.get('id') == self.lastId:
+                if 'error' in message:
+                    raise DevToolsError('{} failed: {}'.format(method, message['error'].get('message')))
+                return message.get('result', {})
+            if 'method' in message:
+                self.events.append(message)
+
+    def wait_for_event(self, method):
+        for i, event in enumerate(self.events):
+            if event['method'] == method:
+                del self.events[i]
+                return event.get('params', {})
+        while True:
+            message = json.loads(self.ws.recv())
+            if message.get('method') == method:
+                return message.get('params', {})
+
+    def evaluate(self, expression, awaitPromise=False):
+        result = self.send('Runtime.evaluate', expression=expression, awaitPromise=awaitPromise, returnByValue=True)
+        if 'exceptionDetails' in result:
+            raise DevToolsError('Script failed: {}'.format(result['exceptionDetails'].get('text')))
+        return result.get('result', {}).get('value')
+
+    def navigate(self, url):
+        self.events.clear()
+        result = self.send('Page.navigate', url=url)
+        if result.get('errorText'):
+            raise DevToolsError('Unable to load {}: {}'.format(url, result['errorText']))
+        self.wait_for_event('Page.loadEventFired')
+        self.currentUrl = url
+
+    def write_page(self, baseUrl, html):
+        # Writes the HTML into the page at baseUrl, so that the assets it refers to resolve relative to it
+        if self.currentUrl != baseUrl:
+            self.navigate(baseUrl)
+        self.evaluate('document.open(); document.write({}); document.close();'.format(json.dumps(html)))
+        self.evaluate(WAIT_FOR_PAGE_EXPRESSION, awaitPromise=True)
+
+    def screenshot(self):
+        # returns a PNG screenshot of the viewport
+        result = self.send('Page.captureScreenshot', format='png', captureBeyondViewport=False,
+                           clip={'x': 0, 'y': 0, 'width': self.width, 'height': self.height, 'scale': 1})
+        return base64.b64decode(result['data'])
+
+    def quit(self):
+        try:
+            if self.ws is not None:
+                try:
+                    self.send('Browser.close')
+                except Exception:
+                    pass  # the connection drops as the browser closes
+            if self.process is not None:
+                try:
+                    self.process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    self.process.kill()
+                    self.process.wait()
+        finally:
+            self.cleanup()
+
+    def kill(self):
+        # Stops the browser without waiting on it, e.g. when it stopped responding
+        try:
+            if self.process is not None and self.process.poll() is None:
+                self.process.kill()
+                self.process.wait()
+        finally:
+            self.cleanup()
+
+    def cleanup(self):
+        if self.ws is not None:
+            try:
+                self.ws.close()
+            except Exception:
+                pass
+            self.ws = None
+        self.process = None
+        if self.userDataDir is not None:
+            shutil.rmtree(self.userDataDir, ignore_errors=True)
+            self.userDataDir = None
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Draws the calendar straight into the black and red planes with PIL, as an alternative to rendering the HTML template in
+headless Chromium. The layout follows calendar_template.html and styles.css (1rem = 16px), and all the text is drawn
+from glyph atlases (see render/glyphs.py), so that no browser has to be started and no screenshot has to be split into
+its colours. Ink is dark on both planes: black text is drawn on the black plane, red text on the red plane.
+
+The calendar is drawn in two layers. The background (month, day names, dates and today's circle) depends only on the
+date and is kept between renders, while the events and battery icon are drawn onto a copy of it on every render.
+"""
+
+from render.glyphs import GlyphAtlas, PRELOAD
+from PIL import Image, ImageDraw
+from datetime import timedelta
+import string
+
+WHITE = 255
+BLACK = 0
+MUTED = 108  # #6c757d, dithered when the planes are packed, like the screenshot of the HTML template
+PADDING = 16
+MONTH_SIZE = 208
+DAY_NAME_SIZE = 56
+DAY_NAME_TOP = 16  # margin above the day names
+DAY_NAME_HEIGHT = 67
+DAYS = 35  # 5 weeks
+DAYS_TOP = 355  # top of the first week, below the month and day names
+DAY_HEIGHT = 184
+DATE_SIZE = 48
+DATE_TOP = 8
+CIRCLE_SIZE = 64  # today's circle sits at the top of the cell, like .datecircle, clear of the events
+EVENT_SIZE = 16
+EVENT_TOP = 64  # below the date
+EVENT_HEIGHT = 28
+EVENT_PADDING = 2
+BATTERY_BOX = (925, 5, 53, 27)  # left, top, width, height of the battery icon
+BATTERY_OFFSETS = {'battery80': 0, 'battery60': 44, 'battery40': 89, 'battery20': 134, 'battery0': 178}
+# Quattrocento has no arrows, the browser falls back to another font for these
+SUBSTITUTES = str.maketrans({'►': '»', '◄': '«'})
+
+
+class CalendarDrawer:
+
+    def __init__(self, width, height, angle, currPath):
+        self.imageWidth = width
+        self.imageHeight = height
+        self.rotateAngle = angle
+        self.currPath = currPath
+        self.atlases = {}
+        self.batteryImage = None
+        self.background = None  # (key, (black, red)) of the background planes last drawn
+
+    def get_atlas(self, fontName, size, preload=PRELOAD):
+        key = (fontName, size)
+        if key not in self.atlases:
+            self.atlases[key] = GlyphAtlas('{}/{}.ttf'.format(self.currPath, fontName), size, preload)
+        return self.atlases[key]
+
+    def save_atlases(self):
+        # keeps glyphs that had to be rasterised during this render for the next one
+        for atlas in self.atlases.values():
+            if atlas.isDirty:
+                atlas.save()
+
+    def close(self):
+        for atlas in self.atlases.values():
+            atlas.close()
+        self.atlases.clear()
+
+    def draw_centred(self, image, atlas, text, left, width, top, fill):
+        x = left + (width - atlas.get_width(text)) / 2
+        atlas.draw_text(image, (x, top), text, fill)
+
+    def draw_battery(self, blackImage, redImage, battText):
+        if battText not in BATTERY_OFFSETS:
+            return
+        if self.batteryImage is None:
+            self.batteryImage = Image.open(self.currPath + '/battery.png').convert('RGBA')
+        left, top, width, height = BATTERY_BOX
+        offset = BATTERY_OFFSETS[battText]
+        sprite = self.batteryImage.crop((0, offset, width, offset + height))
+        # the icon is split into its black and red portions, the same way as the screenshot
+        for x in range(width):
+            for y in range(height):
+                r, g, b, a = sprite.getpixel((x, y))
+                if a < 128:
+                    continue
+                if r > g and r > b:
+                    redImage.putpixel((left + x, top + y), BLACK)
+                else:
+                    blackImage.putpixel((left + x, top + y), min(r, g, b))
+
+    def get_background(self, calDict):
+        # The month, day names, dates and today's circle only change with the date, so they are drawn once and reused
+        # (e.g. by the daemon, or by the fallback of a run that already drew them) until the date changes
+        key = (calDict['today'], calDict['calStartDate'], calDict['weekStartDay'], tuple(calDict['dayOfWeekText']),
+               self.imageWidth, self.imageHeight)
+        if self.background is None or self.background[0] != key:
+            self.background = (key, self.draw_background(calDict))
+        return self.background[1]
+
+    def draw_background(self, calDict):
+        blackImage = Image.new('L', (self.imageWidth, self.imageHeight), WHITE)
+        redImage = Image.new('L', (self.imageWidth, self.imageHeight), WHITE)
+        redDraw = ImageDraw.Draw(redImage)
+        columnWidth = (self.imageWidth - 2 * PADDING) / 7
+        today = calDict['today']
+
+        monthAtlas = self.get_atlas('Quattrocento-Regular', MONTH_SIZE, string.digits)
+        monthTop = PADDING + (MONTH_SIZE - monthAtlas.ascent - monthAtlas.descent) // 2
+        self.draw_centred(blackImage, monthAtlas, str(today.month).upper(), 0, self.imageWidth, monthTop, BLACK)
+
+        dayNameAtlas = self.get_atlas('Quattrocento-Regular', DAY_NAME_SIZE, string.ascii_uppercase)
+        dayNameTop = PADDING + MONTH_SIZE + DAY_NAME_TOP
+        for i in range(7):
+            text = calDict['dayOfWeekText'][(i + calDict['weekStartDay']) % 7].upper()
+            self.draw_centred(blackImage, dayNameAtlas, text, PADDING + i * columnWidth, columnWidth, dayNameTop, BLACK)
+
+        dateAtlas = self.get_atlas('Quattrocento-Bold', DATE_SIZE, string.digits)
+        for i in range(DAYS):
+            currDate = calDict['calStartDate'] + timedelta(days=i)
+            left = PADDING + (i % 7) * columnWidth
+            top = DAYS_TOP + (i // 7) * DAY_HEIGHT
+            dateText = str(currDate.day)
+            if currDate == today:
+                circleLeft = round(left + (columnWidth - CIRCLE_SIZE) / 2)
+                redDraw.ellipse((circleLeft, top, circleLeft + CIRCLE_SIZE - 1, top + CIRCLE_SIZE - 1), fill=BLACK)
+                self.draw_centred(redImage, dateAtlas, dateText, left, columnWidth,
+                                  top + (CIRCLE_SIZE - dateAtlas.ascent - dateAtlas.descent) // 2, WHITE)
+            else:
+                self.draw_centred(blackImage, dateAtlas, dateText, left, columnWidth, top + DATE_TOP,
+                                  MUTED if currDate.month != today.month else BLACK)
+        return blackImage, redImage
+
+    def draw(self, calDict, calList, battText, get_event_text):
+        # Returns the black and red images, rotated to fit the screen like the screenshot would be. The events and
+        # battery icon are drawn straight onto a copy of the background planes.
+        blackBackground, redBackground = self.get_background(calDict)
+        blackImage = blackBackground.copy()
+        redImage = redBackground.copy()
+        self.draw_battery(blackImage, redImage, battText)
+
+        columnWidth = (self.imageWidth - 2 * PADDING) / 7
+        eventAtlas = self.get_atlas('Quattrocento-Regular', EVENT_SIZE)
+        maxEventsPerDay = calDict['maxEventsPerDay']
+        textWidth = columnWidth - 2 * EVENT_PADDING
+        for i in range(len(calList)):
+            currDate = calDict['calStartDate'] + timedelta(days=i)
+            left = PADDING + (i % 7) * columnWidth
+            eventTop = DAYS_TOP + (i // 7) * DAY_HEIGHT + EVENT_TOP
+            isOtherMonth = currDate.month != calDict['today'].month
+            for event in calList[i][:maxEventsPerDay]:
+                text = eventAtlas.fit_text(get_event_text(event, currDate).translate(SUBSTITUTES), textWidth)
+                if event['isUpdated']:
+                    eventAtlas.draw_text(redImage, (left + EVENT_PADDING, eventTop), text, BLACK)
+                else:
+                    eventAtlas.draw_text(blackImage, (left + EVENT_PADDING, eventTop), text,
+                                         MUTED if isOtherMonth else BLACK)
+                eventTop += EVENT_HEIGHT
+            if len(calList[i]) > maxEventsPerDay:
+                text = '{} more'.format(len(calList[i]) - maxEventsPerDay)
+                eventAtlas.draw_text(blackImage, (left + EVENT_PADDING, eventTop), text, MUTED)
+
+        self.save_atlases()
+        return blackImage.rotate(self.rotateAngle, expand=True), redImage.rotate(self.rotateAngle, expand=True)
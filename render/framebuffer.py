@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A compact binary format for the two 1bpp planes of the 12.48" panel, so that a display node only has to fetch a frame
+and upload its bytes to the panel, without a browser or any image processing. The planes are packed exactly the way the
+EPD driver sends them: one bit per pixel, MSB first, 163 bytes per row, already split into the four quadrants of the
+panel (S2, M2, M1, S1, in the order they are uploaded) with the red plane inverted.
+
+Layout (little endian):
+    header:  magic 'MKFB' | version (uint8) | bytes per row (uint16) | rows (uint16) | section count (uint8)
+    section: quadrant (uint8, index into QUADRANTS) | command (uint8, 0x10 black / 0x13 red) | length (uint32)
+             followed by length bytes of PackBits compressed data
+
+PackBits is the run-length scheme used by TIFF and MacPaint, which is a few lines of C on an ESP32: a header byte n of
+0-127 is followed by n+1 literal bytes, a header byte of 129-255 is followed by a single byte to be repeated 257-n times.
+"""
+
+import hashlib
+import struct
+import re
+
+MAGIC = b'MKFB'
+VERSION = 1
+HEADER = struct.Struct('<4sBHHB')
+SECTION = struct.Struct('<BBI')
+ROW_BYTES = 163
+ROWS = 984
+# name, first row, last row (exclusive), first byte, last byte (exclusive)
+QUADRANTS = (('S2', 0, 492, 0, 81), ('M2', 0, 492, 81, 163), ('M1', 492, 984, 0, 81), ('S1', 492, 984, 81, 163))
+BLACK_COMMAND = 0x10
+RED_COMMAND = 0x13
+
+RUN_PATTERN = re.compile(rb'(.)\1{2,}', re.DOTALL)  # runs of 3 or more identical bytes
+
+
+def pack_plane(image, isInverted=False):
+    # Packs an image into a 1bpp buffer with white as 1, the same as EPD.getbuffer
+    plane = image.convert('1')
+    if plane.size != (ROW_BYTES * 8, ROWS):
+        raise ValueError('Expected a {}x{} image, got {}x{}'.format(ROW_BYTES * 8, ROWS, *plane.size))
+    buf = plane.tobytes()
+    if isInverted:
+        buf = bytes(b ^ 0xFF for b in buf)
+    return buf
+
+
+def split_quadrants(buf):
+    # returns the bytes of each quadrant, in the order of QUADRANTS
+    return [b''.join(buf[y * ROW_BYTES + x0:y * ROW_BYTES + x1] for y in range(y0, y1))
+            for name, y0, y1, x0, x1 in QUADRANTS]
+
+
+def packbits(data):
+    out = bytearray()
+
+    def literal(chunk):
+        for i in range(0, len(chunk), 128):
+            part = chunk[i:i + 128]
+            out.append(len(part) - 1)
+            out.extend(part)
+
+    pos = 0
+    for match in RUN_PATTERN.finditer(data):
+        literal(data[pos:match.start()])
+        length = match.end() - match.start()
+        while length > 0:
+            count = min(length, 128)
+            if count < 3:
+                literal(data[match.end() - length:match.end()])
+                break
+            out.append(257 - count)
+            out.append(data[match.start()])
+            length -= count
+        pos = match.end()
+    literal(data[pos:])
+    return bytes(out)
+
+
+def unpackbits(data):
+    out = bytearray()
+    i = 0
+    while i < len(data):
+        header = data[i]
+        i += 1
+        if header < 128:
+            out.extend(data[i:i + header + 1])
+            i += header + 1
+        elif header > 128:
+            out.extend(data[i:i + 1] * (257 - header))
+            i += 1
+    return bytes(out)
+
+
+def encode_frame(blackImage, redImage):
+    # Packs, splits and compresses the black and red images into a single frame
+    sections = []
+    for command, buf in ((BLACK_COMMAND, pack_plane(blackImage)), (RED_COMMAND, pack_plane(redImage, True))):
+        for quadrant, data in enumerate(split_quadrants(buf)):
+            sections.append((quadrant, command, data))
+    # upload order of the driver: black then red, one quadrant at a time
+    sections.sort(key=lambda s: (s[0], s[1]))
+    return encode_sections(sections)
+
+
+def encode_sections(sections):
+    frame = bytearray(HEADER.pack(MAGIC, VERSION, ROW_BYTES, ROWS, len(sections)))
+    for quadrant, command, data in sections:
+        compressed = packbits(data)
+        frame.extend(SECTION.pack(quadrant, command, len(compressed)))
+        frame.extend(compressed)
+    return bytes(frame)
+
+
+def decode_frame(frame):
+    # Returns a list of (quadrant name, command, data) in upload order
+    if len(frame) < HEADER.size:
+        raise ValueError('Frame is too short')
+    magic, version, rowBytes, rows, count = HEADER.unpack_from(frame)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Unsupported frame format')
+    if (rowBytes, rows) != (ROW_BYTES, ROWS):
+        raise ValueError('Frame is for a {}x{} panel'.format(rowBytes * 8, rows))
+    sections = []
+    offset = HEADER.size
+    for _ in range(count):
+        quadrant, command, length = SECTION.unpack_from(frame, offset)
+        offset += SECTION.size
+        name, y0, y1, x0, x1 = QUADRANTS[quadrant]
+        data = unpackbits(frame[offset:offset + length])
+        if len(data) != (y1 - y0) * (x1 - x0):
+            raise ValueError('Section {} {:#x} is corrupt'.format(name, command))
+        sections.append((name, command, data))
+        offset += length
+    return sections
+
+
+def decode_planes(frame):
+    # Returns the planes of a frame as 1bpp images of the whole panel, {command: image}, the red plane still inverted
+    from PIL import Image
+    quadrants = {name: (y0, x0, x1) for name, y0, y1, x0, x1 in QUADRANTS}
+    planes = {}
+    for name, command, data in decode_frame(frame):
+        y0, x0, x1 = quadrants[name]
+        if command not in planes:
+            planes[command] = Image.new('1', (ROW_BYTES * 8, ROWS), 0)
+        section = Image.frombytes('1', ((x1 - x0) * 8, len(data) // (x1 - x0)), data)
+        planes[command].paste(section, (x0 * 8, y0))
+    return planes
+
+
+def get_etag(frame):
+    return '"{}"'.format(hashlib.sha1(frame).hexdigest())
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A cache of pre-rasterised glyphs, so that text is drawn by pasting small bitmaps instead of rasterising every character
+of every event with FreeType on each render. Glyphs are rasterised once per font and size and kept in an atlas file
+next to the font (e.g. render/Quattrocento-Regular-16.atlas), which is memory-mapped when loaded, so the bitmaps are
+paged in from disk as needed rather than read and copied up front. The atlas records a hash of the font it was made from
+and is rebuilt when the font changes. Characters missing from the atlas (e.g. accented letters in an event summary) are
+rasterised when first drawn and added the next time the atlas is saved.
+
+Layout (little endian):
+    header: magic 'MKGA' | version (uint8) | sha1 of the font file (20 bytes) | size (uint16) | ascent (int16) |
+            descent (int16) | glyph count (uint32)
+    entry:  code point (uint32) | offset (uint32) | width (uint16) | height (uint16) | left (int16) | top (int16) |
+            advance (float32)
+    followed by the 8 bit coverage bitmaps of all glyphs, width x height bytes each, at their offsets
+"""
+
+from PIL import Image, ImageDraw, ImageFont
+import hashlib
+import string
+import struct
+import mmap
+import os
+
+from pipeline.files import write_atomic
+
+MAGIC = b'MKGA'
+VERSION = 1
+HEADER = struct.Struct('<4sB20sHhhI')
+ENTRY = struct.Struct('<IIHHhhf')
+# rasterised up front, covers dates, weekdays, times and most event summaries
+PRELOAD = string.ascii_letters + string.digits + string.punctuation + ' «»…'
+
+
+class GlyphAtlas:
+
+    def __init__(self, fontPath, size, preload=PRELOAD, atlasFile=None):
+        self.fontPath = fontPath
+        self.size = size
+        if atlasFile is None:
+            atlasFile = '{}-{}.atlas'.format(os.path.splitext(fontPath)[0], size)
+        self.atlasFile = atlasFile
+        with open(fontPath, 'rb') as f:
+            self.fontHash = hashlib.sha1(f.read()).digest()
+        self.font = None  # only loaded when a glyph has to be rasterised
+        self.glyphs = {}  # character -> (coverage bitmap or None for blank glyphs, left, top, advance)
+        self.ascent = 0
+        self.descent = 0
+        self.isDirty = False
+        self.mmap = None
+        if not self.load():
+            for char in preload:
+                self.get_glyph(char)
+            self.save()
+
+    def get_font(self):
+        if self.font is None:
+            self.font = ImageFont.truetype(self.fontPath, self.size)
+            self.ascent, self.descent = self.font.getmetrics()
+        return self.font
+
+    def load(self):
+        # returns False if there is no usable atlas for this font and size
+        try:
+            with open(self.atlasFile, 'rb') as f:
+                self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        try:
+            magic, version, fontHash, size, ascent, descent, count = HEADER.unpack_from(self.mmap)
+        except struct.error:
+            self.close()
+            return False
+        if (magic, version, fontHash, size) != (MAGIC, VERSION, self.fontHash, self.size):
+            self.close()
+            return False
+        self.ascent, self.descent = ascent, descent
+        view = memoryview(self.mmap)
+        for i in range(count):
+            codepoint, offset, width, height, left, top, advance = ENTRY.unpack_from(
+                self.mmap, HEADER.size + i * ENTRY.size)
+            bitmap = None
+            if width and height:
+                bitmap = Image.frombuffer('L', (width, height), view[offset:offset + width * height], 'raw', 'L', 0, 1)
+            self.glyphs[chr(codepoint)] = (bitmap, left, top, advance)
+        return True
+
+    def rasterise(self, char):
+        font = self.get_font()
+        left, top, right, bottom = font.getbbox(char)
+        bitmap = None
+        if right > left and bottom > top:
+            bitmap = Image.new('L', (right - left, bottom - top), 0)
+            ImageDraw.Draw(bitmap).text((-left, -top), char, font=font, fill=255)
+        return bitmap, left, top, font.getlength(char)
+
+    def get_glyph(self, char):
+        glyph = self.glyphs.get(char)
+        if glyph is None:
+            glyph = self.rasterise(char)
+            self.glyphs[char] = glyph
+            self.isDirty = True
+        return glyph
+
+    def save(self):
+        chars = sorted(self.glyphs)
+        offset = HEADER.size + len(chars) * ENTRY.size
+        entries = bytearray()
+        bitmaps = bytearray()
+        for char in chars:
+            bitmap, left, top, advance = self.glyphs[char]
+            width, height = bitmap.size if bitmap is not None else (0, 0)
+            entries.extend(ENTRY.pack(ord(char), offset + len(bitmaps), width, height, left, top, advance))
+            if bitmap is not None:
+                bitmaps.extend(bitmap.tobytes())
+        # atlases of the same font and size may be saved by several farm workers at once
+        header = HEADER.pack(MAGIC, VERSION, self.fontHash, self.size, self.ascent, self.descent, len(chars))
+        write_atomic(self.atlasFile, header + entries + bitmaps)
+        self.isDirty = False
+
+    def close(self):
+        # Unmaps the atlas file. The glyphs loaded from it point into the mapping, so they are dropped along with it.
+        self.glyphs.clear()
+        if self.mmap is not None:
+            try:
+                self.mmap.close()
+            except BufferError:
+                pass  # a glyph bitmap is still referenced elsewhere, the mapping is closed once that is released
+            self.mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excInfo):
+        self.close()
+
+    def get_width(self, text):
+        return sum(self.get_glyph(char)[3] for char in text)
+
+    def fit_text(self, text, width):
+        # Shortens the text with an ellipsis to fit the width, like text-overflow: ellipsis
+        if self.get_width(text) <= width:
+            return text
+        width -= self.get_width('…')
+        used = 0
+        for i, char in enumerate(text):
+            used += self.get_glyph(char)[3]
+            if used > width:
+                return text[:i] + '…'
+        return text
+
+    def draw_text(self, image, xy, text, fill):
+        # Draws text with its top (at the ascent of the font) at xy
+        x, y = xy
+        for char in text:
+            bitmap, left, top, advance = self.get_glyph(char)
+            if bitmap is not None:
+                image.paste(fill, (round(x) + left, y + top), bitmap)
+            x += advance
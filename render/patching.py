@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Updates the calendar page already loaded in the browser in place, instead of writing the whole HTML into it again. A
+full write makes Chromium parse the stylesheets, lay out the whole grid and decode the fonts once more, when from one
+render to the next usually only a couple of day cells have changed (today's circle moving on, an event added), and
+now and then the month or the battery icon.
+
+The page is written once, as usual, and a small patch API is injected into it. Later renders only send what changed
+since the page was last drawn: the month, the battery class, the day names and the day cells that differ, each as the
+HTML that generate_html would have put there, so the page ends up the same as if it had been written afresh. The patch
+API times how long applying the changes and the layout that follows take, which is logged.
+
+Selected with "isDomPatching": true in config.json, and only of use when the browser is kept open between renders, in
+daemon mode. The page is written afresh whenever the browser is restarted or the template changes. The time from
+sending the changes to the screenshot can be compared with that of a full write:
+
+python3 -m render.patching --measure 20
+"""
+
+import datetime as dt
+import logging
+
+# window.maginkcalPatch(patch) applies the changes, and resolves to [ms spent applying them, ms spent on the layout]
+# once the fonts they need are loaded
+PATCH_API_SCRIPT = '''
+window.maginkcalPatch = function (patch) {
+    var start = performance.now();
+    if ('month' in patch) {
+        document.querySelector('.month').textContent = patch.month;
+    }
+    if ('battText' in patch) {
+        document.querySelector('.batt_container img').className = patch.battText;
+    }
+    if ('dayOfWeek' in patch) {
+        document.querySelector('.day-names').innerHTML = patch.dayOfWeek;
+    }
+    var days = document.querySelector('.days').children;
+    patch.days.forEach(function (day) {
+        days[day[0]].outerHTML = day[1];
+    });
+    var applied = performance.now();
+    document.body.getBoundingClientRect();  // forces the layout now, so that it can be timed
+    var laidOut = performance.now();
+    return document.fonts.ready.then(function () { return [applied - start, laidOut - applied]; });
+};
+'''
+PATCHED_PARTS = ('month', 'battText', 'dayOfWeek')
+
+
+def make_patch(previousParts, parts):
+    # Returns the changes from the parts shown on the page to the new ones, see RenderHelper.generate_parts, or None
+    # if the page has to be written afresh
+    if previousParts is None or len(previousParts['days']) != len(parts['days']):
+        return None
+    patch = {key: parts[key] for key in PATCHED_PARTS if parts[key] != previousParts[key]}
+    patch['days'] = [[i, day] for i, (day, previousDay) in enumerate(zip(parts['days'], previousParts['days']))
+                     if day != previousDay]
+    return patch
+
+
+def make_sample_days(count):
+    # Calendars of successive days, e.g. as seen by the daemon over a few weeks: today's circle moves on every day,
+    # and an event is added each day
+    from render.critical import make_sample_cal_dicts
+    calDict = make_sample_cal_dicts()[1]
+    calDicts = []
+    for i in range(count):
+        today = calDict['today'] + dt.timedelta(days=i % 14)
+        start = dt.datetime.combine(today, dt.time(18))
+        event = {'summary': 'Event {}'.format(i), 'startDatetime': start, 'endDatetime': start + dt.timedelta(hours=1),
+                 'allday': False, 'isUpdated': False, 'isMultiday': False}
+        calDicts.append(dict(calDict, today=today, events=calDict['events'] + [event]))
+    return calDicts
+
+
+def measure(renderService, calDicts):
+    # Returns the median time from the HTML being ready to the screenshot, in seconds, with and without patching,
+    # and the median time spent applying the patches and on the layout, in milliseconds
+    import statistics
+    import time
+    timings = {False: [], True: []}
+    patchTimings = []
+    renderService.isPersistentBrowser = True
+    try:
+        for isDomPatching in (False, True):
+            renderService.isDomPatching = isDomPatching
+            renderService.close_browser()
+            renderService.start_browser()
+            for i, calDict in enumerate(calDicts):
+                parts = renderService.generate_parts(calDict)
+                html = renderService.fill_template(parts)
+                start = time.perf_counter()
+                renderService.take_screenshot(html, parts)
+                if i > 0:  # the first render writes the page either way
+                    timings[isDomPatching].append(time.perf_counter() - start)
+                    if isDomPatching:
+                        patchTimings.append(renderService.lastPatchTimings)
+    finally:
+        renderService.close_browser()
+    return ({isDomPatching: statistics.median(values) for isDomPatching, values in timings.items()},
+            [statistics.median(values) for values in zip(*patchTimings)])
+
+
+def main():
+    import argparse
+    import json
+    from render.render import RenderHelper
+
+    parser = argparse.ArgumentParser(description='Compare patching the calendar page with writing it afresh.')
+    parser.add_argument('--measure', type=int, default=20, metavar='COUNT', help='renders of successive days to time')
+    parser.add_argument('--backend', default='devtools', choices=['browser', 'devtools'],
+                        help='how the screenshots are taken')
+    parser.add_argument('--config', default='config.json', help='config file for the image size')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s - %(message)s')
+
+    with open(args.config) as f:
+        config = json.load(f)
+    renderService = RenderHelper(config['imageWidth'], config['imageHeight'], config['rotateAngle'])
+    renderService.backend = args.backend
+    renderService.isInlineCss = config.get('isInlineCss', False)
+    timings, (applyMs, layoutMs) = measure(renderService, make_sample_days(args.measure + 1))
+    print('HTML to screenshot, median of {}: {:.3f}s written afresh, {:.3f}s patched ({:+.1%})'.format(
+        args.measure, timings[False], timings[True], (timings[True] - timings[False]) / timings[False]))
+    print('Patches took {:.1f}ms to apply and {:.1f}ms to lay out'.format(applyMs, layoutMs))
+
+
+if __name__ == '__main__':
+    main()
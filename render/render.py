@@ -15,22 +15,71 @@ from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.by import By
 import shutil
-from time import sleep
+import io
 from datetime import timedelta
 import pathlib
+import hashlib
+import os
+import json
 from PIL import Image
+from contextlib import nullcontext
 import logging
 
+from render.devtools import DevToolsBrowser
+from render.patching import PATCH_API_SCRIPT, make_patch
+
+# resolves once the page written into the browser has loaded, including its stylesheets and fonts
+WAIT_FOR_PAGE_SCRIPT = '''
+var done = arguments[arguments.length - 1];
+function check() {
+    if (document.readyState === 'complete') {
+        document.fonts.ready.then(function () { done(); });
+    } else {
+        setTimeout(check, 10);
+    }
+}
+check();
+'''
+
 
 class RenderHelper:
 
     def __init__(self, width, height, angle):
         self.logger = logging.getLogger('maginkcal')
         self.currPath = str(pathlib.Path(__file__).parent.absolute())
-        self.htmlFile = 'file://' + self.currPath + '/calendar.html'
+        self.outputName = 'calendar'  # calendar.html and calendar.png are written next to the template and its assets
+        self.isSaveFiles = False  # write the HTML and screenshot of each render to disk, for debugging
+        self.isInlineCss = False  # render from the template with a purged, inlined stylesheet, see render/critical.py
+        # 'browser' takes a screenshot of the HTML template through Selenium, 'devtools' does so over the DevTools
+        # protocol without chromedriver, 'pil' draws the calendar directly
+        self.backend = 'browser'
+        self.drawer = None
         self.imageWidth = width
         self.imageHeight = height
         self.rotateAngle = angle
+        self.driver = None
+        self.isPersistentBrowser = False  # keep the browser open after taking a screenshot, e.g. in daemon mode
+        self.recorder = None  # optionally set to an EnergyLogger to account for the time spent in each stage
+        self.isDomPatching = False  # patch what changed into the page left open since the last render, see patching.py
+        self.pageParts = None  # parts of the HTML shown in the open page, see generate_parts
+        self.pageKey = None  # template the open page was written from, with its modification time
+        self.lastPatchTimings = None  # ms spent applying the last patch and on the layout that followed
+
+    def stage(self, name):
+        if self.recorder is None:
+            return nullcontext()
+        return self.recorder.stage(name)
+
+    def get_output_file(self, extension):
+        return self.currPath + '/' + self.outputName + extension
+
+    def get_template_file(self):
+        if not self.isInlineCss:
+            return self.currPath + '/calendar_template.html'
+        from render.critical import get_inline_template_file, is_stale, build_inline_template
+        if is_stale(self.currPath):
+            return build_inline_template(self)
+        return get_inline_template_file(self.currPath)
 
     def set_viewport_size(self, driver):
 
@@ -50,13 +99,25 @@ class RenderHelper:
             width=target_width,
             height=target_height)
 
-    def get_screenshot(self):
+    def start_browser(self):
+        # Launch headless Chromium and size its viewport. This can be called ahead of time (e.g. while the calendar
+        # events are still being fetched) so that the browser is already warm by the time the HTML is ready
+        with self.stage('launch'):
+            self.launch_browser()
+
+    def launch_browser(self):
         from selenium.webdriver.chrome.service import Service
         chrome_path = shutil.which("chromium-browser")
         driver_path = shutil.which("chromedriver")
 
         if not chrome_path:
             raise FileNotFoundError("Could not find chromium-browser in PATH")
+        if self.backend == 'devtools':
+            browser = DevToolsBrowser(chrome_path, self.imageWidth, self.imageHeight)
+            browser.launch()
+            self.driver = browser
+            self.logger.info('Browser started.')
+            return
         if not driver_path:
             raise FileNotFoundError("Could not find chromedriver in PATH")
 
@@ -70,20 +131,122 @@ class RenderHelper:
         
         service = Service(executable_path=driver_path)
         driver = webdriver.Chrome(service=service, options=opts)
-
         try:
             self.set_viewport_size(driver)
-            driver.get(self.htmlFile)
-            sleep(1)
-            driver.get_screenshot_as_file(self.currPath + '/calendar.png')
-        finally:
+        except Exception:
             driver.quit()
-
-        self.logger.info('Screenshot captured and saved to file.')
-
-        redimg = Image.open(self.currPath + '/calendar.png')  # get image)
+            raise
+        self.driver = driver
+        self.logger.info('Browser started.')
+
+    def close_browser(self):
+        self.pageParts = None
+        if self.driver is not None:
+            try:
+                self.driver.quit()
+            finally:
+                self.driver = None
+
+    def close(self):
+        # Closes the browser and unmaps the glyph atlases, when done rendering
+        self.close_browser()
+        if self.drawer is not None:
+            self.drawer.close()
+            self.drawer = None
+
+    def abandon_browser(self):
+        # Used when a stage using the browser overran its deadline, in which case asking the browser to quit may well
+        # hang too. The driver process is killed instead, and a new browser started next time.
+        driver, self.driver = self.driver, None
+        self.pageParts = None
+        if driver is not None:
+            try:
+                if isinstance(driver, DevToolsBrowser):
+                    driver.kill()
+                else:
+                    driver.service.process.kill()
+            except Exception as e:
+                self.logger.info('Unable to kill the browser driver: {}'.format(e))
+
+    def take_screenshot(self, html, parts=None):
+        # The HTML is written into a page loaded from the render folder, so that the stylesheets, fonts and images it
+        # refers to resolve as if it was a file in there. Returns the screenshot as PNG data. With isDomPatching and the
+        # parts of the HTML given, only what changed is patched into the page when it is still open from the last time.
+        if self.driver is None:
+            self.start_browser()
+        driver = self.driver
+        templateFile = self.get_template_file()
+        pageKey = (templateFile, os.path.getmtime(templateFile))
+        try:
+            if not self.patch_page(driver, pageKey, parts):
+                self.write_page(driver, 'file://' + templateFile, html)
+                if self.isDomPatching and parts is not None:
+                    self.pageParts, self.pageKey = parts, pageKey
+            if isinstance(driver, DevToolsBrowser):
+                screenshot = driver.screenshot()
+            else:
+                screenshot = driver.get_screenshot_as_png()
+        except Exception:
+            self.close_browser()
+            raise
+        if not self.isPersistentBrowser:
+            self.close_browser()
+        return screenshot
+
+    def write_page(self, driver, templateUrl, html):
+        if isinstance(driver, DevToolsBrowser):
+            driver.write_page(templateUrl, html)
+            if self.isDomPatching:
+                driver.evaluate(PATCH_API_SCRIPT)
+            return
+        if not driver.current_url.startswith('file://' + self.currPath + '/'):
+            driver.get(templateUrl)
+        driver.execute_script('document.open(); document.write(arguments[0]); document.close();', html)
+        driver.execute_async_script(WAIT_FOR_PAGE_SCRIPT)
+        if self.isDomPatching:
+            driver.execute_script(PATCH_API_SCRIPT)
+
+    def patch_page(self, driver, pageKey, parts):
+        # Returns False if the page has to be written afresh instead
+        if not self.isDomPatching or parts is None or self.pageKey != pageKey:
+            return False
+        patch = make_patch(self.pageParts, parts)
+        if patch is None:
+            return False
+        self.pageParts = None  # in case the patch fails halfway
+        try:
+            if isinstance(driver, DevToolsBrowser):
+                timings = driver.evaluate('window.maginkcalPatch({})'.format(json.dumps(patch)), awaitPromise=True)
+            else:
+                timings = driver.execute_async_script(
+                    'window.maginkcalPatch(arguments[0]).then(arguments[arguments.length - 1]);', patch)
+        except Exception as e:
+            self.logger.info('Unable to patch the page, writing it afresh: {}'.format(e))
+            return False
+        self.pageParts = parts
+        self.lastPatchTimings = tuple(timings)
+        self.logger.info('Patched {} days into the page in {:.1f}ms, laid out in {:.1f}ms.'.format(
+            len(patch['days']), *self.lastPatchTimings))
+        return True
+
+    def get_screenshot(self, html, parts=None):
+        # Takes the screenshot of the HTML and splits it into its colours, decoding it straight from memory
+        with self.stage('browser'):
+            screenshot = self.take_screenshot(html, parts)
+
+        self.logger.info('Screenshot captured.')
+        if self.isSaveFiles:
+            with open(self.get_output_file('.png'), 'wb') as f:
+                f.write(screenshot)
+
+        with self.stage('split'):
+            return self.split_colours(Image.open(io.BytesIO(screenshot)))
+
+    def split_colours(self, image):
+        # Extracts the grayscale and red portions of the screenshot into separate images
+        redimg = image.convert('RGB')  # decoded once, then copied
         rpixels = redimg.load()  # create the pixel map
-        blackimg = Image.open(self.currPath + '/calendar.png')  # get image)
+        blackimg = redimg.copy()
         bpixels = blackimg.load()  # create the pixel map
 
         for i in range(redimg.size[0]):  # loop through every pixel in the image
@@ -122,20 +285,12 @@ class RenderHelper:
                 datetime_str = '{}{}am'.format(str(datetimeObj.hour), datetime_str)
         return datetime_str
 
-    def process_inputs(self, calDict):
-        # calDict = {'events': eventList, 'calStartDate': calStartDate, 'today': currDate, 'lastRefresh': currDatetime, 'batteryLevel': batteryLevel}
+    def get_cal_list(self, calDict):
         # first setup list to represent the 5 weeks in our calendar
         calList = []
         for i in range(35):
             calList.append([])
 
-        # retrieve calendar configuration
-        maxEventsPerDay = calDict['maxEventsPerDay']
-        batteryDisplayMode = calDict['batteryDisplayMode']
-        dayOfWeekText = calDict['dayOfWeekText']
-        weekStartDay = calDict['weekStartDay']
-        is24hour = calDict['is24hour']
-
         # for each item in the eventList, add them to the relevant day in our calendar list
         for event in calDict['events']:
             idx = self.get_day_in_cal(calDict['calStartDate'], event['startDatetime'].date())
@@ -145,18 +300,21 @@ class RenderHelper:
                 idx = self.get_day_in_cal(calDict['calStartDate'], event['endDatetime'].date())
                 if idx < len(calList):
                     calList[idx].append(event)
+        return calList
 
-        # Read html template
-        with open(self.currPath + '/calendar_template.html', 'r') as file:
-            calendar_template = file.read()
-
-        # Insert month header
-        month_name = str(calDict['today'].month)
+    def get_event_text(self, event, currDate, is24hour=False):
+        if event['isMultiday']:
+            if event['startDatetime'].date() == currDate:
+                return '►' + event['summary']
+            else:
+                return '◄' + event['summary']
+        elif event['allday']:
+            return event['summary']
+        else:
+            return self.get_short_time(event['startDatetime'], is24hour) + ' ' + event['summary']
 
-        # Insert battery icon
+    def get_battery_text(self, batteryDisplayMode, battLevel):
         # batteryDisplayMode - 0: do not show / 1: always show / 2: show when battery is low
-        battLevel = calDict['batteryLevel']
-
         if batteryDisplayMode == 0:
             battText = 'batteryHide'
         elif batteryDisplayMode == 1:
@@ -175,6 +333,78 @@ class RenderHelper:
             battText = 'battery0'
         elif batteryDisplayMode == 2 and battLevel >= 20.0:
             battText = 'batteryHide'
+        return battText
+
+    def get_signature(self, calDict):
+        # Fingerprint of everything that ends up on the display, used to tell if a refresh would change anything
+        battText = self.get_battery_text(calDict['batteryDisplayMode'], calDict['batteryLevel'])
+        events = [(e['summary'], e['startDatetime'].isoformat(), e['endDatetime'].isoformat(), e['allday'],
+                   e['isUpdated'], e['isMultiday']) for e in calDict['events']]
+        content = [calDict['calStartDate'].isoformat(), calDict['today'].isoformat(), battText,
+                   calDict['dayOfWeekText'], calDict['weekStartDay'], calDict['maxEventsPerDay'], calDict['is24hour'],
+                   self.imageWidth, self.imageHeight, self.rotateAngle, events]
+        return hashlib.sha1(json.dumps(content).encode('utf-8')).hexdigest()
+
+    def process_inputs(self, calDict):
+        if self.backend == 'pil':
+            return self.draw_calendar(calDict)
+
+        with self.stage('template'):
+            parts = self.generate_parts(calDict)
+            html = self.fill_template(parts)
+        if self.isSaveFiles:
+            with open(self.get_output_file('.html'), 'w') as f:
+                f.write(html)
+
+        calBlackImage, calRedImage = self.get_screenshot(html, parts)
+
+        return calBlackImage, calRedImage
+
+    def draw_calendar(self, calDict):
+        # Draws the calendar with PIL instead of taking a screenshot of the HTML in a browser
+        if self.drawer is None:
+            from render.drawing import CalendarDrawer
+            self.drawer = CalendarDrawer(self.imageWidth, self.imageHeight, self.rotateAngle, self.currPath)
+        battText = self.get_battery_text(calDict['batteryDisplayMode'], calDict['batteryLevel'])
+        with self.stage('template'):
+            images = self.drawer.draw(calDict, self.get_cal_list(calDict), battText,
+                                      lambda event, currDate: self.get_event_text(event, currDate,
+                                                                                  calDict['is24hour']))
+        self.logger.info('Calendar drawn.')
+        return images
+
+    def generate_html(self, calDict, template=None):
+        # calDict = {'events': eventList, 'calStartDate': calStartDate, 'today': currDate, 'lastRefresh': currDatetime, 'batteryLevel': batteryLevel}
+        return self.fill_template(self.generate_parts(calDict), template)
+
+    def fill_template(self, parts, template=None):
+        # Read html template
+        calendar_template = template
+        if calendar_template is None:
+            with open(self.get_template_file(), 'r') as file:
+                calendar_template = file.read()
+
+        # Append the bottom and return the page
+        return calendar_template.format(month=parts['month'], battText=parts['battText'], dayOfWeek=parts['dayOfWeek'],
+                                        events=''.join(day + '\n' for day in parts['days']))
+
+    def generate_parts(self, calDict):
+        # Returns what goes into the template: the month, the battery class, the day of week row, and the HTML of
+        # each day of the calendar, which is what render/patching.py compares from one render to the next
+        calList = self.get_cal_list(calDict)
+
+        # retrieve calendar configuration
+        maxEventsPerDay = calDict['maxEventsPerDay']
+        batteryDisplayMode = calDict['batteryDisplayMode']
+        dayOfWeekText = calDict['dayOfWeekText']
+        weekStartDay = calDict['weekStartDay']
+        is24hour = calDict['is24hour']
+
+        # Insert month header
+        month_name = str(calDict['today'].month)
+
+        # Insert battery icon
+        battText = self.get_battery_text(batteryDisplayMode, calDict['batteryLevel'])
 
         # Populate the day of week row
         cal_days_of_week = ''
@@ -183,47 +413,28 @@ class RenderHelper:
                 (i + weekStartDay) % 7] + "</li>\n"
 
         # Populate the date and events
-        cal_events_text = ''
+        cal_days = []
         for i in range(len(calList)):
             currDate = calDict['calStartDate'] + timedelta(days=i)
             dayOfMonth = currDate.day
             if currDate == calDict['today']:
-                cal_events_text += '<li><div class="datecircle">' + str(dayOfMonth) + '</div>\n'
+                cal_day_text = '<li><div class="datecircle">' + str(dayOfMonth) + '</div>\n'
             elif currDate.month != calDict['today'].month:
-                cal_events_text += '<li><div class="date text-muted">' + str(dayOfMonth) + '</div>\n'
+                cal_day_text = '<li><div class="date text-muted">' + str(dayOfMonth) + '</div>\n'
             else:
-                cal_events_text += '<li><div class="date">' + str(dayOfMonth) + '</div>\n'
+                cal_day_text = '<li><div class="date">' + str(dayOfMonth) + '</div>\n'
 
             for j in range(min(len(calList[i]), maxEventsPerDay)):
                 event = calList[i][j]
-                cal_events_text += '<div class="event'
+                cal_day_text += '<div class="event'
                 if event['isUpdated']:
-                    cal_events_text += ' text-danger'
+                    cal_day_text += ' text-danger'
                 elif currDate.month != calDict['today'].month:
-                    cal_events_text += ' text-muted'
-                if event['isMultiday']:
-                    if event['startDatetime'].date() == currDate:
-                        cal_events_text += '">►' + event['summary']
-                    else:
-                        # calHtmlList.append(' text-multiday">')
-                        cal_events_text += '">◄' + event['summary']
-                elif event['allday']:
-                    cal_events_text += '">' + event['summary']
-                else:
-                    cal_events_text += '">' + self.get_short_time(event['startDatetime'], is24hour) + ' ' + event[
-                        'summary']
-                cal_events_text += '</div>\n'
+                    cal_day_text += ' text-muted'
+                cal_day_text += '">' + self.get_event_text(event, currDate, is24hour) + '</div>\n'
             if len(calList[i]) > maxEventsPerDay:
-                cal_events_text += '<div class="event text-muted">' + str(len(calList[i]) - maxEventsPerDay) + ' more'
+                cal_day_text += '<div class="event text-muted">' + str(len(calList[i]) - maxEventsPerDay) + ' more'
 
-            cal_events_text += '</li>\n'
+            cal_days.append(cal_day_text + '</li>')
 
-        # Append the bottom and write the file
-        htmlFile = open(self.currPath + '/calendar.html', "w")
-        htmlFile.write(calendar_template.format(month=month_name, battText=battText, dayOfWeek=cal_days_of_week,
-                                                events=cal_events_text))
-        htmlFile.close()
-
-        calBlackImage, calRedImage = self.get_screenshot()
-
-        return calBlackImage, calRedImage
+        return {'month': month_name, 'battText': battText, 'dayOfWeek': cal_days_of_week, 'days': cal_days}
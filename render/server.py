@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Publishes the latest rendered frame (see render/framebuffer.py) over HTTP, so that one RPi can render the calendar
+while thin display nodes only fetch the frame and upload it to their panel. Every frame has an ETag, so a display node
+that sends it back in If-None-Match gets a 304 without a body when nothing changed since its last update.
+
+The frame is also written to render/frame.bin, which is served again after a restart, and can be copied to any static
+file host instead.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from render.framebuffer import get_etag
+from pipeline.files import write_atomic
+import threading
+import pathlib
+import logging
+
+
+class FrameHandler(BaseHTTPRequestHandler):
+
+    def do_HEAD(self):
+        self.send_frame(isHead=True)
+
+    def do_GET(self):
+        self.send_frame()
+
+    def send_frame(self, isHead=False):
+        if self.path.split('?')[0] != '/frame':
+            self.send_error(404)
+            return
+        frame, etag = self.server.frameService.get_frame()
+        if frame is None:
+            self.send_error(503, 'No frame rendered yet')
+            return
+        if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(frame)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        if not isHead:
+            self.wfile.write(frame)
+
+    def log_message(self, format, *args):
+        self.server.frameService.logger.debug('Frame server: ' + format % args)
+
+
+class FrameServer:
+
+    def __init__(self, host='0.0.0.0', port=8091, frameFile=None):
+        self.logger = logging.getLogger('maginkcal')
+        self.host = host
+        self.port = port
+        if frameFile is None:
+            frameFile = str(pathlib.Path(__file__).parent.absolute()) + '/frame.bin'
+        self.frameFile = frameFile
+        self.lock = threading.Lock()
+        self.frame = None
+        self.etag = None
+        self.server = None
+        try:
+            with open(self.frameFile, 'rb') as f:
+                self.set_frame(f.read())
+        except OSError:
+            pass
+
+    def set_frame(self, frame):
+        with self.lock:
+            self.frame = frame
+            self.etag = get_etag(frame)
+
+    def get_frame(self):
+        with self.lock:
+            return self.frame, self.etag
+
+    def publish(self, frame):
+        self.set_frame(frame)
+        write_atomic(self.frameFile, frame)
+        self.logger.info('Published frame {} ({} bytes).'.format(self.etag, len(frame)))
+
+    def start(self):
+        self.server = ThreadingHTTPServer((self.host, self.port), FrameHandler)
+        self.server.daemon_threads = True
+        self.server.frameService = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.logger.info('Frame server listening on {}:{}'.format(*self.server.server_address[:2]))
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None